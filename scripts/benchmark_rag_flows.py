@@ -0,0 +1,82 @@
+"""
+Measure how long it takes to set up the RAG flow for a chat request, without calling any model or database:
+either building the model and agents for every request, as the routes used to
+(for SimpleRAGChat that overstates it slightly, since it never built the Searcher agent),
+or binding the request to the agents that RAGFlowFactory built once for the process.
+
+    python scripts/benchmark_rag_flows.py --requests 2000
+"""
+
+import argparse
+import time
+
+from openai import AsyncOpenAI
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from fastapi_app.api_models import ChatRequest, ChatRequestContext, ChatRequestOverrides
+from fastapi_app.postgres_searcher import PostgresSearcher
+from fastapi_app.rag_flow_factory import RAGFlowFactory, create_rag_agents
+
+
+def make_chat_request(use_advanced_flow: bool) -> ChatRequest:
+    return ChatRequest(
+        messages=[
+            {"content": "How many days of annual leave do I get?", "role": "user"},
+            {"content": "You get 30 working days of annual leave per year [12].", "role": "assistant"},
+            {"content": "Can I carry them over to next year?", "role": "user"},
+        ],
+        context=ChatRequestContext(overrides=ChatRequestOverrides(use_advanced_flow=use_advanced_flow)),
+    )
+
+
+def time_per_request(create_flow, requests: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(requests):
+        create_flow()
+    return (time.perf_counter() - start_time) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-request setup of the RAG flows")
+    parser.add_argument("--requests", type=int, default=1000, help="Number of simulated requests per measurement")
+    parser.add_argument("--chat-model", type=str, default="gpt-4o-mini")
+    args = parser.parse_args()
+
+    # The client is never called, it only has to exist for the models to be built
+    openai_chat_client = AsyncOpenAI(api_key="not-used", base_url="http://localhost")
+    searcher = PostgresSearcher(
+        db_session=AsyncSession(),
+        openai_embed_client=openai_chat_client,
+        embed_deployment=None,
+        embed_model="text-embedding-3-large",
+        embed_dimensions=1024,
+        embedding_column="embedding_3l",
+    )
+    factory = RAGFlowFactory(openai_chat_client, args.chat_model, None)
+
+    for use_advanced_flow in (False, True):
+        chat_request = make_chat_request(use_advanced_flow)
+        flow_class = type(factory.create_flow(chat_request, searcher))
+
+        def create_flow_per_request():
+            # Builds the model, the agents and the search tool's schema like every request did before
+            return flow_class(
+                messages=chat_request.messages,
+                overrides=chat_request.context.overrides,
+                searcher=searcher,
+                agents=create_rag_agents(openai_chat_client, args.chat_model, None),
+            )
+
+        def create_flow_from_factory():
+            return factory.create_flow(chat_request, searcher)
+
+        before = time_per_request(create_flow_per_request, args.requests)
+        after = time_per_request(create_flow_from_factory, args.requests)
+        print(
+            f"{flow_class.__name__}: {before * 1e6:.1f} µs per request when building the agents, "
+            f"{after * 1e6:.1f} µs with the shared agents ({before / after:.1f}x faster)"
+        )
+
+
+if __name__ == "__main__":
+    main()
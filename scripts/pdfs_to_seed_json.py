@@ -1,16 +1,20 @@
 import os
 import json
+import hashlib
 import fitz
 import openai
+import threading
 import time
 import tiktoken
 from tqdm import tqdm
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 
  
 from openai import AzureOpenAI
 
+from fastapi_app.seed_io import SeedWriter, read_seed_records
+
 # === Load environment ===
 load_dotenv()
 
@@ -24,10 +28,12 @@ deployment_name = os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT")  # Your Azure deplo
 
 
 # Initialize the client
+# Retries are handled by get_embeddings_with_retry, which also adapts the request concurrency
 client = AzureOpenAI(
     api_key=api_key,
     api_version=api_version,
     azure_endpoint=endpoint,
+    max_retries=0,
 )
 
 
@@ -39,7 +45,13 @@ BASE_FILEURLS = ["https://hrhandbook.iom.int/system/files/policies/",
                  "https://governingbodies.iom.int/"]
 DOCTYPES = ["HR Policy", "Administration Instruction", "Manuals",  "Audit"]
 
-OUTPUT_FILE = "seed_data_iom_all-small7.json"
+# Use a .jsonl.gz or .jsonl file name for the compact line-delimited format, or .json for a single JSON array
+OUTPUT_FILE = "seed_data_iom_all-small7.jsonl.gz"
+# The full text of each page, referenced by the page_id of the chunk records (load it as seed_pages.jsonl.gz)
+PAGES_OUTPUT_FILE = "seed_pages_iom_all-small7.jsonl.gz"
+# Only the chunks and pages that changed since the delta files were last deleted, to update an existing database
+DELTA_OUTPUT_FILE = "seed_data_iom_all-small7_delta.jsonl.gz"
+DELTA_PAGES_OUTPUT_FILE = "seed_pages_iom_all-small7_delta.jsonl.gz"
 
 
 # === File conversion ====
@@ -125,7 +137,6 @@ def convert_file_to_pdf(input_path, output_path):
     except Exception as e:
         raise RuntimeError(f"Conversion error: {e}")
     
-from pathlib import Path
 import filetype
 def process_directories(directories):
     for dir_path in directories:
@@ -152,12 +163,18 @@ def process_directories(directories):
                 except Exception as e:
                     print(f"Error processing {file_path}: {str(e)}")
 
-process_directories(PDF_DIRS)
-
 # === settings ===
 MAX_TOKENS_PER_CHUNK = 400
-MAX_RETRIES = 3
-THREAD_WORKERS = 5
+MAX_RETRIES = 5
+THREAD_WORKERS = 16  # upper bound for the adaptive number of concurrent embedding requests
+PROCESS_WORKERS = os.cpu_count()  # worker processes for text extraction, cleaning and chunking
+INITIAL_CONCURRENCY = 4
+MAX_PENDING_BATCHES = 2 * THREAD_WORKERS  # embedding batches queued before file extraction waits
+MAX_PENDING_FILES = 2 * (PROCESS_WORKERS or 1)  # files submitted for extraction ahead of the embedding
+# Chunks are packed into one embedding request up to these limits
+# (the API accepts at most 2048 inputs and 300,000 tokens per request)
+MAX_BATCH_INPUTS = 2048
+MAX_BATCH_TOKENS = 100_000
 
 # === Tokenizer ===
 tokenizer = tiktoken.encoding_for_model("text-embedding-3-small")  # compatible with Azure
@@ -202,22 +219,122 @@ def semantic_chunk(paragraphs, max_tokens=MAX_TOKENS_PER_CHUNK):
 
 # === Embedding ===
 
-def get_embedding_with_retry(text, retries=3, delay=2):
+def make_token_batches(tasks, max_inputs=MAX_BATCH_INPUTS, max_tokens=MAX_BATCH_TOKENS):
+    """
+    Packs (chunk, metadata) tasks into batches that stay within the per-request input and token limits.
+    Yields each batch as soon as it is full, so tasks can be streamed in while they are produced.
+    """
+    batch: list[tuple[str, dict]] = []
+    batch_tokens = 0
+    for chunk, metadata in tasks:
+        chunk_tokens = count_tokens(chunk)
+        if batch and (len(batch) >= max_inputs or batch_tokens + chunk_tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append((chunk, metadata))
+        batch_tokens += chunk_tokens
+    if batch:
+        yield batch
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of concurrent embedding requests with additive increase / multiplicative decrease:
+    every successful request raises the limit by 1/limit (about +1 per round of requests),
+    every rate-limited request halves it and pauses all workers until the Retry-After time has passed.
+    """
+
+    def __init__(self, initial_limit=INITIAL_CONCURRENCY, max_limit=THREAD_WORKERS, min_limit=1):
+        self.limit = float(initial_limit)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                pause = self.resume_at - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self, rate_limited=False, retry_after=None):
+        with self.condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(self.min_limit, self.limit / 2)
+                if retry_after:
+                    self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+def get_retry_after(error, default):
+    """
+    Returns the number of seconds to wait before retrying, from the Retry-After headers of a 429 response.
+    """
+    headers = error.response.headers if getattr(error, "response", None) is not None else {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # Retry-After can also be an HTTP date, fall back to the default delay
+    return default
+
+
+def get_embeddings_with_retry(texts, limiter, retries=MAX_RETRIES, delay=2):
+    """
+    Embeds a batch of texts in one request.
+    Returns one embedding per text in input order, with None for each text that could not be embedded.
+    """
     for attempt in range(retries):
+        limiter.acquire()
         try:
             response = client.embeddings.create(
-                input=[text],
+                input=texts,
                 model=deployment_name  # This must match your deployment name in Azure
             )
-            return response.data[0].embedding
+        except openai.RateLimitError as e:
+            wait_time = get_retry_after(e, default=delay * (2 ** attempt))
+            limiter.release(rate_limited=True, retry_after=wait_time)
+            print(
+                f"⚠️ Rate limited ({attempt + 1}/{retries}), concurrency now {int(limiter.limit)}. "
+                f"Waiting {wait_time}s..."
+            )
+            continue
+        except openai.BadRequestError as e:
+            limiter.release()
+            if len(texts) == 1:
+                print(f"❌ Embedding request rejected: {e}")
+                return [None]
+            # Split the batch so that one rejected input does not lose the whole batch
+            half = len(texts) // 2
+            first = get_embeddings_with_retry(texts[:half], limiter, retries, delay)
+            second = get_embeddings_with_retry(texts[half:], limiter, retries, delay)
+            return first + second
         except Exception as e:
+            limiter.release()
             if attempt < retries - 1:
                 wait_time = delay * (2 ** attempt)
                 print(f"⚠️ Retry {attempt + 1}/{retries} failed: {e}. Waiting {wait_time}s...")
                 time.sleep(wait_time)
-            else:
-                print(f"❌ Final retry failed for embedding: {e}")
-                return []
+                continue
+            print(f"❌ Final retry failed for embedding batch: {e}")
+            return [None] * len(texts)
+        limiter.release()
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    print(f"❌ Still rate limited after {retries} retries, giving up on batch of {len(texts)} chunks")
+    return [None] * len(texts)
 
 
 
@@ -229,8 +346,7 @@ def fallback_pdfplumber_text(file_path):
     try:
         with pdfplumber.open(file_path) as pdf:
             for page in pdf.pages:
-                texts.append(page.extract_text() or "")
-                texts = clean_text(texts)
+                texts.append(clean_text(page.extract_text() or ""))
         return texts
     except Exception as e:
         print(f"❌ Fallback also failed for {file_path}: {e}")
@@ -244,6 +360,63 @@ from datetime import datetime
 import unicodedata
 from collections import OrderedDict
 
+# Patterns are compiled once at import, since clean_text runs for every page
+LINE_ENDINGS_PATTERN = re.compile(r'\r\n?')
+SPACES_PATTERN = re.compile(r'[ \t]+')
+BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# Header/footer patterns
+HEADER_FOOTER_PATTERNS = [
+    re.compile(pattern, flags=re.MULTILINE)
+    for pattern in [
+        r'(?i)\bconfidential\b.*?\bdraft\b',
+        r'(?i)page\s*\d+\s*(of\s*\d+)?',
+        r'(?i)^footer:.*$',
+        r'(?i)^header:.*$',
+        r'^\s*\d{1,3}\s*$',
+        r'(?i)^this\s+document\s+is\s+proprietary\b.*$'
+    ]
+]
+
+DEFAULT_TYPOS = {
+    'polciy': 'policy',
+    'departement': 'department',
+    'adress': 'address',
+    'recieve': 'receive',
+    'goverment': 'government',
+    'documen': 'document',
+    'teh': 'the',
+    'wether': 'whether'
+}
+
+
+def compile_typo_pattern(typos):
+    return re.compile('|'.join(rf'\b{re.escape(k)}\b' for k in typos), re.IGNORECASE)
+
+
+DEFAULT_TYPO_PATTERN = compile_typo_pattern(DEFAULT_TYPOS)
+
+DATE_FORMATS = [
+    ('%m/%d/%Y', r'\b\d{2}/\d{2}/\d{4}\b'),
+    ('%d-%b-%y', r'\b\d{2}-[a-zA-Z]{3}-\d{2}\b'),
+    ('%Y-%m-%d', r'\b\d{4}-\d{2}-\d{2}\b'),
+    ('%B %d, %Y', r'\b[A-Za-z]+ \d{1,2}, \d{4}\b'),
+    ('%b %d, %Y', r'\b[A-Za-z]{3} \d{1,2}, \d{4}\b')
+]
+DATE_PATTERN = re.compile('|'.join(fmt[1] for fmt in DATE_FORMATS))
+
+
+def normalize_date(match):
+    date_str = match.group(0)
+    for fmt, _ in DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return date_str
+
+
 def clean_text(
     text: str,
     additional_headers_footers: Optional[List[str]] = None,
@@ -262,37 +435,24 @@ def clean_text(
     text = ''.join(c for c in text if c.isprintable() or c in {'\n', '\t'})
 
     # Standardize spacing and line endings
-    text = re.sub(r'\r\n?', '\n', text)
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = LINE_ENDINGS_PATTERN.sub('\n', text)
+    text = SPACES_PATTERN.sub(' ', text)
+    text = BLANK_LINES_PATTERN.sub('\n\n', text)
 
-    # Header/footer patterns
-    default_patterns = [
-        r'(?i)\bconfidential\b.*?\bdraft\b',
-        r'(?i)page\s*\d+\s*(of\s*\d+)?',
-        r'(?i)^footer:.*$',
-        r'(?i)^header:.*$',
-        r'^\s*\d{1,3}\s*$',
-        r'(?i)^this\s+document\s+is\s+proprietary\b.*$'
+    # Remove headers and footers
+    all_patterns = HEADER_FOOTER_PATTERNS + [
+        re.compile(pattern, flags=re.MULTILINE) for pattern in additional_headers_footers or []
     ]
-    all_patterns = default_patterns + (additional_headers_footers or [])
-
     for pattern in all_patterns:
-        text = re.sub(pattern, '', text, flags=re.MULTILINE)
+        text = pattern.sub('', text)
 
     # Correct typos
-    default_typos = {
-        'polciy': 'policy',
-        'departement': 'department',
-        'adress': 'address',
-        'recieve': 'receive',
-        'goverment': 'government',
-        'documen': 'document',
-        'teh': 'the',
-        'wether': 'whether'
-    }
-    typos = {**default_typos, **(additional_typos or {})}
-    typo_pattern = re.compile('|'.join(rf'\b{re.escape(k)}\b' for k in typos), re.IGNORECASE)
+    if additional_typos:
+        typos = {**DEFAULT_TYPOS, **additional_typos}
+        typo_pattern = compile_typo_pattern(typos)
+    else:
+        typos = DEFAULT_TYPOS
+        typo_pattern = DEFAULT_TYPO_PATTERN
 
     def replace_typo(match):
         return typos[match.group(0).lower()]
@@ -300,25 +460,7 @@ def clean_text(
     text = typo_pattern.sub(replace_typo, text)
 
     # Normalize dates
-    date_formats = [
-        ('%m/%d/%Y', r'\b\d{2}/\d{2}/\d{4}\b'),
-        ('%d-%b-%y', r'\b\d{2}-[a-zA-Z]{3}-\d{2}\b'),
-        ('%Y-%m-%d', r'\b\d{4}-\d{2}-\d{2}\b'),
-        ('%B %d, %Y', r'\b[A-Za-z]+ \d{1,2}, \d{4}\b'),
-        ('%b %d, %Y', r'\b[A-Za-z]{3} \d{1,2}, \d{4}\b')
-    ]
-
-    def normalize_date(match):
-        date_str = match.group(0)
-        for fmt, _ in date_formats:
-            try:
-                return datetime.strptime(date_str, fmt).strftime('%Y-%m-%d')
-            except ValueError:
-                continue
-        return date_str
-
-    combined_date_pattern = '|'.join(fmt[1] for fmt in date_formats)
-    text = re.sub(combined_date_pattern, normalize_date, text)
+    text = DATE_PATTERN.sub(normalize_date, text)
 
     # Deduplicate and filter short paragraphs
     paragraphs = [p.strip() for p in text.split('\n') if p.strip()]
@@ -326,13 +468,13 @@ def clean_text(
 
     for para in paragraphs:
         if len(para) >= min_paragraph_length:
-            key = re.sub(r'\s+', ' ', para.lower())
+            key = WHITESPACE_PATTERN.sub(' ', para.lower())
             if key not in seen:
                 seen[key] = para
 
     # Reconstruct cleaned text
     final_text = '\n'.join(seen.values())
-    final_text = re.sub(r'\n{3,}', '\n\n', final_text).strip()
+    final_text = BLANK_LINES_PATTERN.sub('\n\n', final_text).strip()
 
     return final_text
 
@@ -358,85 +500,403 @@ def extract_text_by_page(file_path):
 
 EXPECTED_EMBED_DIM = 1536  # for text-embedding-3-small
 
-def build_chunk_record(chunk_text, metadata):
-    embedding = get_embedding_with_retry(chunk_text)
-
-    if not embedding:
-        print(f"❌ Empty embedding for file {metadata['filename']} chunk {metadata['chunk']}")
-        return None
+def build_chunk_records(batch, limiter):
+    embeddings = get_embeddings_with_retry([chunk for chunk, _ in batch], limiter)
 
-    if len(embedding) != EXPECTED_EMBED_DIM:
-        print(f"❌ Invalid embedding dimension ({len(embedding)}) for file {metadata['filename']} chunk {metadata['chunk']}")
-        return None
-
-    return {**metadata, "embedding_3l": embedding}
+    records = []
+    for (_, metadata), embedding in zip(batch, embeddings):
+        if embedding is None:
+            print(f"❌ Missing embedding for file {metadata['filename']} chunk {metadata['chunk']}")
+            continue
+        if len(embedding) != EXPECTED_EMBED_DIM:
+            print(
+                f"❌ Invalid embedding dimension ({len(embedding)}) "
+                f"for file {metadata['filename']} chunk {metadata['chunk']}"
+            )
+            continue
+        records.append({**metadata, "embedding_3l": embedding})
+    return records
 
 
 def process_file(filename, folder_path, base_fileurl, doctype):
+    """
+    Returns the pages of the file and the (chunk, metadata) tasks of their chunks.
+    Each chunk record stores only its own text; the page text is stored once in the page record.
+    """
     file_path = os.path.join(folder_path, filename)
     fileurl = base_fileurl + filename
     pages = extract_text_by_page(file_path)
+    page_records = []
     chunk_tasks = []
 
     for page_num, page_text in enumerate(pages, start=1):
+        page_records.append({
+            "filename": filename,
+            "fileurl": fileurl,
+            "typedoc": doctype,
+            "pagenumber": page_num,
+            "content": page_text,
+        })
         paragraphs = page_text.split("\n")
         chunks = semantic_chunk(paragraphs)
         for chunk_idx, chunk in enumerate(chunks):
             metadata = {
                 "filename": filename,
                 "fileurl": fileurl,
-                "content": page_text,
+                "content": chunk,
                 "typedoc": doctype,
                 "pagenumber": page_num,
                 "chunk": chunk_idx
             }
             chunk_tasks.append((chunk, metadata))
 
-    return chunk_tasks
+    return page_records, chunk_tasks
 
 
-# === Main Processing ===
-def process_all_pdfs():
-    all_tasks = []
+# === Manifest ===
+# The manifest records what was ingested on earlier runs, so that only new or changed chunks are embedded again.
+# The delta files hold those chunks and pages, plus {"id": ..., "deleted": true} tombstones for removed ones.
+# Each run adds its changes to the delta files, so delete them once they are loaded into the database.
+# The full output files are the previous ones with the delta applied, to seed an empty database.
+# Bump CHUNKER_VERSION whenever the cleaning or chunking changes, to re-embed every chunk.
+# Delete the manifest (and the output files) to embed everything again with new ids.
 
-    for folder_path, base_fileurl, doctype in zip(PDF_DIRS, BASE_FILEURLS, DOCTYPES):
-        print(f"📁 Scanning folder: {folder_path}")
+MANIFEST_FILE = "seed_manifest.json"
+CHUNKER_VERSION = "2"
 
 
+def load_manifest(path=MANIFEST_FILE):
+    if not os.path.exists(path):
+        return {"next_id": 1, "next_page_id": 1, "files": {}}
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest.setdefault("next_page_id", 1)
+    return manifest
 
 
-        for filename in os.listdir(folder_path):
-            if filename.lower().endswith(".pdf"):
-                print(f"📄 Processing file: {filename}")
-                try:
-                    tasks = process_file(filename, folder_path, base_fileurl, doctype)
-                    all_tasks.extend(tasks)
-                except Exception as e:
-                    print(f"❌ Error processing {filename}: {e}")
+def save_manifest(manifest, path=MANIFEST_FILE):
+    # Write to a temporary file first so that an interrupted run never leaves a truncated manifest
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
 
-    results = []
-    with ThreadPoolExecutor(max_workers=THREAD_WORKERS) as executor:
-        futures = [executor.submit(build_chunk_record, chunk, meta) for chunk, meta in all_tasks]
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Embedding chunks"):
-            result = future.result()
-            if result:
-                results.append(result)
 
-    # Add IDs
-    for idx, record in enumerate(results, start=1):
-        record["id"] = idx
+def hash_file(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
 
-    return results
 
+def hash_chunk(chunk_text, metadata):
+    """
+    Hashes everything that ends up in the chunk record, plus the chunker version and embedding model,
+    so the hash changes whenever the record or its embedding would change.
+    """
+    key = json.dumps([CHUNKER_VERSION, deployment_name, chunk_text, metadata], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
-def main():
-    print(f"📁 Reading PDFs from {PDF_DIRS}")
-    records = process_all_pdfs()
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(records, f, indent=2, ensure_ascii=False)
+def hash_page(page):
+    key = json.dumps([CHUNKER_VERSION, page], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def is_reusable(file_entry, manifest):
+    """
+    Whether the manifest entry of a file can be kept as is when the file itself has not changed.
+    """
+    if not file_entry:
+        return False
+    if manifest.get("chunker_version") != CHUNKER_VERSION or manifest.get("embed_model") != deployment_name:
+        return False
+    # Chunks that failed to embed on the last run have no hash
+    return all(chunk["hash"] is not None for chunk in file_entry["chunks"].values())
+
+
+def get_chunk_key(metadata):
+    return f"{metadata['pagenumber']}:{metadata['chunk']}"
+
+
+def diff_file_pages(pages, file_entry, manifest):
+    """
+    Compares the pages of a changed file with its manifest entry, like diff_file_chunks does for chunks.
+    Returns the page records to write, the new page entries and the tombstones.
+    """
+    old_pages = file_entry.get("pages", {}) if file_entry else {}
+    changed_pages = []
+    page_entries = {}
+    for page in pages:
+        page_key = str(page["pagenumber"])
+        page_hash = hash_page(page)
+        old_page = old_pages.get(page_key)
+        if old_page:
+            page_id = old_page["id"]
+        else:
+            page_id = manifest["next_page_id"]
+            manifest["next_page_id"] += 1
+        page_entries[page_key] = {"id": page_id, "hash": page_hash}
+        if not old_page or old_page["hash"] != page_hash:
+            changed_pages.append({**page, "id": page_id})
+    tombstones = [{"id": page["id"], "deleted": True} for key, page in old_pages.items() if key not in page_entries]
+    return changed_pages, page_entries, tombstones
+
 
-    print(f"✅ {len(records)} records written to {OUTPUT_FILE}")
+def diff_file_chunks(tasks, file_entry, manifest, page_entries):
+    """
+    Compares the chunks of a changed file with its manifest entry.
+    Chunks keep their id as long as their position (page and chunk number) exists,
+    new positions get new ids and positions that no longer exist become tombstones.
+    Returns the tasks to embed, the new chunk entries and the tombstones.
+    """
+    old_chunks = file_entry["chunks"] if file_entry else {}
+    changed_tasks = []
+    chunks = {}
+    for chunk_text, metadata in tasks:
+        chunk_key = get_chunk_key(metadata)
+        chunk_hash = hash_chunk(chunk_text, metadata)
+        old_chunk = old_chunks.get(chunk_key)
+        if old_chunk:
+            chunk_id = old_chunk["id"]
+        else:
+            chunk_id = manifest["next_id"]
+            manifest["next_id"] += 1
+        chunks[chunk_key] = {"id": chunk_id, "hash": chunk_hash}
+        if not old_chunk or old_chunk["hash"] != chunk_hash:
+            page_id = page_entries[str(metadata["pagenumber"])]["id"]
+            changed_tasks.append((chunk_text, {**metadata, "id": chunk_id, "page_id": page_id}))
+    tombstones = [{"id": chunk["id"], "deleted": True} for key, chunk in old_chunks.items() if key not in chunks]
+    return changed_tasks, chunks, tombstones
+
+
+# === Main Processing ===
+def extract_file(filename, folder_path, base_fileurl, doctype, unchanged_sha256=None):
+    """
+    Runs in a worker process: hashes the file and, unless the hash equals unchanged_sha256,
+    extracts, cleans and chunks its text. Returns the file hash and the pages and chunk tasks (None if unchanged).
+    """
+    file_hash = hash_file(os.path.join(folder_path, filename))
+    if file_hash == unchanged_sha256:
+        return file_hash, None
+    return file_hash, process_file(filename, folder_path, base_fileurl, doctype)
+
+
+def process_all_pdfs(writer, page_writer):
+    """
+    Writes the records of new or changed chunks and tombstones for removed chunks to the seed writer,
+    the same for pages to the page seed writer, and returns the updated manifest.
+    Files are extracted in worker processes, and their chunks are fed to the embedding requests
+    as soon as each file is done.
+    """
+    manifest = load_manifest()
+    old_files = manifest["files"]
+    files = {}
+    tombstones = []
+    page_tombstones = []
+    chunk_locations = {}  # id of each chunk to embed -> (file key, chunk key) in the manifest
+
+    def iter_changed_tasks(extract_executor):
+        changed_files = []
+        for folder_path, base_fileurl, doctype in zip(PDF_DIRS, BASE_FILEURLS, DOCTYPES):
+            print(f"📁 Scanning folder: {folder_path}")
+
+            for filename in os.listdir(folder_path):
+                if filename.lower().endswith(".pdf"):
+                    file_key = f"{folder_path}/{filename}"
+                    file_stat = os.stat(os.path.join(folder_path, filename))
+                    file_entry = old_files.get(file_key)
+                    reusable = is_reusable(file_entry, manifest)
+                    unchanged = reusable and (
+                        file_entry["size"] == file_stat.st_size and file_entry["mtime"] == file_stat.st_mtime
+                    )
+                    if unchanged:
+                        files[file_key] = file_entry
+                        continue
+                    unchanged_sha256 = file_entry["sha256"] if reusable else None
+                    changed_files.append(
+                        (file_key, filename, folder_path, base_fileurl, doctype, file_stat, unchanged_sha256)
+                    )
+
+        # Only a few files are extracted ahead of the embedding, and the next one is submitted as each one is diffed,
+        # so that the extracted text of the files waiting for their embeddings does not pile up in memory
+        pending_files = iter(changed_files)
+        extract_futures = {}
+
+        def submit_next_file():
+            next_file = next(pending_files, None)
+            if next_file is None:
+                return
+            file_key, filename, folder_path, base_fileurl, doctype, file_stat, unchanged_sha256 = next_file
+            future = extract_executor.submit(
+                extract_file, filename, folder_path, base_fileurl, doctype, unchanged_sha256
+            )
+            extract_futures[future] = (file_key, filename, file_stat)
+
+        for _ in range(MAX_PENDING_FILES):
+            submit_next_file()
+
+        with tqdm(total=len(changed_files), desc="Extracting files") as extract_progress:
+            while extract_futures:
+                done, _ = wait(extract_futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_key, filename, file_stat = extract_futures.pop(future)
+                    changed_tasks = diff_extracted_file(future, file_key, filename, file_stat)
+                    submit_next_file()
+                    extract_progress.update()
+                    yield from changed_tasks
+
+    def diff_extracted_file(future, file_key, filename, file_stat):
+        """
+        Records the extracted file in the manifest, writes its changed pages and returns its changed chunk tasks.
+        """
+        file_entry = old_files.get(file_key)
+        try:
+            file_hash, extracted = future.result()
+        except Exception as e:
+            print(f"❌ Error processing {filename}: {e}")
+            if file_entry:
+                files[file_key] = file_entry
+            return []
+        if extracted is None:
+            files[file_key] = {**file_entry, "size": file_stat.st_size, "mtime": file_stat.st_mtime}
+            return []
+
+        pages, tasks = extracted
+        changed_pages, page_entries, file_page_tombstones = diff_file_pages(pages, file_entry, manifest)
+        for page in changed_pages:
+            page_writer.write(page)
+        page_tombstones.extend(file_page_tombstones)
+        changed_tasks, chunks, file_tombstones = diff_file_chunks(tasks, file_entry, manifest, page_entries)
+        tombstones.extend(file_tombstones)
+        for _, metadata in changed_tasks:
+            chunk_locations[metadata["id"]] = (file_key, get_chunk_key(metadata))
+        files[file_key] = {
+            "size": file_stat.st_size, "mtime": file_stat.st_mtime, "sha256": file_hash,
+            "pages": page_entries, "chunks": chunks
+        }
+        return changed_tasks
+
+    embedded_ids = set()
+    limiter = AdaptiveConcurrencyLimiter()
+
+    def write_completed(futures, progress):
+        for future in futures:
+            records = future.result()
+            for record in records:
+                writer.write(record)
+                embedded_ids.add(record["id"])
+            progress.update(embed_futures.pop(future))
+
+    with ProcessPoolExecutor(max_workers=PROCESS_WORKERS) as extract_executor, \
+            ThreadPoolExecutor(max_workers=THREAD_WORKERS) as embed_executor, \
+            tqdm(desc="Embedding chunks") as progress:
+        embed_futures = {}
+        for batch in make_token_batches(iter_changed_tasks(extract_executor)):
+            embed_futures[embed_executor.submit(build_chunk_records, batch, limiter)] = len(batch)
+            progress.total = (progress.total or 0) + len(batch)
+            # Write records as batches complete, and stop reading new files while too many batches are pending.
+            # Since no further files are submitted for extraction meanwhile, memory use does not grow with the corpus
+            if len(embed_futures) >= MAX_PENDING_BATCHES:
+                done, _ = wait(embed_futures, return_when=FIRST_COMPLETED)
+                write_completed(done, progress)
+        write_completed(as_completed(list(embed_futures)), progress)
+
+    for file_key, file_entry in old_files.items():
+        if file_key not in files:
+            print(f"🗑️ Removed file: {file_key}")
+            tombstones.extend({"id": chunk["id"], "deleted": True} for chunk in file_entry["chunks"].values())
+            page_tombstones.extend({"id": page["id"], "deleted": True} for page in file_entry.get("pages", {}).values())
+
+    print(f"🔎 {len(chunk_locations)} new or changed chunks, {len(tombstones)} removed chunks")
+
+    for tombstone in tombstones:
+        writer.write(tombstone)
+    for tombstone in page_tombstones:
+        page_writer.write(tombstone)
+
+    # Chunks that failed to embed keep their id but no hash, so they are retried on the next run
+    for chunk_id, (file_key, chunk_key) in chunk_locations.items():
+        if chunk_id not in embedded_ids:
+            files[file_key]["chunks"][chunk_key]["hash"] = None
+
+    manifest.update(chunker_version=CHUNKER_VERSION, embed_model=deployment_name, files=files)
+    return manifest
+
+
+class TrackingWriter:
+    """Passes records on to a seed writer and remembers their ids."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.ids = set()
+
+    def write(self, record):
+        self.ids.add(record["id"])
+        self.writer.write(record)
+
+
+def copy_unreplaced_records(path, writer, replaced_ids):
+    """
+    Copies the records of an earlier output file whose id is not in replaced_ids to the writer.
+    The file may be the one the writer replaces, since seed writers only replace it when they are closed.
+    """
+    if not os.path.exists(path):
+        return
+    for record in read_seed_records(path):
+        if record["id"] not in replaced_ids:
+            writer.write(record)
+
+
+def apply_delta(full_path, delta_path, keep_previous):
+    """
+    Rewrites the full output file from the delta file: new and changed records replace their earlier version
+    and tombstones remove it. Unless keep_previous is false, the records of the previous full output file
+    that the delta does not touch are kept.
+    """
+    delta_ids = set()
+    with SeedWriter(full_path) as writer:
+        for record in read_seed_records(delta_path):
+            delta_ids.add(record["id"])
+            if not record.get("deleted"):
+                writer.write(record)
+        if keep_previous:
+            copy_unreplaced_records(full_path, writer, delta_ids)
+    return writer.count
+
+
+def main():
+    # Convert other documents first, so that the converted PDFs are picked up below.
+    # This runs here and not at import time, since the extraction worker processes import this module.
+    process_directories(PDF_DIRS)
+
+    # Without a manifest every chunk is exported again with new ids, so earlier output files are not reused
+    incremental = os.path.exists(MANIFEST_FILE)
+    if incremental and not (os.path.exists(OUTPUT_FILE) and os.path.exists(PAGES_OUTPUT_FILE)):
+        raise SystemExit(
+            f"❌ {OUTPUT_FILE} or {PAGES_OUTPUT_FILE} is missing, so the full export cannot be updated. "
+            f"Delete {MANIFEST_FILE} to export every chunk again."
+        )
+
+    print(f"📁 Reading PDFs from {PDF_DIRS}")
+    with SeedWriter(DELTA_OUTPUT_FILE) as delta_writer, SeedWriter(DELTA_PAGES_OUTPUT_FILE) as page_delta_writer:
+        writer, page_writer = TrackingWriter(delta_writer), TrackingWriter(page_delta_writer)
+        manifest = process_all_pdfs(writer, page_writer)
+        if incremental:
+            # Keep the changes of earlier runs that were not loaded yet, unless this run replaced them
+            copy_unreplaced_records(DELTA_OUTPUT_FILE, delta_writer, writer.ids)
+            copy_unreplaced_records(DELTA_PAGES_OUTPUT_FILE, page_delta_writer, page_writer.ids)
+    record_count = apply_delta(OUTPUT_FILE, DELTA_OUTPUT_FILE, incremental)
+    page_count = apply_delta(PAGES_OUTPUT_FILE, DELTA_PAGES_OUTPUT_FILE, incremental)
+    # Only record the run in the manifest once its records are safely written
+    save_manifest(manifest)
+
+    print(
+        f"✅ {delta_writer.count} records written to {DELTA_OUTPUT_FILE}, "
+        f"{page_delta_writer.count} pages written to {DELTA_PAGES_OUTPUT_FILE}"
+    )
+    print(f"✅ {record_count} records in {OUTPUT_FILE}, {page_count} pages in {PAGES_OUTPUT_FILE}")
 
 if __name__ == "__main__":
     main()
@@ -2,7 +2,7 @@ import logging
 import os
 from collections.abc import AsyncIterator
 from contextlib import asynccontextmanager
-from typing import TypedDict, Union
+from typing import Optional, TypedDict, Union
 
 import fastapi
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -12,23 +12,41 @@ from opentelemetry.instrumentation.openai import OpenAIInstrumentor
 from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
+from fastapi_app.answer_cache import AnswerCache, create_answer_cache_from_env
 from fastapi_app.dependencies import (
     FastAPIAppContext,
+    ReadReplicaRouter,
     common_parameters,
     create_async_sessionmaker,
+    create_read_replica_router,
     get_azure_credential,
 )
+from fastapi_app.embedding_cache import EmbeddingCache, create_embedding_cache_from_env
+from fastapi_app.embedding_settings import create_embedding_settings_watcher_from_env
+from fastapi_app.embeddings import EmbeddingBatcher, create_embedding_batcher_from_env
 from fastapi_app.openai_clients import create_openai_chat_client, create_openai_embed_client
-from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.postgres_engine import (
+    create_postgres_engine_from_env,
+    create_postgres_replica_engines_from_env,
+    register_pool_metrics,
+)
+from fastapi_app.rag_flow_factory import RAGFlowFactory
+from fastapi_app.request_coalescing import RequestCoalescer, create_request_coalescer_from_env
 
 logger = logging.getLogger("ragapp")
 
 
 class State(TypedDict):
     sessionmaker: async_sessionmaker[AsyncSession]
+    read_router: Optional[ReadReplicaRouter]
     context: FastAPIAppContext
     chat_client: Union[AsyncOpenAI, AsyncAzureOpenAI]
     embed_client: Union[AsyncOpenAI, AsyncAzureOpenAI]
+    embed_cache: Optional[EmbeddingCache]
+    embed_batcher: Optional[EmbeddingBatcher]
+    answer_cache: Optional[AnswerCache]
+    rag_flow_factory: RAGFlowFactory
+    request_coalescer: Optional[RequestCoalescer]
 
 
 @asynccontextmanager
@@ -43,11 +61,48 @@ async def lifespan(app: fastapi.FastAPI) -> AsyncIterator[State]:
         azure_credential = await get_azure_credential()
     engine = await create_postgres_engine_from_env(azure_credential)
     sessionmaker = await create_async_sessionmaker(engine)
+    replica_engines = await create_postgres_replica_engines_from_env(azure_credential)
+    read_router = await create_read_replica_router(sessionmaker, replica_engines)
+    if read_router is not None:
+        await read_router.start()
     chat_client = await create_openai_chat_client(azure_credential)
     embed_client = await create_openai_embed_client(azure_credential)
+    embed_cache = await create_embedding_cache_from_env(sessionmaker)
+    embed_batcher = await create_embedding_batcher_from_env()
+    answer_cache = await create_answer_cache_from_env(sessionmaker)
+    rag_flow_factory = RAGFlowFactory(
+        chat_client,
+        context.openai_chat_model,
+        context.openai_chat_deployment,
+        input_token_budget=context.chat_input_token_budget,
+        history_verbatim_turns=context.chat_history_verbatim_turns,
+    )
+    request_coalescer = await create_request_coalescer_from_env()
+    # Picks up embedding column cutovers, see migrate_embeddings.py
+    embedding_settings_watcher = await create_embedding_settings_watcher_from_env(sessionmaker, context)
+    if embedding_settings_watcher is not None:
+        await embedding_settings_watcher.start()
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
         SQLAlchemyInstrumentor().instrument(engine=engine.sync_engine)
-    yield {"sessionmaker": sessionmaker, "context": context, "chat_client": chat_client, "embed_client": embed_client}
+        register_pool_metrics({"primary": engine, **replica_engines})
+    yield {
+        "sessionmaker": sessionmaker,
+        "read_router": read_router,
+        "context": context,
+        "chat_client": chat_client,
+        "embed_client": embed_client,
+        "embed_cache": embed_cache,
+        "embed_batcher": embed_batcher,
+        "answer_cache": answer_cache,
+        "rag_flow_factory": rag_flow_factory,
+        "request_coalescer": request_coalescer,
+    }
+    if embedding_settings_watcher is not None:
+        await embedding_settings_watcher.stop()
+    if read_router is not None:
+        await read_router.stop()
+    for replica_engine in replica_engines.values():
+        await replica_engine.dispose()
     await engine.dispose()
 
 
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from collections.abc import AsyncGenerator
+from typing import Any, Optional
+
+import numpy as np
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from fastapi_app.api_models import (
+    AIChatRoles,
+    ChatParams,
+    HNSWSearchSettings,
+    Message,
+    RetrievalResponse,
+    RetrievalResponseDelta,
+    ThoughtStep,
+)
+from fastapi_app.postgres_models import AnswerCacheEntry
+
+logger = logging.getLogger("ragapp")
+
+
+class AnswerCacheHit(BaseModel):
+    """
+    A cached answer for a query similar to the current one
+    """
+
+    query: str
+    similarity: float
+    response: RetrievalResponse
+
+    def cache_thought(self) -> ThoughtStep:
+        return ThoughtStep(
+            title="Answer served from cache",
+            description=self.query,
+            props={"similarity": round(self.similarity, 4)},
+        )
+
+    def to_response(self, session_state: Any = None) -> RetrievalResponse:
+        """The cached answer, with the sessionState of the request it is served to"""
+        response = self.response.model_copy(deep=True, update={"sessionState": session_state})
+        response.context.thoughts.append(self.cache_thought())
+        return response
+
+    async def to_stream(self, session_state: Any = None) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        """Replay the cached answer in the same shape as a streamed answer: context first, then content deltas."""
+        response = self.to_response(session_state)
+        yield RetrievalResponseDelta(context=response.context, sessionState=response.sessionState)
+        for delta in re.findall(r"\S+\s*|\s+", response.message.content):
+            yield RetrievalResponseDelta(delta=Message(content=delta, role=AIChatRoles.ASSISTANT))
+
+
+class AnswerCache:
+    """
+    Semantic cache of chat answers, looked up by cosine similarity of the query embedding
+    among entries generated with the same answer parameters.
+    Entries expire after ttl_seconds and are deleted by a trigger whenever the items table changes.
+    """
+
+    def __init__(
+        self,
+        sessionmaker: async_sessionmaker[AsyncSession],
+        similarity_threshold: float = 0.97,
+        ttl_seconds: float = 86400,
+    ):
+        self.sessionmaker = sessionmaker
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.embedding_dimensions = AnswerCacheEntry.query_embedding.type.dim
+
+    @staticmethod
+    def is_cacheable(chat_params: ChatParams) -> bool:
+        """Answers that depend on earlier messages in the conversation are never cached."""
+        return not chat_params.past_messages
+
+    @staticmethod
+    def make_params_key(
+        chat_params: ChatParams,
+        *,
+        chat_model: str,
+        embedding_column: str,
+        hybrid_search_mode: str,
+        hnsw_settings: HNSWSearchSettings,
+        vector_index_mode: str,
+        binary_rerank_candidates: int,
+    ) -> str:
+        """
+        Build the key for all parameters that, besides the query, determine the answer.
+        The HNSW settings are the ones the search applies, after the server defaults and any adjustments.
+        """
+        params = chat_params.model_dump(
+            mode="json",
+            include={
+                "retrieval_mode",
+                "top",
+                "temperature",
+                "seed",
+                "prompt_template",
+                "use_advanced_flow",
+                "skip_single_turn_rewrite",
+                "input_token_budget",
+                "response_token_limit",
+                "expand_top_pages",
+            },
+        )
+        params.update(
+            chat_model=chat_model,
+            embedding_column=embedding_column,
+            hybrid_search_mode=hybrid_search_mode,
+            hnsw_settings=hnsw_settings.to_config(),
+            vector_index_mode=vector_index_mode,
+            binary_rerank_candidates=binary_rerank_candidates,
+        )
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    async def lookup(self, query_vector: list[float], params_key: str) -> Optional[AnswerCacheHit]:
+        if len(query_vector) != self.embedding_dimensions:
+            return None
+        try:
+            async with self.sessionmaker() as session:
+                row = (
+                    await session.execute(
+                        text(
+                            f"SELECT query, response::text AS response, query_embedding <=> :embedding AS distance "
+                            f"FROM {AnswerCacheEntry.__tablename__} "
+                            "WHERE params_key = :params_key AND created_at > now() - make_interval(secs => :ttl) "
+                            "ORDER BY query_embedding <=> :embedding LIMIT 1"
+                        ),
+                        {"embedding": np.array(query_vector), "params_key": params_key, "ttl": self.ttl_seconds},
+                    )
+                ).first()
+        except Exception as e:
+            logger.warning("Answer cache lookup failed: %s", e)
+            return None
+        if row is None or 1 - row.distance < self.similarity_threshold:
+            return None
+        return AnswerCacheHit(
+            query=row.query,
+            similarity=1 - row.distance,
+            response=RetrievalResponse.model_validate_json(row.response),
+        )
+
+    async def store(self, query: str, query_vector: list[float], params_key: str, response: RetrievalResponse):
+        if len(query_vector) != self.embedding_dimensions:
+            return
+        try:
+            async with self.sessionmaker() as session:
+                await session.execute(
+                    text(
+                        f"INSERT INTO {AnswerCacheEntry.__tablename__} "
+                        "(params_key, query, query_embedding, response) "
+                        "VALUES (:params_key, :query, :embedding, CAST(:response AS JSONB))"
+                    ),
+                    {
+                        "params_key": params_key,
+                        "query": query,
+                        "embedding": np.array(query_vector),
+                        # The sessionState belongs to the client that asked, so it is never shared
+                        "response": response.model_dump_json(exclude={"sessionState"}),
+                    },
+                )
+                await session.commit()
+        except Exception as e:
+            logger.warning("Answer cache update failed: %s", e)
+
+    async def store_stream(
+        self,
+        query: str,
+        query_vector: list[float],
+        params_key: str,
+        stream: AsyncGenerator[RetrievalResponseDelta, None],
+    ) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        """Pass a streamed answer through, then cache the complete answer once the stream has finished."""
+        context = None
+        content = []
+        async for event in stream:
+            if event.context is not None:
+                context = event.context
+            if event.delta is not None:
+                content.append(event.delta.content)
+            yield event
+        if context is not None:
+            response = RetrievalResponse(
+                message=Message(content="".join(content), role=AIChatRoles.ASSISTANT), context=context
+            )
+            await self.store(query, query_vector, params_key, response)
+
+
+async def create_answer_cache_from_env(
+    sessionmaker: async_sessionmaker[AsyncSession],
+) -> Optional[AnswerCache]:
+    """
+    Create the semantic answer cache from environment variables.
+    The cache is only enabled when ANSWER_CACHE_ENABLED is "true".
+    """
+    if (os.getenv("ANSWER_CACHE_ENABLED") or "false").lower() != "true":
+        return None
+    similarity_threshold = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD") or 0.97)
+    ttl_seconds = float(os.getenv("ANSWER_CACHE_TTL_SECONDS") or 86400)
+    logger.info("Answer cache enabled with similarity threshold %s", similarity_threshold)
+    return AnswerCache(sessionmaker, similarity_threshold=similarity_threshold, ttl_seconds=ttl_seconds)
@@ -22,6 +22,31 @@ class RetrievalMode(str, Enum):
     HYBRID = "hybrid"
 
 
+class HNSWIterativeScan(str, Enum):
+    OFF = "off"
+    RELAXED_ORDER = "relaxed_order"
+    STRICT_ORDER = "strict_order"
+
+
+class HNSWSearchSettings(BaseModel):
+    """
+    pgvector HNSW query settings, applied with SET LOCAL semantics to the search transaction.
+    Unset values keep the server defaults.
+    """
+
+    ef_search: Optional[int] = Field(default=None, gt=0)
+    iterative_scan: Optional[HNSWIterativeScan] = None
+    max_scan_tuples: Optional[int] = Field(default=None, gt=0)
+
+    def to_config(self) -> dict[str, str]:
+        config = {
+            "hnsw.ef_search": self.ef_search,
+            "hnsw.iterative_scan": self.iterative_scan.value if self.iterative_scan else None,
+            "hnsw.max_scan_tuples": self.max_scan_tuples,
+        }
+        return {name: str(value) for name, value in config.items() if value is not None}
+
+
 class ChatRequestOverrides(BaseModel):
     top: int = 3
     temperature: float = 0.3
@@ -29,6 +54,14 @@ class ChatRequestOverrides(BaseModel):
     use_advanced_flow: bool = True
     prompt_template: Optional[str] = None
     seed: Optional[int] = None
+    speculative_retrieval: bool = False
+    # Search with the user query as is when it is a short, single-turn question that needs no rewrite
+    skip_single_turn_rewrite: bool = True
+    hnsw_ef_search: Optional[int] = Field(default=None, gt=0)
+    hnsw_iterative_scan: Optional[HNSWIterativeScan] = None
+    hnsw_max_scan_tuples: Optional[int] = Field(default=None, gt=0)
+    # Number of top results whose whole page is sent to the model instead of just the matching chunk
+    expand_top_pages: int = Field(default=0, ge=0)
 
 
 class ChatRequestContext(BaseModel):
@@ -49,6 +82,7 @@ class ItemPublic(BaseModel):
     chunk: int
     content: str
     typedoc: str
+    page_id: Optional[int] = None
 
     def to_str_for_rag(self):
         return (
@@ -107,6 +141,7 @@ class RetrievalResponseDelta(BaseModel):
 class ChatParams(ChatRequestOverrides):
     prompt_template: str
     response_token_limit: int = 1024
+    input_token_budget: int = 6000
     enable_text_search: bool
     enable_vector_search: bool
     original_user_query: str
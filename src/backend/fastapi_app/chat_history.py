@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+from collections.abc import Sequence
+from typing import Any, Optional
+
+from openai.types.responses import ResponseInputItemParam
+from pydantic import BaseModel, ValidationError
+
+from fastapi_app.context_builder import get_message_text
+
+logger = logging.getLogger("ragapp")
+
+# Key of the rolling summary in the sessionState that the client sends back with the next request
+HISTORY_SUMMARY_KEY = "history_summary"
+
+DEFAULT_VERBATIM_TURNS = 3
+
+
+class HistorySummary(BaseModel):
+    """
+    Summary of the first message_count past messages of a chat session
+    """
+
+    summary: str
+    message_count: int
+    # Detects a client that edited or cleared the conversation since the summary was made
+    messages_hash: str
+
+
+def hash_messages(messages: Sequence[ResponseInputItemParam]) -> str:
+    serialized = json.dumps([[message.get("role"), get_message_text(message)] for message in messages])
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def format_messages_for_summary(previous_summary: Optional[str], messages: Sequence[ResponseInputItemParam]) -> str:
+    lines = [f"Summary of the conversation so far:\n{previous_summary}\n"] if previous_summary else []
+    lines.append("Messages:")
+    lines += [f"{message.get('role')}: {get_message_text(message)}" for message in messages]
+    return "\n".join(lines)
+
+
+class ChatHistory:
+    """
+    The past messages of a chat session, where the turns before the last verbatim_turns
+    are replaced with the rolling summary from the sessionState, when it covers them.
+    Turns that are neither summarized nor among the last verbatim_turns are kept verbatim,
+    until the summary that is made alongside the answer catches up with them.
+    Set verbatim_turns to 0 to always keep all turns verbatim.
+    """
+
+    def __init__(
+        self,
+        past_messages: list[ResponseInputItemParam],
+        session_state: Any = None,
+        verbatim_turns: int = DEFAULT_VERBATIM_TURNS,
+    ):
+        self.past_messages = past_messages
+        self.session_state = session_state
+        self.verbatim_turns = verbatim_turns
+        self.summary = self.get_valid_summary()
+
+    def get_valid_summary(self) -> Optional[HistorySummary]:
+        if self.verbatim_turns <= 0 or not isinstance(self.session_state, dict):
+            return None
+        if self.session_state.get(HISTORY_SUMMARY_KEY) is None:
+            return None
+        try:
+            summary = HistorySummary.model_validate(self.session_state[HISTORY_SUMMARY_KEY])
+        except ValidationError as e:
+            logger.warning("Ignoring invalid history summary in session state: %s", e)
+            return None
+        if not 0 < summary.message_count <= len(self.past_messages):
+            return None
+        if hash_messages(self.past_messages[: summary.message_count]) != summary.messages_hash:
+            return None
+        return summary
+
+    def get_messages(self) -> list[ResponseInputItemParam]:
+        if self.summary is None:
+            return self.past_messages
+        summary_message: ResponseInputItemParam = {
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{self.summary.summary}",
+        }
+        return [summary_message] + self.past_messages[self.summary.message_count :]
+
+    def get_messages_to_summarize(self) -> list[ResponseInputItemParam]:
+        """
+        The messages that fall out of the verbatim window with the next request,
+        which adds this request's question and answer, and that the summary does not cover yet.
+        """
+        if self.verbatim_turns <= 0:
+            return []
+        next_message_count = max(len(self.past_messages) + 2 - 2 * self.verbatim_turns, 0)
+        summarized_count = self.summary.message_count if self.summary else 0
+        return self.past_messages[summarized_count:next_message_count]
+
+    def update_session_state(self, summary: str, messages: Sequence[ResponseInputItemParam]) -> Any:
+        """The sessionState for the response, with a summary of the previous summary and the given messages"""
+        message_count = (self.summary.message_count if self.summary else 0) + len(messages)
+        history_summary = HistorySummary(
+            summary=summary,
+            message_count=message_count,
+            messages_hash=hash_messages(self.past_messages[:message_count]),
+        )
+        session_state = dict(self.session_state) if isinstance(self.session_state, dict) else {}
+        session_state[HISTORY_SUMMARY_KEY] = history_summary.model_dump()
+        return session_state
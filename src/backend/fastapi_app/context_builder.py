@@ -0,0 +1,134 @@
+import functools
+import logging
+import math
+from collections.abc import Sequence
+from typing import Optional
+
+import tiktoken
+from openai.types.responses import ResponseInputItemParam
+
+from fastapi_app.api_models import ItemPublic
+
+logger = logging.getLogger("ragapp")
+
+# Encoding for models that tiktoken does not know, such as Ollama models
+DEFAULT_ENCODING = "o200k_base"
+
+# Tokens that the chat format adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+DEFAULT_INPUT_TOKEN_BUDGET = 6000
+
+# Share of the budget that the conversation history may use, the rest is for the sources
+DEFAULT_HISTORY_SHARE = 0.25
+
+
+@functools.lru_cache
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    Get the tiktoken encoding for a chat model, loading it once per process.
+    Returns None if the encoding cannot be loaded, e.g. without network access to download it.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning("Could not load a tokenizer for %s, estimating token counts from text length: %s", model, e)
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        # About four characters per token for English text
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[: max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def get_message_text(message: ResponseInputItemParam) -> str:
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(str(part.get("text", "")) for part in content if isinstance(part, dict))
+    return ""
+
+
+class ContextBuilder:
+    """
+    Fits the conversation history and the search results into the input token budget of the answer prompt.
+    The oldest messages and the lowest-ranked sources are dropped first,
+    and sources from the same file share a single header.
+    """
+
+    def __init__(self, model: str, history_share: float = DEFAULT_HISTORY_SHARE):
+        self.model = model
+        self.history_share = history_share
+
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def count_message_tokens(self, messages: Sequence[ResponseInputItemParam]) -> int:
+        return sum(self.count_tokens(get_message_text(message)) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+    def fit_history(
+        self, messages: Sequence[ResponseInputItemParam], token_budget: int
+    ) -> list[ResponseInputItemParam]:
+        """Keep the most recent messages that fit into the budget."""
+        kept: list[ResponseInputItemParam] = []
+        used_tokens = 0
+        for message in reversed(messages):
+            used_tokens += self.count_message_tokens([message])
+            if used_tokens > token_budget:
+                break
+            kept.append(message)
+        return kept[::-1]
+
+    def format_sources(self, items: Sequence[ItemPublic], token_budget: Optional[int] = None) -> tuple[str, list[int]]:
+        """
+        Format the items in rank order until the budget is used up, grouped under one header per file.
+        Items whose text is already included from the same file and page are skipped.
+        If not even the top item fits, its content is truncated to the budget.
+        Returns the sources text and the ids of the included items.
+        """
+        groups: dict[str, list[str]] = {}
+        included: dict[tuple[str, int], list[str]] = {}
+        item_ids: list[int] = []
+        used_tokens = 0
+        for item in items:
+            content = item.content.strip()
+            page_key = (item.filename, item.pagenumber)
+            if any(content in text for text in included.get(page_key, [])):
+                continue
+            header = f"File: {item.filename} | Type: {item.typedoc} | URL: {item.fileurl}"
+            header_tokens = 0 if header in groups else self.count_tokens(header) + 1
+            line_prefix = f"[{item.id}] Page {item.pagenumber}: "
+            tokens = header_tokens + self.count_tokens(line_prefix + content) + 1
+            if token_budget is not None and used_tokens + tokens > token_budget:
+                if item_ids:
+                    break
+                remaining_tokens = token_budget - header_tokens - self.count_tokens(line_prefix) - 1
+                content = truncate_to_tokens(content, remaining_tokens, self.model)
+                if not content:
+                    break
+            groups.setdefault(header, []).append(line_prefix + content)
+            included.setdefault(page_key, []).append(content)
+            item_ids.append(item.id)
+            used_tokens += tokens
+        if len(item_ids) < len(items):
+            logger.debug("Included %d of %d sources in the prompt", len(item_ids), len(items))
+        return "\n\n".join("\n".join([header, *lines]) for header, lines in groups.items()), item_ids
@@ -1,3 +1,5 @@
+import asyncio
+import itertools
 import logging
 import os
 from collections.abc import AsyncGenerator
@@ -7,8 +9,19 @@ import azure.identity
 from fastapi import Depends, Request
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 from pydantic import BaseModel
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
 
+from fastapi_app.answer_cache import AnswerCache
+from fastapi_app.api_models import ChatRequestOverrides, HNSWIterativeScan, HNSWSearchSettings
+from fastapi_app.chat_history import DEFAULT_VERBATIM_TURNS
+from fastapi_app.context_builder import DEFAULT_INPUT_TOKEN_BUDGET
+from fastapi_app.embedding_cache import EmbeddingCache
+from fastapi_app.embeddings import EmbeddingBatcher
+from fastapi_app.postgres_models import VECTOR_INDEX_MODES
+from fastapi_app.rag_flow_factory import RAGFlowFactory
+from fastapi_app.request_coalescing import RequestCoalescer
+
 logger = logging.getLogger("ragapp")
 
 
@@ -32,6 +45,22 @@ class FastAPIAppContext(BaseModel):
     openai_chat_deployment: Optional[str]
     openai_embed_deployment: Optional[str]
     embedding_column: str
+    hybrid_search_mode: str = "single_statement"
+    hnsw_search_settings: HNSWSearchSettings = HNSWSearchSettings()
+    vector_index_mode: str = "vector"
+    binary_rerank_candidates: int = 200
+    chat_input_token_budget: int = DEFAULT_INPUT_TOKEN_BUDGET
+    chat_history_verbatim_turns: int = DEFAULT_VERBATIM_TURNS
+
+    def get_hnsw_search_settings(self, overrides: Optional[ChatRequestOverrides] = None) -> HNSWSearchSettings:
+        """Combine the server defaults for HNSW searches with any per-request overrides"""
+        if overrides is None:
+            return self.hnsw_search_settings
+        return HNSWSearchSettings(
+            ef_search=overrides.hnsw_ef_search or self.hnsw_search_settings.ef_search,
+            iterative_scan=overrides.hnsw_iterative_scan or self.hnsw_search_settings.iterative_scan,
+            max_scan_tuples=overrides.hnsw_max_scan_tuples or self.hnsw_search_settings.max_scan_tuples,
+        )
 
 
 async def common_parameters():
@@ -74,6 +103,23 @@ async def common_parameters():
     else:
         openai_chat_deployment = None
         openai_chat_model = os.getenv("OPENAICOM_CHAT_MODEL") or "gpt-3.5-turbo"
+    hybrid_search_mode = os.getenv("POSTGRES_HYBRID_SEARCH_MODE") or "single_statement"
+    if hybrid_search_mode not in ("single_statement", "concurrent"):
+        raise ValueError(f"Unsupported POSTGRES_HYBRID_SEARCH_MODE: {hybrid_search_mode}")
+    hnsw_ef_search = os.getenv("POSTGRES_HNSW_EF_SEARCH")
+    hnsw_iterative_scan = os.getenv("POSTGRES_HNSW_ITERATIVE_SCAN")
+    hnsw_max_scan_tuples = os.getenv("POSTGRES_HNSW_MAX_SCAN_TUPLES")
+    hnsw_search_settings = HNSWSearchSettings(
+        ef_search=int(hnsw_ef_search) if hnsw_ef_search else None,
+        iterative_scan=HNSWIterativeScan(hnsw_iterative_scan) if hnsw_iterative_scan else None,
+        max_scan_tuples=int(hnsw_max_scan_tuples) if hnsw_max_scan_tuples else None,
+    )
+    vector_index_mode = os.getenv("POSTGRES_VECTOR_INDEX_MODE") or "vector"
+    if vector_index_mode not in VECTOR_INDEX_MODES:
+        raise ValueError(f"Unsupported POSTGRES_VECTOR_INDEX_MODE: {vector_index_mode}")
+    binary_rerank_candidates = int(os.getenv("POSTGRES_BINARY_RERANK_CANDIDATES") or 200)
+    chat_input_token_budget = int(os.getenv("CHAT_INPUT_TOKEN_BUDGET") or DEFAULT_INPUT_TOKEN_BUDGET)
+    chat_history_verbatim_turns = int(os.getenv("CHAT_HISTORY_VERBATIM_TURNS") or DEFAULT_VERBATIM_TURNS)
     return FastAPIAppContext(
         openai_chat_model=openai_chat_model,
         openai_embed_model=openai_embed_model,
@@ -81,6 +127,12 @@ async def common_parameters():
         openai_chat_deployment=openai_chat_deployment,
         openai_embed_deployment=openai_embed_deployment,
         embedding_column=embedding_column,
+        hybrid_search_mode=hybrid_search_mode,
+        hnsw_search_settings=hnsw_search_settings,
+        vector_index_mode=vector_index_mode,
+        binary_rerank_candidates=binary_rerank_candidates,
+        chat_input_token_budget=chat_input_token_budget,
+        chat_history_verbatim_turns=chat_history_verbatim_turns,
     )
 
 
@@ -119,12 +171,100 @@ async def create_async_sessionmaker(engine: AsyncEngine) -> async_sessionmaker[A
     )
 
 
+class ReadReplicaRouter:
+    """
+    Hands out sessionmakers for read-only queries, taking turns between the read replicas that passed
+    their last health check, and falling back to the primary when none did.
+    """
+
+    def __init__(
+        self,
+        primary: async_sessionmaker[AsyncSession],
+        replicas: dict[str, async_sessionmaker[AsyncSession]],
+        health_check_seconds: float = 10,
+        health_check_timeout: float = 2,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.health_check_seconds = health_check_seconds
+        self.health_check_timeout = health_check_timeout
+        self.healthy = dict.fromkeys(replicas, True)
+        self._counter = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+
+    def get_sessionmaker(self) -> async_sessionmaker[AsyncSession]:
+        healthy_replicas = [name for name, healthy in self.healthy.items() if healthy]
+        if not healthy_replicas:
+            return self.primary
+        return self.replicas[healthy_replicas[next(self._counter) % len(healthy_replicas)]]
+
+    async def check_replica(self, name: str) -> bool:
+        try:
+            async with self.replicas[name]() as session:
+                await asyncio.wait_for(session.execute(text("SELECT 1")), self.health_check_timeout)
+            return True
+        except Exception as e:
+            logger.warning("Health check of read replica %s failed: %s", name, e)
+            return False
+
+    async def check_health(self) -> None:
+        results = await asyncio.gather(*(self.check_replica(name) for name in self.replicas))
+        for name, healthy in zip(self.replicas, results):
+            if healthy != self.healthy[name]:
+                logger.info("Read replica %s is %s", name, "healthy again" if healthy else "unhealthy, not using it")
+            self.healthy[name] = healthy
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_seconds)
+            await self.check_health()
+
+    async def start(self) -> None:
+        """Check the replicas before serving requests, then keep checking them in the background."""
+        await self.check_health()
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+async def create_read_replica_router(
+    primary: async_sessionmaker[AsyncSession], replica_engines: dict[str, AsyncEngine]
+) -> Optional[ReadReplicaRouter]:
+    """
+    Create the router for read-only sessions, if there are read replicas.
+    Replicas are checked every POSTGRES_READ_REPLICA_HEALTH_CHECK_SECONDS.
+    """
+    if not replica_engines:
+        return None
+    logger.info("Routing read-only queries to read replicas: %s", ", ".join(replica_engines))
+    return ReadReplicaRouter(
+        primary,
+        {name: await create_async_sessionmaker(engine) for name, engine in replica_engines.items()},
+        health_check_seconds=float(os.getenv("POSTGRES_READ_REPLICA_HEALTH_CHECK_SECONDS") or 10),
+    )
+
+
 async def get_async_sessionmaker(
     request: Request,
 ) -> AsyncGenerator[async_sessionmaker[AsyncSession], None]:
     yield request.state.sessionmaker
 
 
+async def get_read_only_sessionmaker(
+    request: Request,
+) -> AsyncGenerator[async_sessionmaker[AsyncSession], None]:
+    """Get a sessionmaker for read-only queries, which may connect to a read replica"""
+    read_router: Optional[ReadReplicaRouter] = request.state.read_router
+    yield read_router.get_sessionmaker() if read_router is not None else request.state.sessionmaker
+
+
 async def get_context(
     request: Request,
 ) -> FastAPIAppContext:
@@ -138,6 +278,13 @@ async def get_async_db_session(
         yield session
 
 
+async def get_read_only_db_session(
+    sessionmaker: Annotated[async_sessionmaker[AsyncSession], Depends(get_read_only_sessionmaker)],
+) -> AsyncGenerator[AsyncSession, None]:
+    async with sessionmaker() as session:
+        yield session
+
+
 async def get_openai_chat_client(
     request: Request,
 ) -> OpenAIClient:
@@ -152,7 +299,50 @@ async def get_openai_embed_client(
     return OpenAIClient(client=request.state.embed_client)
 
 
+async def get_embedding_cache(
+    request: Request,
+) -> Optional[EmbeddingCache]:
+    """Get the query embedding cache, if enabled"""
+    return request.state.embed_cache
+
+
+async def get_embedding_batcher(
+    request: Request,
+) -> Optional[EmbeddingBatcher]:
+    """Get the embedding request batcher, if enabled"""
+    return request.state.embed_batcher
+
+
+async def get_rag_flow_factory(
+    request: Request,
+) -> RAGFlowFactory:
+    """Get the factory of the RAG flows, which shares their agents across requests"""
+    return request.state.rag_flow_factory
+
+
+async def get_request_coalescer(
+    request: Request,
+) -> Optional[RequestCoalescer]:
+    """Get the coalescer of identical chat requests, if enabled"""
+    return request.state.request_coalescer
+
+
+async def get_answer_cache(
+    request: Request,
+) -> Optional[AnswerCache]:
+    """Get the semantic answer cache, if enabled"""
+    return request.state.answer_cache
+
+
 CommonDeps = Annotated[FastAPIAppContext, Depends(get_context)]
+DBSessionMaker = Annotated[async_sessionmaker[AsyncSession], Depends(get_async_sessionmaker)]
 DBSession = Annotated[AsyncSession, Depends(get_async_db_session)]
+ReadOnlyDBSessionMaker = Annotated[async_sessionmaker[AsyncSession], Depends(get_read_only_sessionmaker)]
+ReadOnlyDBSession = Annotated[AsyncSession, Depends(get_read_only_db_session)]
 ChatClient = Annotated[OpenAIClient, Depends(get_openai_chat_client)]
 EmbeddingsClient = Annotated[OpenAIClient, Depends(get_openai_embed_client)]
+EmbeddingsCache = Annotated[Optional[EmbeddingCache], Depends(get_embedding_cache)]
+EmbeddingsBatcher = Annotated[Optional[EmbeddingBatcher], Depends(get_embedding_batcher)]
+AnswersCache = Annotated[Optional[AnswerCache], Depends(get_answer_cache)]
+RAGFlows = Annotated[RAGFlowFactory, Depends(get_rag_flow_factory)]
+RequestCoalescing = Annotated[Optional[RequestCoalescer], Depends(get_request_coalescer)]
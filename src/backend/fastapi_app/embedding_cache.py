@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from fastapi_app.postgres_models import EmbeddingCacheEntry
+
+logger = logging.getLogger("ragapp")
+
+
+class EmbeddingCacheStats(BaseModel):
+    """
+    Counters for an embedding cache
+    """
+
+    hits: int = 0
+    misses: int = 0
+    store_hits: int = 0
+    evictions: int = 0
+    size: int = 0
+
+
+class EmbeddingStore(ABC):
+    """Shared backing store for embeddings, consulted on in-process cache misses."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[list[float]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set(self, key: str, embedding: list[float]) -> None:
+        raise NotImplementedError
+
+
+class PostgresEmbeddingStore(EmbeddingStore):
+    """
+    Stores embeddings in an UNLOGGED table so that all app workers share cache hits.
+    Expired rows are deleted while storing, at most once per cleanup interval and worker.
+    """
+
+    def __init__(
+        self,
+        sessionmaker: async_sessionmaker[AsyncSession],
+        ttl_seconds: float,
+        cleanup_interval_seconds: float = 3600,
+    ):
+        self.sessionmaker = sessionmaker
+        self.ttl_seconds = ttl_seconds
+        self.cleanup_interval_seconds = cleanup_interval_seconds
+        self._next_cleanup = 0.0
+
+    async def get(self, key: str) -> Optional[list[float]]:
+        async with self.sessionmaker() as session:
+            embedding = (
+                await session.execute(
+                    text(
+                        f"SELECT embedding FROM {EmbeddingCacheEntry.__tablename__} "
+                        "WHERE key = :key AND created_at > now() - make_interval(secs => :ttl)"
+                    ),
+                    {"key": key, "ttl": self.ttl_seconds},
+                )
+            ).scalar()
+        return list(embedding) if embedding is not None else None
+
+    async def set(self, key: str, embedding: list[float]) -> None:
+        async with self.sessionmaker() as session:
+            await session.execute(
+                text(
+                    f"INSERT INTO {EmbeddingCacheEntry.__tablename__} (key, embedding) VALUES (:key, :embedding) "
+                    "ON CONFLICT (key) DO UPDATE SET embedding = excluded.embedding, created_at = now()"
+                ),
+                {"key": key, "embedding": embedding},
+            )
+            if time.monotonic() >= self._next_cleanup:
+                self._next_cleanup = time.monotonic() + self.cleanup_interval_seconds
+                await session.execute(
+                    text(
+                        f"DELETE FROM {EmbeddingCacheEntry.__tablename__} "
+                        "WHERE created_at <= now() - make_interval(secs => :ttl)"
+                    ),
+                    {"ttl": self.ttl_seconds},
+                )
+            await session.commit()
+
+
+class EmbeddingCache:
+    """
+    In-process LRU cache of query embeddings with a time-to-live,
+    optionally backed by a shared EmbeddingStore.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl_seconds: float = 86400, store: Optional[EmbeddingStore] = None):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self._entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._stats = EmbeddingCacheStats()
+
+    @staticmethod
+    def make_key(
+        q: str,
+        embed_model: str,
+        embed_deployment: Optional[str] = None,
+        embedding_dimensions: Optional[int] = None,
+    ) -> str:
+        """
+        Build a cache key for a query.
+        The text is normalized (Unicode NFKC, collapsed whitespace, case-folded)
+        so that trivially different spellings of the same question share an entry.
+        """
+        normalized = " ".join(unicodedata.normalize("NFKC", q).split()).casefold()
+        key = json.dumps([embed_model, embed_deployment, embedding_dimensions, normalized])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    @property
+    def stats(self) -> EmbeddingCacheStats:
+        return self._stats.model_copy(update={"size": len(self._entries)})
+
+    def _get_local(self, key: str) -> Optional[list[float]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, embedding = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return embedding
+
+    def _set_local(self, key: str, embedding: list[float]) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._stats.evictions += 1
+
+    async def get(self, key: str) -> Optional[list[float]]:
+        if (embedding := self._get_local(key)) is not None:
+            self._stats.hits += 1
+            return embedding
+        if self.store is not None:
+            try:
+                embedding = await self.store.get(key)
+            except Exception as e:
+                logger.warning("Embedding cache store lookup failed: %s", e)
+                embedding = None
+            if embedding is not None:
+                self._stats.hits += 1
+                self._stats.store_hits += 1
+                self._set_local(key, embedding)
+                return embedding
+        self._stats.misses += 1
+        return None
+
+    async def set(self, key: str, embedding: list[float]) -> None:
+        self._set_local(key, embedding)
+        if self.store is not None:
+            try:
+                await self.store.set(key, embedding)
+            except Exception as e:
+                logger.warning("Embedding cache store update failed: %s", e)
+
+
+async def create_embedding_cache_from_env(
+    sessionmaker: async_sessionmaker[AsyncSession],
+) -> Optional[EmbeddingCache]:
+    """
+    Create the query embedding cache from environment variables.
+    Set EMBEDDING_CACHE_SIZE to 0 to disable caching,
+    and EMBEDDING_CACHE_BACKEND to "postgres" to share entries between workers.
+    """
+    maxsize = int(os.getenv("EMBEDDING_CACHE_SIZE") or 1024)
+    if maxsize <= 0:
+        logger.info("Query embedding cache is disabled")
+        return None
+    ttl_seconds = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS") or 86400)
+    store: Optional[EmbeddingStore] = None
+    if os.getenv("EMBEDDING_CACHE_BACKEND") == "postgres":
+        logger.info("Using PostgreSQL as shared store for the query embedding cache")
+        store = PostgresEmbeddingStore(sessionmaker, ttl_seconds)
+    return EmbeddingCache(maxsize=maxsize, ttl_seconds=ttl_seconds, store=store)
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import re
+from typing import Optional
+
+from pydantic import BaseModel, field_validator
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from fastapi_app.dependencies import FastAPIAppContext
+from fastapi_app.postgres_models import AppSetting, Item
+
+logger = logging.getLogger("ragapp")
+
+# Key of the app_settings row that selects the embedding column searched by all app instances
+EMBEDDING_SETTINGS_KEY = "embedding"
+
+# Unquoted lowercase Postgres identifiers, since column names are interpolated into SQL
+COLUMN_NAME_PATTERN = re.compile(r"^[a-z_][a-z0-9_]{0,62}$")
+
+
+def validate_column_name(column_name: str) -> str:
+    if not COLUMN_NAME_PATTERN.match(column_name):
+        raise ValueError(f"Invalid column name: {column_name!r}")
+    return column_name
+
+
+class EmbeddingSettings(BaseModel):
+    """
+    The embedding column that searches use, and the model that query embeddings must be computed with to match it
+    """
+
+    embedding_column: str
+    openai_embed_model: str
+    openai_embed_deployment: Optional[str] = None
+    openai_embed_dimensions: Optional[int] = None
+
+    @field_validator("embedding_column")
+    @classmethod
+    def check_embedding_column(cls, value: str) -> str:
+        return validate_column_name(value)
+
+    @classmethod
+    def from_context(cls, context: FastAPIAppContext) -> "EmbeddingSettings":
+        return cls.model_validate(context.model_dump(include=set(cls.model_fields)))
+
+    def supports_vector_index_mode(self, vector_index_mode: str) -> bool:
+        """
+        The quantized indexes are only defined for the columns of the Item model (see quantized_embedding_index),
+        so a column added by migrate_embeddings can only be searched in the "vector" mode.
+        """
+        return vector_index_mode == "vector" or self.embedding_column in Item.__table__.columns
+
+
+async def load_embedding_settings(session: AsyncSession) -> Optional[EmbeddingSettings]:
+    value = (
+        await session.execute(
+            text(f"SELECT value FROM {AppSetting.__tablename__} WHERE key = :key"), {"key": EMBEDDING_SETTINGS_KEY}
+        )
+    ).scalar()
+    return EmbeddingSettings.model_validate(value) if value is not None else None
+
+
+async def save_embedding_settings(session: AsyncSession, settings: EmbeddingSettings) -> None:
+    """Switch all app instances to the given embedding settings. The caller commits the session."""
+    await session.execute(
+        text(
+            f"INSERT INTO {AppSetting.__tablename__} (key, value) VALUES (:key, CAST(:value AS JSONB)) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = now()"
+        ),
+        {"key": EMBEDDING_SETTINGS_KEY, "value": settings.model_dump_json()},
+    )
+
+
+class EmbeddingSettingsWatcher:
+    """
+    Polls the embedding settings in the database and applies them to the app context,
+    so that a cutover to a new embedding column reaches running app instances without a restart.
+    The context object is shared by all requests, so it is updated in place.
+    """
+
+    def __init__(
+        self,
+        sessionmaker: async_sessionmaker[AsyncSession],
+        context: FastAPIAppContext,
+        poll_seconds: float = 30,
+    ):
+        self.sessionmaker = sessionmaker
+        self.context = context
+        self.poll_seconds = poll_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    def apply(self, settings: EmbeddingSettings) -> bool:
+        """Update the context with the settings, and return whether anything changed."""
+        if settings == EmbeddingSettings.from_context(self.context):
+            return False
+        if not settings.supports_vector_index_mode(self.context.vector_index_mode):
+            logger.warning(
+                "Ignoring the switch to embedding column %s, which has no %s index "
+                "(set POSTGRES_VECTOR_INDEX_MODE=vector to search it)",
+                settings.embedding_column,
+                self.context.vector_index_mode,
+            )
+            return False
+        logger.info(
+            "Switching embedding column from %s to %s (model %s)",
+            self.context.embedding_column,
+            settings.embedding_column,
+            settings.openai_embed_model,
+        )
+        # There is no await between the assignments, so no request sees a mix of old and new settings
+        for name, value in settings:
+            setattr(self.context, name, value)
+        return True
+
+    async def refresh(self) -> bool:
+        async with self.sessionmaker() as session:
+            settings = await load_embedding_settings(session)
+        return settings is not None and self.apply(settings)
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Failed to refresh embedding settings: %s", e)
+
+    async def start(self) -> None:
+        """Apply the current settings before serving requests, then keep polling in the background."""
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning("Failed to load embedding settings, using the environment settings: %s", e)
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+async def create_embedding_settings_watcher_from_env(
+    sessionmaker: async_sessionmaker[AsyncSession], context: FastAPIAppContext
+) -> Optional[EmbeddingSettingsWatcher]:
+    """
+    Create the watcher for the embedding settings from environment variables.
+    Set EMBEDDING_SETTINGS_POLL_SECONDS to 0 to only use the embedding settings from the environment.
+    """
+    poll_seconds = float(os.getenv("EMBEDDING_SETTINGS_POLL_SECONDS") or 30)
+    if poll_seconds <= 0:
+        return None
+    return EmbeddingSettingsWatcher(sessionmaker, context, poll_seconds=poll_seconds)
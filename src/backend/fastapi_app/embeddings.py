@@ -1,35 +1,176 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
 from typing import Optional, TypedDict, Union
 
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 
+from fastapi_app.embedding_cache import EmbeddingCache
+
+logger = logging.getLogger("ragapp")
+
+SUPPORTED_DIMENSIONS_MODEL = {
+    "text-embedding-ada-002": False,
+    "text-embedding-3-small": True,
+    "text-embedding-3-large": True,
+}
 
-async def compute_text_embedding(
-    q: str,
-    openai_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
-    embed_model: str,
-    embed_deployment: Optional[str] = None,
-    embedding_dimensions: Optional[int] = None,
-) -> list[float]:
-    SUPPORTED_DIMENSIONS_MODEL = {
-        "text-embedding-ada-002": False,
-        "text-embedding-3-small": True,
-        "text-embedding-3-large": True,
-    }
 
-    class ExtraArgs(TypedDict, total=False):
-        dimensions: int
+class ExtraArgs(TypedDict, total=False):
+    dimensions: int
 
-    dimensions_args: ExtraArgs = {}
+
+def get_dimensions_args(embed_model: str, embedding_dimensions: Optional[int]) -> ExtraArgs:
     if SUPPORTED_DIMENSIONS_MODEL.get(embed_model):
         if embedding_dimensions is None:
             raise ValueError(f"Model {embed_model} requires embedding dimensions")
-        else:
-            dimensions_args = {"dimensions": embedding_dimensions}
+        return {"dimensions": embedding_dimensions}
+    return {}
+
 
-    embedding = await openai_client.embeddings.create(
+async def compute_text_embeddings(
+    texts: list[str],
+    openai_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
+    embed_model: str,
+    embed_deployment: Optional[str] = None,
+    embedding_dimensions: Optional[int] = None,
+) -> list[list[float]]:
+    """Compute embeddings for several texts with a single list-input API call, in input order."""
+    dimensions_args = get_dimensions_args(embed_model, embedding_dimensions)
+    response = await openai_client.embeddings.create(
         # Azure OpenAI takes the deployment name as the model name
         model=embed_deployment if embed_deployment else embed_model,
-        input=q,
+        input=texts,
         **dimensions_args,
     )
-    return embedding.data[0].embedding
+    if len(response.data) != len(texts):
+        raise ValueError(f"Expected {len(texts)} embeddings but received {len(response.data)}")
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+@dataclass
+class _PendingBatch:
+    openai_client: Union[AsyncOpenAI, AsyncAzureOpenAI]
+    embed_model: str
+    embed_deployment: Optional[str]
+    embedding_dimensions: Optional[int]
+    flush_handle: Optional[asyncio.TimerHandle] = None
+    # Identical texts in the same batch share one input and one future
+    futures: dict[str, asyncio.Future[list[float]]] = field(default_factory=dict)
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests into list-input API calls.
+    Requests are collected for up to max_wait_seconds (or until max_batch_size distinct texts are waiting),
+    sent as one call, and the resulting vectors are handed back to each waiting coroutine.
+    """
+
+    def __init__(self, max_batch_size: int = 16, max_wait_seconds: float = 0.005):
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.requests = 0
+        self.batches = 0
+        self._pending: dict[tuple, _PendingBatch] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(
+        self,
+        q: str,
+        openai_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
+        embed_model: str,
+        embed_deployment: Optional[str] = None,
+        embedding_dimensions: Optional[int] = None,
+    ) -> list[float]:
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+        key = (id(openai_client), embed_model, embed_deployment, embedding_dimensions)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = _PendingBatch(openai_client, embed_model, embed_deployment, embedding_dimensions)
+            batch.flush_handle = loop.call_later(self.max_wait_seconds, self._flush, key)
+            self._pending[key] = batch
+        future = batch.futures.get(q)
+        if future is None:
+            future = batch.futures[q] = loop.create_future()
+            if len(batch.futures) >= self.max_batch_size:
+                self._flush(key)
+        # Shield so that one cancelled caller does not cancel the result for others waiting on the same text
+        return await asyncio.shield(future)
+
+    def _flush(self, key: tuple) -> None:
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.flush_handle is not None:
+            batch.flush_handle.cancel()
+        self.batches += 1
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: _PendingBatch) -> None:
+        texts = list(batch.futures)
+        try:
+            embeddings = await compute_text_embeddings(
+                texts,
+                batch.openai_client,
+                batch.embed_model,
+                batch.embed_deployment,
+                batch.embedding_dimensions,
+            )
+        except Exception as e:
+            for future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, embedding in zip(texts, embeddings):
+            future = batch.futures[text]
+            if not future.done():
+                future.set_result(embedding)
+
+
+async def create_embedding_batcher_from_env() -> Optional[EmbeddingBatcher]:
+    """
+    Create the embedding request batcher from environment variables.
+    Set EMBEDDING_BATCH_MAX_SIZE to 0 or 1 to send every request on its own.
+    """
+    max_batch_size = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE") or 16)
+    if max_batch_size <= 1:
+        logger.info("Embedding request batching is disabled")
+        return None
+    max_wait_seconds = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS") or 5) / 1000
+    return EmbeddingBatcher(max_batch_size=max_batch_size, max_wait_seconds=max_wait_seconds)
+
+
+async def compute_text_embedding(
+    q: str,
+    openai_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
+    embed_model: str,
+    embed_deployment: Optional[str] = None,
+    embedding_dimensions: Optional[int] = None,
+    cache: Optional[EmbeddingCache] = None,
+    batcher: Optional[EmbeddingBatcher] = None,
+) -> list[float]:
+    dimensions_args = get_dimensions_args(embed_model, embedding_dimensions)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(q, embed_model, embed_deployment, embedding_dimensions)
+        if (cached_embedding := await cache.get(cache_key)) is not None:
+            return cached_embedding
+
+    if batcher is not None:
+        embedding = await batcher.embed(q, openai_client, embed_model, embed_deployment, embedding_dimensions)
+    else:
+        response = await openai_client.embeddings.create(
+            # Azure OpenAI takes the deployment name as the model name
+            model=embed_deployment if embed_deployment else embed_model,
+            input=q,
+            **dimensions_args,
+        )
+        embedding = response.data[0].embedding
+    if cache is not None and cache_key is not None:
+        await cache.set(cache_key, embedding)
+    return embedding
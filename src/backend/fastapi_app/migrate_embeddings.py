@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import logging
+from typing import Optional
+
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, async_sessionmaker
+
+from fastapi_app.dependencies import common_parameters
+from fastapi_app.embedding_settings import (
+    EmbeddingSettings,
+    load_embedding_settings,
+    save_embedding_settings,
+    validate_column_name,
+)
+from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.postgres_models import Item
+from fastapi_app.setup_postgres_seeddata import build_indexes
+from fastapi_app.update_embeddings import CHECKPOINT_FILE, update_embeddings
+
+logger = logging.getLogger("ragapp")
+
+"""
+**Re-embed the items into a new column without interrupting searches**
+
+Run the steps in order; the app keeps searching the current column until the cutover:
+
+1. add-column: add a nullable vector column for the new embedding model.
+2. backfill: compute the embeddings for the new column, in batches that can be resumed (see update_embeddings.py).
+   Run it again with --resume after an interruption, and once more after any ingestion that happened meanwhile.
+3. create-index: build the HNSW index for the new column without blocking writes.
+4. validate: check that every row has an embedding, and the recall of the index on a sample of rows.
+5. cutover: store the new column and model in the app_settings table, in a single transaction.
+   Running app instances poll that row and switch within EMBEDDING_SETTINGS_POLL_SECONDS (see embedding_settings.py).
+
+The old column is left in place, so switching back is another cutover.
+After the cutover, ingestion still only computes embeddings for the columns of the Item model.
+setup_postgres_seeddata.py clears the new column in the rows it changes and then embeds every row without one,
+and update_embeddings.py --only-missing does the same for rows written in other ways,
+since it uses the column and model of the cutover.
+Only the full-precision index is built for the new column, so the cutover requires POSTGRES_VECTOR_INDEX_MODE=vector,
+and app instances that use a quantized index mode ignore it.
+"""
+
+
+class EmbeddingColumnReport(BaseModel):
+    """
+    Coverage of an embedding column and recall of its HNSW index
+    """
+
+    embedding_column: str
+    rows: int
+    embedded_rows: int
+    index_valid: bool
+    sample_size: int = 0
+    recall: Optional[float] = None
+
+    @property
+    def coverage(self) -> float:
+        return self.embedded_rows / self.rows if self.rows else 1.0
+
+    def failures(self, min_coverage: float, min_recall: float) -> list[str]:
+        failures = []
+        if self.coverage < min_coverage:
+            failures.append(f"coverage {self.coverage:.2%} is below {min_coverage:.2%}")
+        if not self.index_valid:
+            failures.append(f"the HNSW index on {self.embedding_column} does not exist or is invalid")
+        if self.recall is not None and self.recall < min_recall:
+            failures.append(f"recall {self.recall:.2%} is below {min_recall:.2%}")
+        return failures
+
+
+def embedding_index_name(embedding_column: str) -> str:
+    return f"hnsw_index_for_cosine_{Item.__tablename__}_{embedding_column}"
+
+
+def compute_recall(approximate_ids: list[int], exact_ids: list[int]) -> float:
+    """Fraction of the exact nearest neighbors that the index search also found."""
+    if not exact_ids:
+        return 1.0
+    return len(set(approximate_ids).intersection(exact_ids)) / len(exact_ids)
+
+
+async def add_embedding_column(engine: AsyncEngine, embedding_column: str, dimensions: int) -> None:
+    validate_column_name(embedding_column)
+    logger.info("Adding column %s with %d dimensions...", embedding_column, dimensions)
+    async with engine.begin() as conn:
+        # Adding a nullable column without a default only changes the catalog, so it does not rewrite the table
+        await conn.execute(
+            text(
+                f"ALTER TABLE {Item.__tablename__} "
+                f"ADD COLUMN IF NOT EXISTS {embedding_column} vector({int(dimensions)})"
+            )
+        )
+
+
+async def create_embedding_index(
+    engine: AsyncEngine, embedding_column: str, maintenance_work_mem: str = "1GB", parallel_workers: int = 4
+) -> None:
+    """Build the HNSW index for an embedding column concurrently, so that the app can keep writing to the table."""
+    validate_column_name(embedding_column)
+    index_name = embedding_index_name(embedding_column)
+    async with engine.connect() as conn:
+        # CREATE INDEX CONCURRENTLY cannot run in a transaction, so use the asyncpg connection directly
+        connection = (await conn.get_raw_connection()).driver_connection
+        if connection is None:
+            raise RuntimeError("The database connection is closed")
+        index_valid = await connection.fetchval(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", index_name
+        )
+        if index_valid:
+            logger.info("Index %s already exists", index_name)
+            return
+        if index_valid is False:
+            # An interrupted concurrent build leaves an invalid index behind
+            logger.info("Dropping invalid index %s", index_name)
+            await connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+        index_definition = (
+            f"CREATE INDEX CONCURRENTLY {index_name} ON {Item.__tablename__} "
+            f"USING hnsw ({embedding_column} vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+        )
+        await build_indexes(connection, [(index_name, index_definition)], maintenance_work_mem, parallel_workers)
+
+
+async def validate_embedding_column(
+    conn: AsyncConnection, embedding_column: str, sample_size: int = 100, k: int = 10
+) -> EmbeddingColumnReport:
+    """
+    Measure how many rows have an embedding in the column, and the recall@k of its HNSW index,
+    using the embeddings of a random sample of rows as queries and exact nearest neighbor searches as ground truth.
+    """
+    validate_column_name(embedding_column)
+    table_name = Item.__tablename__
+    counts = (
+        await conn.execute(text(f"SELECT count(*) AS rows, count({embedding_column}) AS embedded FROM {table_name}"))
+    ).one()
+    index_valid = (
+        await conn.execute(
+            text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:index_name)"),
+            {"index_name": embedding_index_name(embedding_column)},
+        )
+    ).scalar()
+    report = EmbeddingColumnReport(
+        embedding_column=embedding_column,
+        rows=counts.rows,
+        embedded_rows=counts.embedded,
+        index_valid=bool(index_valid),
+    )
+    await conn.commit()
+    if not report.index_valid or sample_size <= 0:
+        return report
+
+    sample = (
+        await conn.execute(
+            text(
+                f"SELECT id, {embedding_column} AS embedding FROM {table_name} "
+                f"WHERE {embedding_column} IS NOT NULL ORDER BY random() LIMIT :sample_size"
+            ),
+            {"sample_size": sample_size},
+        )
+    ).fetchall()
+    await conn.commit()
+    neighbors_query = text(
+        f"SELECT id FROM {table_name} WHERE id <> :id AND {embedding_column} IS NOT NULL "
+        f"ORDER BY {embedding_column} <=> :embedding LIMIT :k"
+    )
+    recalls = []
+    for row in sample:
+        params = {"id": row.id, "embedding": row.embedding, "k": k}
+        approximate_ids = (await conn.execute(neighbors_query, params)).scalars().all()
+        await conn.commit()
+        # Without index scans, the same query returns the exact nearest neighbors
+        await conn.execute(text("SELECT set_config('enable_indexscan', 'off', true)"))
+        exact_ids = (await conn.execute(neighbors_query, params)).scalars().all()
+        await conn.commit()
+        recalls.append(compute_recall(list(approximate_ids), list(exact_ids)))
+    report.sample_size = len(recalls)
+    report.recall = sum(recalls) / len(recalls) if recalls else None
+    return report
+
+
+async def cutover(engine: AsyncEngine, settings: EmbeddingSettings) -> None:
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessionmaker() as session:
+        previous = await load_embedding_settings(session)
+        await save_embedding_settings(session, settings)
+        await session.commit()
+    logger.info(
+        "Switched the app from %s to %s (model %s)",
+        previous.embedding_column if previous else "the column configured in the environment",
+        settings.embedding_column,
+        settings.openai_embed_model,
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Re-embed the items into a new column, then switch the app to it")
+    parser.add_argument("step", choices=["add-column", "backfill", "create-index", "validate", "cutover"])
+    parser.add_argument("--column", type=str, required=True, help="Name of the new embedding column")
+    parser.add_argument("--embed-model", type=str, help="Embedding model for the new column (default from env)")
+    parser.add_argument("--embed-deployment", type=str, help="Azure OpenAI deployment of the embedding model")
+    parser.add_argument("--embed-dimensions", type=int, help="Dimensions of the new embeddings (default from env)")
+    parser.add_argument("--batch-size", type=int, default=100, help="Number of rows embedded per API call")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of batches embedded at the same time")
+    parser.add_argument("--resume", action="store_true", help="Continue the backfill after the last checkpoint")
+    parser.add_argument("--checkpoint-file", type=str, default=CHECKPOINT_FILE)
+    parser.add_argument("--maintenance-work-mem", type=str, default="1GB", help="For building the index")
+    parser.add_argument("--parallel-workers", type=int, default=4, help="For building the index")
+    parser.add_argument("--sample-size", type=int, default=100, help="Number of queries for measuring recall")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbors for measuring recall")
+    parser.add_argument("--min-coverage", type=float, default=1.0, help="Fraction of rows that must be embedded")
+    parser.add_argument("--min-recall", type=float, default=0.9, help="Minimum recall@k of the index")
+    parser.add_argument("--force", action="store_true", help="Cut over even if the validation fails")
+    args = parser.parse_args()
+
+    context = await common_parameters()
+    settings = EmbeddingSettings(
+        embedding_column=args.column,
+        openai_embed_model=args.embed_model or context.openai_embed_model,
+        openai_embed_deployment=args.embed_deployment or context.openai_embed_deployment,
+        openai_embed_dimensions=args.embed_dimensions or context.openai_embed_dimensions,
+    )
+
+    if args.step == "backfill":
+        # Only rows without an embedding, so that re-running the backfill catches up with new rows
+        await update_embeddings(
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            only_missing=True,
+            resume=args.resume,
+            checkpoint_file=args.checkpoint_file,
+            embedding_settings=settings,
+            # The content hash tracks the live column, which the app keeps searching until the cutover
+            update_content_hash=False,
+        )
+        return
+
+    engine = await create_postgres_engine_from_env()
+    try:
+        if args.step == "add-column":
+            if settings.openai_embed_dimensions is None:
+                parser.error("--embed-dimensions is required to add a column")
+            await add_embedding_column(engine, settings.embedding_column, settings.openai_embed_dimensions)
+        elif args.step == "create-index":
+            await create_embedding_index(
+                engine, settings.embedding_column, args.maintenance_work_mem, args.parallel_workers
+            )
+        elif args.step in ("validate", "cutover"):
+            async with engine.connect() as conn:
+                report = await validate_embedding_column(conn, settings.embedding_column, args.sample_size, args.k)
+            logger.info(
+                "Column %s: %d of %d rows embedded (%.2f%%), index %s, recall@%d %s on %d queries",
+                report.embedding_column,
+                report.embedded_rows,
+                report.rows,
+                report.coverage * 100,
+                "valid" if report.index_valid else "missing or invalid",
+                args.k,
+                f"{report.recall:.2%}" if report.recall is not None else "not measured",
+                report.sample_size,
+            )
+            failures = report.failures(args.min_coverage, args.min_recall)
+            for failure in failures:
+                logger.error("Validation failed: %s", failure)
+            if args.step == "cutover":
+                if not settings.supports_vector_index_mode(context.vector_index_mode):
+                    raise SystemExit(
+                        f"Not cutting over, since {settings.embedding_column} has no {context.vector_index_mode} "
+                        "index (set POSTGRES_VECTOR_INDEX_MODE=vector)"
+                    )
+                if failures and not args.force:
+                    raise SystemExit("Not cutting over, since the validation failed (use --force to override)")
+                await cutover(engine, settings)
+            elif failures:
+                raise SystemExit(1)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
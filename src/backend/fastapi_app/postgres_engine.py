@@ -1,29 +1,118 @@
+import asyncio
 import logging
 import os
+import time
+from collections.abc import Iterable
+from typing import Optional
 
+from azure.core.credentials import AccessToken
 from azure.identity import AzureDeveloperCliCredential
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, MeterProvider, Observation
 from pgvector.asyncpg import register_vector
+from pydantic import BaseModel
 from sqlalchemy import event
 from sqlalchemy.engine import AdaptedConnection
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool
 
 from fastapi_app.dependencies import get_azure_credential
 
 logger = logging.getLogger("ragapp")
 
+AZURE_POSTGRES_SCOPE = "https://ossrdbms-aad.database.windows.net/.default"
 
-async def create_postgres_engine(*, host, username, database, password, sslmode, azure_credential) -> AsyncEngine:
-    def get_password_from_azure_credential():
-        token = azure_credential.get_token("https://ossrdbms-aad.database.windows.net/.default")
-        return token.token
 
-    token_based_password = False
+class PostgresPoolSettings(BaseModel):
+    """
+    Connection pool settings for the engine, see
+    https://docs.sqlalchemy.org/en/20/core/pooling.html#sqlalchemy.pool.QueuePool
+    """
+
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    # Connections are replaced after this many seconds, so that they don't outlive server-side idle timeouts
+    pool_recycle: int = 1800
+    # Test connections on checkout, at the cost of a round trip, to survive server restarts and failovers
+    pool_pre_ping: bool = False
+
+
+class PostgresPoolStats(BaseModel):
+    """
+    Connection counts of an engine's pool
+    """
+
+    size: int = 0
+    checked_out: int = 0
+    checked_in: int = 0
+    overflow: int = 0
+    max_connections: int = 0
+
+
+class AzureTokenCache:
+    """
+    Caches the Microsoft Entra token that is used as the password for Azure Database for PostgreSQL.
+    New connections get the cached token, and once it is about to expire,
+    a new one is fetched in a worker thread so that the event loop is not blocked.
+    Only a token that has already expired is fetched synchronously.
+    """
+
+    def __init__(self, azure_credential, refresh_margin_seconds: float = 300):
+        self.azure_credential = azure_credential
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._token: Optional[AccessToken] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _fetch(self) -> AccessToken:
+        start_time = time.perf_counter()
+        self._token = self.azure_credential.get_token(AZURE_POSTGRES_SCOPE)
+        logger.info("Fetched token for Azure Database for PostgreSQL in %.2f seconds", time.perf_counter() - start_time)
+        return self._token
+
+    async def refresh(self) -> str:
+        return (await asyncio.to_thread(self._fetch)).token
+
+    def _on_refresh_done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to refresh token for Azure Database for PostgreSQL: %s", task.exception())
+
+    def _start_refresh(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._refresh_task = loop.create_task(self.refresh())
+        self._refresh_task.add_done_callback(self._on_refresh_done)
+
+    def get_token(self) -> str:
+        now = time.time()
+        if self._token is None or self._token.expires_on <= now:
+            return self._fetch().token
+        if self._token.expires_on - now <= self.refresh_margin_seconds:
+            self._start_refresh()
+        return self._token.token
+
+
+async def create_postgres_engine(
+    *,
+    host,
+    username,
+    database,
+    password,
+    sslmode,
+    azure_credential,
+    pool_settings: Optional[PostgresPoolSettings] = None,
+) -> AsyncEngine:
+    token_cache: Optional[AzureTokenCache] = None
     if host.endswith(".database.azure.com"):
-        token_based_password = True
         logger.info("Authenticating to Azure Database for PostgreSQL using Azure Identity...")
         if azure_credential is None:
             raise ValueError("Azure credential must be provided for Azure Database for PostgreSQL")
-        password = get_password_from_azure_credential()
+        token_cache = AzureTokenCache(azure_credential)
+        password = await token_cache.refresh()
     else:
         logger.info("Authenticating to PostgreSQL using password...")
 
@@ -32,7 +121,8 @@ async def create_postgres_engine(*, host, username, database, password, sslmode,
     if sslmode:
         DATABASE_URI += f"?ssl={sslmode}"
 
-    engine = create_async_engine(DATABASE_URI, echo=False)
+    pool_settings = pool_settings or PostgresPoolSettings()
+    engine = create_async_engine(DATABASE_URI, echo=False, **pool_settings.model_dump())
 
     @event.listens_for(engine.sync_engine, "connect")
     def register_custom_types(dbapi_connection: AdaptedConnection, *args):
@@ -44,16 +134,30 @@ async def create_postgres_engine(*, host, username, database, password, sslmode,
 
     @event.listens_for(engine.sync_engine, "do_connect")
     def update_password_token(dialect, conn_rec, cargs, cparams):
-        if token_based_password:
-            logger.info("Updating password token for Azure Database for PostgreSQL")
-            cparams["password"] = get_password_from_azure_credential()
+        if token_cache is not None:
+            cparams["password"] = token_cache.get_token()
 
     return engine
 
 
+def get_pool_settings_from_env() -> PostgresPoolSettings:
+    return PostgresPoolSettings(
+        pool_size=int(os.getenv("POSTGRES_POOL_SIZE") or 5),
+        max_overflow=int(os.getenv("POSTGRES_POOL_MAX_OVERFLOW") or 10),
+        pool_timeout=float(os.getenv("POSTGRES_POOL_TIMEOUT") or 30),
+        pool_recycle=int(os.getenv("POSTGRES_POOL_RECYCLE") or 1800),
+        pool_pre_ping=(os.getenv("POSTGRES_POOL_PRE_PING") or "false").lower() == "true",
+    )
+
+
 async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
+    """
+    Create the engine from environment variables.
+    The pool is configured with POSTGRES_POOL_SIZE, POSTGRES_POOL_MAX_OVERFLOW, POSTGRES_POOL_TIMEOUT,
+    POSTGRES_POOL_RECYCLE and POSTGRES_POOL_PRE_PING.
+    """
     if azure_credential is None and os.environ["POSTGRES_HOST"].endswith(".database.azure.com"):
-        azure_credential = get_azure_credential()
+        azure_credential = await get_azure_credential()
 
     return await create_postgres_engine(
         host=os.environ["POSTGRES_HOST"],
@@ -62,9 +166,35 @@ async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
         password=os.environ.get("POSTGRES_PASSWORD"),
         sslmode=os.environ.get("POSTGRES_SSL"),
         azure_credential=azure_credential,
+        pool_settings=get_pool_settings_from_env(),
     )
 
 
+async def create_postgres_replica_engines_from_env(azure_credential=None) -> dict[str, AsyncEngine]:
+    """
+    Create one engine for each read replica host in POSTGRES_READ_REPLICA_HOSTS (comma-separated).
+    The replicas use the same database, credentials and pool settings as the primary.
+    """
+    hosts = [host.strip() for host in (os.getenv("POSTGRES_READ_REPLICA_HOSTS") or "").split(",") if host.strip()]
+    if not hosts:
+        return {}
+    if azure_credential is None and any(host.endswith(".database.azure.com") for host in hosts):
+        azure_credential = await get_azure_credential()
+
+    return {
+        host: await create_postgres_engine(
+            host=host,
+            username=os.environ["POSTGRES_USERNAME"],
+            database=os.environ["POSTGRES_DATABASE"],
+            password=os.environ.get("POSTGRES_PASSWORD"),
+            sslmode=os.environ.get("POSTGRES_SSL"),
+            azure_credential=azure_credential,
+            pool_settings=get_pool_settings_from_env(),
+        )
+        for host in hosts
+    }
+
+
 async def create_postgres_engine_from_args(args, azure_credential=None) -> AsyncEngine:
     if azure_credential is None and args.host.endswith(".database.azure.com"):
         if tenant_id := args.tenant_id:
@@ -82,3 +212,49 @@ async def create_postgres_engine_from_args(args, azure_credential=None) -> Async
         sslmode=args.sslmode,
         azure_credential=azure_credential,
     )
+
+
+def get_pool_stats(engine: AsyncEngine) -> PostgresPoolStats:
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return PostgresPoolStats()
+    return PostgresPoolStats(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        checked_in=pool.checkedin(),
+        overflow=max(pool.overflow(), 0),
+        max_connections=pool.size() + max(pool._max_overflow, 0),
+    )
+
+
+def register_pool_metrics(engines: dict[str, AsyncEngine], meter_provider: Optional[MeterProvider] = None) -> None:
+    """
+    Report the connection counts of the pools, by pool name, as OpenTelemetry gauges,
+    following the semantic conventions for database client metrics.
+    Each gauge can only be registered once, so a single call reports all the pools.
+    """
+    meter = metrics.get_meter("ragapp", meter_provider=meter_provider)
+
+    def observe_connection_count(options: CallbackOptions) -> Iterable[Observation]:
+        for pool_name, engine in engines.items():
+            stats = get_pool_stats(engine)
+            attributes = {"db.client.connection.pool.name": pool_name}
+            yield Observation(stats.checked_out, {**attributes, "db.client.connection.state": "used"})
+            yield Observation(stats.checked_in, {**attributes, "db.client.connection.state": "idle"})
+
+    def observe_connection_max(options: CallbackOptions) -> Iterable[Observation]:
+        for pool_name, engine in engines.items():
+            yield Observation(get_pool_stats(engine).max_connections, {"db.client.connection.pool.name": pool_name})
+
+    meter.create_observable_gauge(
+        "db.client.connection.count",
+        callbacks=[observe_connection_count],
+        unit="{connection}",
+        description="Number of connections in the pool, by state",
+    )
+    meter.create_observable_gauge(
+        "db.client.connection.max",
+        callbacks=[observe_connection_max],
+        unit="{connection}",
+        description="Maximum number of connections the pool can open",
+    )
@@ -1,10 +1,19 @@
 from __future__ import annotations
 
-from pgvector.sqlalchemy import Vector
-from sqlalchemy import Index
-from sqlalchemy.dialects.postgresql import ARRAY
+import hashlib
+from datetime import datetime
+
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
+from sqlalchemy import REAL, Computed, DateTime, ForeignKey, Index, cast, func
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
+# The text search configuration must match the one used by plainto_tsquery in PostgresSearcher
+TSVECTOR_EXPRESSION = "to_tsvector('english', content)"
+
+# Columns that are never returned to API clients
+NON_PUBLIC_COLUMNS = {"embedding_3l", "content_tsv", "content_hash"}
+
 
 # Define the models
 class Base(DeclarativeBase):
@@ -20,18 +29,27 @@ class Item(Base):
     typedoc: Mapped[str] = mapped_column()
     pagenumber: Mapped[int] = mapped_column()
     chunk: Mapped[int] = mapped_column()
+    # The page the chunk was taken from, whose full text is only fetched to expand the context of top results
+    page_id: Mapped[int | None] = mapped_column(ForeignKey("pages.id", ondelete="CASCADE"), index=True, nullable=True)
     # Embeddings for different models:
     embedding_3l: Mapped[Vector] = mapped_column(Vector(1536), nullable=True)  # text-embedding-3-large
+    # Full-text search vector, computed by Postgres whenever content changes:
+    content_tsv: Mapped[str] = mapped_column(
+        TSVECTOR, Computed(TSVECTOR_EXPRESSION, persisted=True), deferred=True, nullable=True
+    )
+    # SHA-256 of the text the embeddings were last computed from, see update_embeddings.py
+    content_hash: Mapped[str | None] = mapped_column(deferred=True, nullable=True)
 
     def to_dict(self, include_embedding: bool = False):
-        model_dict = {column.name: getattr(self, column.name) for column in self.__table__.columns}
+        model_dict = {
+            column.name: getattr(self, column.name)
+            for column in self.__table__.columns
+            if column.name not in NON_PUBLIC_COLUMNS
+        }
         if include_embedding:
-            model_dict["embedding_3l"] = model_dict.get("embedding_3l", [])
-        else:
-            del model_dict["embedding_3l"]
+            model_dict["embedding_3l"] = getattr(self, "embedding_3l", [])
         return model_dict
 
-
     def to_str_for_rag(self):
         return (
             f"Filename: {self.filename} | "
@@ -45,6 +63,54 @@ class Item(Base):
     def to_str_for_embedding(self):
         return f"Content: {self.content} Filename: {self.filename} Page Number: {self.pagenumber}"
 
+    def compute_content_hash(self) -> str:
+        return hashlib.sha256(self.to_str_for_embedding().encode("utf-8")).hexdigest()
+
+
+class Page(Base):
+    """Full text of a document page, stored once for all the chunks (items) taken from it."""
+
+    __tablename__ = "pages"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    filename: Mapped[str] = mapped_column()
+    fileurl: Mapped[str] = mapped_column()
+    typedoc: Mapped[str] = mapped_column()
+    pagenumber: Mapped[int] = mapped_column()
+    content: Mapped[str] = mapped_column()
+
+
+class EmbeddingCacheEntry(Base):
+    """Query embeddings shared between app workers. UNLOGGED since the data can always be recomputed."""
+
+    __tablename__ = "embedding_cache"
+    __table_args__ = {"prefixes": ["UNLOGGED"]}
+    key: Mapped[str] = mapped_column(primary_key=True)
+    embedding: Mapped[list[float]] = mapped_column(ARRAY(REAL))
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class AnswerCacheEntry(Base):
+    """Chat answers cached by query embedding. Emptied by a trigger whenever the items table changes."""
+
+    __tablename__ = "answer_cache"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    params_key: Mapped[str] = mapped_column(index=True)
+    query: Mapped[str] = mapped_column()
+    query_embedding: Mapped[Vector] = mapped_column(Vector(1536))
+    response: Mapped[dict] = mapped_column(JSONB)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class AppSetting(Base):
+    """Settings that can be changed while the app is running. Every app instance polls them."""
+
+    __tablename__ = "app_settings"
+    key: Mapped[str] = mapped_column(primary_key=True)
+    value: Mapped[dict] = mapped_column(JSONB)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
 
 """
 **Define HNSW index to support vector similarity search**
@@ -64,5 +130,68 @@ index_3l = Index(
     postgresql_using="hnsw",
     postgresql_with={"m": 16, "ef_construction": 64},
     postgresql_ops={"embedding_3l": "vector_cosine_ops"},
+
+)
+
+index_answer_cache = Index(
+    f"hnsw_index_for_cosine_{AnswerCacheEntry.__tablename__}_query_embedding",
+    AnswerCacheEntry.query_embedding,
+    postgresql_using="hnsw",
+    postgresql_with={"m": 16, "ef_construction": 64},
+    postgresql_ops={"query_embedding": "vector_cosine_ops"},
 )
 
+"""
+**Define optional quantized HNSW indexes to reduce index memory**
+
+The halfvec index stores the embeddings at half precision (half the size of the full index),
+ and the binary index stores one bit per dimension (1/32 of the size).
+Both are expression indexes, so the full-precision column is kept for exact re-ranking.
+Queries must use the same expressions to hit them, see PostgresSearcher.
+They are only created when selected, see create_db_schema.
+"""
+
+VECTOR_INDEX_MODES = ("vector", "halfvec", "binary")
+
+
+def embedding_dimensions(column_name: str) -> int:
+    column_type = Item.__table__.columns[column_name].type
+    if not isinstance(column_type, Vector):
+        raise ValueError(f"Column {column_name} is not a vector column")
+    return column_type.dim
+
+
+def quantized_embedding_index(vector_index_mode: str, column_name: str = "embedding_3l") -> Index:
+    column = Item.__table__.columns[column_name]
+    dimensions = embedding_dimensions(column_name)
+    if vector_index_mode == "halfvec":
+        return Index(
+            f"hnsw_index_for_cosine_{table_name}_{column_name}_halfvec",
+            cast(column, HALFVEC(dimensions)).label("expr"),
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"expr": "halfvec_cosine_ops"},
+        )
+    elif vector_index_mode == "binary":
+        return Index(
+            f"hnsw_index_for_hamming_{table_name}_{column_name}_binary",
+            cast(func.binary_quantize(column), BIT(dimensions)).label("expr"),
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"expr": "bit_hamming_ops"},
+        )
+    raise ValueError(f"No quantized index for vector index mode: {vector_index_mode}")
+
+
+"""
+**Define GIN index to support full-text search**
+
+The index is built over the stored content_tsv column,
+ so queries must use that column (not an inline to_tsvector call) to hit it.
+"""
+
+index_content_tsv = Index(
+    f"gin_index_for_fulltext_{table_name}_content_tsv",
+    Item.content_tsv,
+    postgresql_using="gin",
+)
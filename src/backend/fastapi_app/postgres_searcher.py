@@ -1,13 +1,34 @@
-from typing import Optional, Union
+import asyncio
+from collections.abc import Hashable, Sequence
+from typing import Optional, TypeVar, Union
 
 import numpy as np
 from openai import AsyncAzureOpenAI, AsyncOpenAI
-from sqlalchemy import Float, Integer, column, select, text
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import load_only
 
-from fastapi_app.api_models import Filter
-from fastapi_app.embeddings import compute_text_embedding
-from fastapi_app.postgres_models import Item
+from fastapi_app.api_models import Filter, HNSWSearchSettings
+from fastapi_app.embedding_cache import EmbeddingCache
+from fastapi_app.embeddings import EmbeddingBatcher, compute_text_embedding
+from fastapi_app.postgres_models import NON_PUBLIC_COLUMNS, Item, Page, embedding_dimensions
+
+# Columns returned for search results; embeddings and the tsvector are never fetched
+ITEM_PUBLIC_COLUMNS = [column for column in Item.__table__.columns if column.name not in NON_PUBLIC_COLUMNS]
+
+# Upper limit of the hnsw.ef_search setting in pgvector
+HNSW_MAX_EF_SEARCH = 1000
+
+RankedKey = TypeVar("RankedKey", bound=Hashable)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[RankedKey]], k: int = 60) -> list[RankedKey]:
+    """Fuse several ranked lists into one, scoring each key by the sum of 1 / (k + rank) over the lists."""
+    scores: dict[RankedKey, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda key: scores[key], reverse=True)
 
 
 class PostgresSearcher:
@@ -19,6 +40,13 @@ class PostgresSearcher:
         embed_model: str,
         embed_dimensions: Optional[int],
         embedding_column: str,
+        embed_cache: Optional[EmbeddingCache] = None,
+        embed_batcher: Optional[EmbeddingBatcher] = None,
+        sessionmaker: Optional[async_sessionmaker[AsyncSession]] = None,
+        hybrid_search_mode: str = "single_statement",
+        hnsw_settings: Optional[HNSWSearchSettings] = None,
+        vector_index_mode: str = "vector",
+        binary_rerank_candidates: int = 200,
     ):
         self.db_session = db_session
         self.openai_embed_client = openai_embed_client
@@ -26,6 +54,22 @@ class PostgresSearcher:
         self.embed_deployment = embed_deployment
         self.embed_dimensions = embed_dimensions
         self.embedding_column = embedding_column
+        self.embed_cache = embed_cache
+        self.embed_batcher = embed_batcher
+        # In "concurrent" mode the two legs of a hybrid search run on separate pooled connections
+        self.sessionmaker = sessionmaker
+        self.hybrid_search_mode = hybrid_search_mode
+        self.hnsw_settings = hnsw_settings or HNSWSearchSettings()
+        # "halfvec" and "binary" search the quantized expression indexes, see quantized_embedding_index
+        self.vector_index_mode = vector_index_mode
+        self.binary_rerank_candidates = binary_rerank_candidates
+        if vector_index_mode == "binary" and (self.hnsw_settings.ef_search or 0) < binary_rerank_candidates:
+            # The index scan returns at most ef_search rows, so it must be able to fill the candidate list
+            self.hnsw_settings = self.hnsw_settings.model_copy(
+                update={"ef_search": min(binary_rerank_candidates, HNSW_MAX_EF_SEARCH)}
+            )
+        # An AsyncSession does not support concurrent statements, so serialize searches that run in parallel
+        self.session_lock = asyncio.Lock()
 
     def build_filter_clause(self, filters: Optional[list[Filter]]) -> tuple[str, str]:
         if filters is None:
@@ -39,28 +83,78 @@ class PostgresSearcher:
             return f"WHERE {filter_clause}", f"AND {filter_clause}"
         return "", ""
 
+    async def apply_hnsw_settings(self, session: AsyncSession) -> None:
+        """
+        Set the HNSW query settings for the rest of the session's current transaction,
+        so that they never leak to other users of the pooled connection.
+        """
+        config = self.hnsw_settings.to_config()
+        if not config:
+            return
+        params = {}
+        calls = []
+        for i, (name, value) in enumerate(config.items()):
+            params.update({f"name_{i}": name, f"value_{i}": value})
+            calls.append(f"set_config(:name_{i}, :value_{i}, true)")
+        await session.execute(text(f"SELECT {', '.join(calls)}"), params)
+
+    def build_vector_query(self, filter_clause_where: str) -> str:
+        table_name = Item.__tablename__
+        column = self.embedding_column
+        if self.vector_index_mode == "vector":
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY {column} <=> :embedding) AS rank
+                FROM {table_name}
+                {filter_clause_where}
+                ORDER BY {column} <=> :embedding
+                LIMIT 20
+            """
+        dimensions = embedding_dimensions(column)
+        query_vector = f"CAST(:embedding AS vector({dimensions}))"
+        if self.vector_index_mode == "halfvec":
+            distance = f"CAST({column} AS halfvec({dimensions})) <=> CAST({query_vector} AS halfvec({dimensions}))"
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY {distance}) AS rank
+                FROM {table_name}
+                {filter_clause_where}
+                ORDER BY {distance}
+                LIMIT 20
+            """
+        elif self.vector_index_mode == "binary":
+            # Coarse pass over the binary index by Hamming distance, then exact re-ranking on the full vectors
+            hamming_distance = (
+                f"CAST(binary_quantize({column}) AS bit({dimensions})) <~> binary_quantize({query_vector})"
+            )
+            return f"""
+            SELECT id, RANK () OVER (ORDER BY {column} <=> {query_vector}) AS rank
+                FROM (
+                    SELECT id, {column}
+                    FROM {table_name}
+                    {filter_clause_where}
+                    ORDER BY {hamming_distance}
+                    LIMIT {int(self.binary_rerank_candidates)}
+                ) candidates
+                ORDER BY {column} <=> {query_vector}
+                LIMIT 20
+            """
+        raise ValueError(f"Unsupported vector index mode: {self.vector_index_mode}")
+
     async def search(
         self,
         query_text: Optional[str],
         query_vector: list[float],
         top: int = 5,
         filters: Optional[list[Filter]] = None,
-    ):
+    ) -> list[Item]:
         filter_clause_where, filter_clause_and = self.build_filter_clause(filters)
         table_name = Item.__tablename__
-        vector_query = f"""
-            SELECT id, RANK () OVER (ORDER BY {self.embedding_column} <=> :embedding) AS rank
-                FROM {table_name}
-                {filter_clause_where}
-                ORDER BY {self.embedding_column} <=> :embedding
-                LIMIT 20
-            """
+        vector_query = self.build_vector_query(filter_clause_where)
 
         fulltext_query = f"""
-            SELECT id, RANK () OVER (ORDER BY ts_rank_cd(to_tsvector('english', content), query) DESC)
+            SELECT id, RANK () OVER (ORDER BY ts_rank_cd(content_tsv, query) DESC)
                 FROM {table_name}, plainto_tsquery('english', :query) query
-                WHERE to_tsvector('english', content) @@ query {filter_clause_and}
-                ORDER BY ts_rank_cd(to_tsvector('english', content), query) DESC
+                WHERE content_tsv @@ query {filter_clause_and}
+                ORDER BY ts_rank_cd(content_tsv, query) DESC
                 LIMIT 20
             """
 
@@ -81,28 +175,91 @@ class PostgresSearcher:
         LIMIT 20
         """
 
-        if query_text is not None and len(query_vector) > 0:
-            sql = text(hybrid_query).columns(column("id", Integer), column("score", Float))
+        if query_text is not None and len(query_vector) > 0 and self.hybrid_search_mode == "concurrent":
+            return await self.search_legs_concurrently(vector_query, fulltext_query, query_text, query_vector, top)
+        elif query_text is not None and len(query_vector) > 0:
+            ranking_query, ranking_order = hybrid_query, "ranked.score DESC"
         elif len(query_vector) > 0:
-            sql = text(vector_query).columns(column("id", Integer), column("rank", Integer))
+            ranking_query, ranking_order = vector_query, "ranked.rank"
         elif query_text is not None:
-            sql = text(fulltext_query).columns(column("id", Integer), column("rank", Integer))
+            ranking_query, ranking_order = fulltext_query, "ranked.rank"
         else:
             raise ValueError("Both query text and query vector are empty")
 
-        results = (
-            await self.db_session.execute(
-                sql,
-                {"embedding": np.array(query_vector), "query": query_text, "k": 60},
+        # Join the ranked ids back to the table in the same statement,
+        # projecting only the public columns so that embeddings are never fetched
+        projection = ", ".join(f"{table_name}.{column.name}" for column in ITEM_PUBLIC_COLUMNS)
+        sql = text(
+            f"""
+            SELECT {projection}
+            FROM ({ranking_query}) AS ranked
+            JOIN {table_name} ON {table_name}.id = ranked.id
+            ORDER BY {ranking_order}
+            LIMIT :top
+            """
+        ).columns(*ITEM_PUBLIC_COLUMNS)
+
+        async with self.session_lock:
+            if len(query_vector) > 0:
+                await self.apply_hnsw_settings(self.db_session)
+            results = await self.db_session.scalars(
+                select(Item).from_statement(sql),
+                {"embedding": np.array(query_vector), "query": query_text, "k": 60, "top": top},
             )
-        ).fetchall()
+            return list(results.all())
 
-        # Convert results to SQLAlchemy models
-        row_models = []
-        for id, _ in results[:top]:
-            item = await self.db_session.execute(select(Item).where(Item.id == id))
-            row_models.append(item.scalar())
-        return row_models
+    async def fetch_ranked_ids(self, sql: str, params: dict, uses_vector_index: bool = False) -> list[int]:
+        if self.sessionmaker is None:
+            raise ValueError("A sessionmaker is required to run hybrid search legs concurrently")
+        async with self.sessionmaker() as session:
+            if uses_vector_index:
+                await self.apply_hnsw_settings(session)
+            return list((await session.execute(text(sql), params)).scalars())
+
+    async def search_legs_concurrently(
+        self,
+        vector_query: str,
+        fulltext_query: str,
+        query_text: str,
+        query_vector: list[float],
+        top: int,
+    ) -> list[Item]:
+        """
+        Run the vector and full-text legs of a hybrid search on two connections at the same time,
+        then fuse the rankings with reciprocal rank fusion and fetch the top rows in one statement.
+        """
+        vector_ids, fulltext_ids = await asyncio.gather(
+            self.fetch_ranked_ids(vector_query, {"embedding": np.array(query_vector)}, uses_vector_index=True),
+            self.fetch_ranked_ids(fulltext_query, {"query": query_text}),
+        )
+        ids = reciprocal_rank_fusion([vector_ids, fulltext_ids], k=60)[:top]
+        if not ids:
+            return []
+        async with self.session_lock:
+            results = await self.db_session.scalars(
+                select(Item)
+                .options(load_only(*[getattr(Item, column.name) for column in ITEM_PUBLIC_COLUMNS]))
+                .where(Item.id.in_(ids))
+            )
+            items_by_id = {item.id: item for item in results}
+        return [items_by_id[id] for id in ids if id in items_by_id]
+
+    async def fetch_page_contents(self, page_ids: list[int]) -> dict[int, str]:
+        """Fetch the full text of pages, to expand the context around the chunks found by a search."""
+        async with self.session_lock:
+            rows = await self.db_session.execute(select(Page.id, Page.content).where(Page.id.in_(page_ids)))
+            return {row.id: row.content for row in rows}
+
+    async def compute_query_embedding(self, query_text: str) -> list[float]:
+        return await compute_text_embedding(
+            query_text,
+            self.openai_embed_client,
+            self.embed_model,
+            self.embed_deployment,
+            self.embed_dimensions,
+            cache=self.embed_cache,
+            batcher=self.embed_batcher,
+        )
 
     async def search_and_embed(
         self,
@@ -117,13 +274,7 @@ class PostgresSearcher:
         """
         vector: list[float] = []
         if enable_vector_search and query_text is not None:
-            vector = await compute_text_embedding(
-                query_text,
-                self.openai_embed_client,
-                self.embed_model,
-                self.embed_deployment,
-                self.embed_dimensions,
-            )
+            vector = await self.compute_query_embedding(query_text)
         if not enable_text_search:
             query_text = None
 
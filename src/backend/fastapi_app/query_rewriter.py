@@ -1,9 +1,11 @@
 import json
+import re
 
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionToolParam,
 )
+from openai.types.responses import ResponseInputItemParam
 
 
 def build_search_function() -> list[ChatCompletionToolParam]:
@@ -49,3 +51,31 @@ def extract_search_arguments(original_user_query: str, chat_completion: ChatComp
     elif query_text := response_message.content:
         search_query = query_text.strip()
     return search_query, filters
+
+
+def queries_match(query: str, other_query: str, threshold: float = 0.9) -> bool:
+    """
+    Whether two search queries are identical or near-identical,
+    judged by the overlap of their case-folded word sets.
+    """
+    words = set(re.findall(r"\w+", query.casefold()))
+    other_words = set(re.findall(r"\w+", other_query.casefold()))
+    if not words or not other_words:
+        return words == other_words
+    return len(words & other_words) / len(words | other_words) >= threshold
+
+
+def needs_query_rewrite(
+    original_user_query: str, past_messages: list[ResponseInputItemParam], max_words: int = 24
+) -> tuple[bool, str]:
+    """
+    Decide whether the user query has to be rewritten by the LLM before searching.
+    Returns the decision and the reason for it.
+    """
+    if past_messages:
+        return True, "The conversation history must be resolved into a standalone search query."
+    if any(ord(char) > 127 for char in original_user_query if char.isalpha()):
+        return True, "The query may not be in English and may need to be translated."
+    if len(original_user_query.split()) > max_words:
+        return True, f"The query is longer than {max_words} words and needs to be condensed."
+    return False, "Single-turn query without conversation history, so it was used as the search query."
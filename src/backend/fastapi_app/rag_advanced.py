@@ -1,18 +1,17 @@
+import asyncio
 import json
 from collections.abc import AsyncGenerator
-from typing import Optional, Union
+from typing import Any, Optional, Union
 
 from agents import (
-    Agent,
     ItemHelpers,
-    ModelSettings,
-    OpenAIChatCompletionsModel,
+    RunContextWrapper,
     Runner,
     ToolCallOutputItem,
+    TResponseInputItem,
     function_tool,
     set_tracing_disabled,
 )
-from openai import AsyncAzureOpenAI, AsyncOpenAI
 from openai.types.responses import EasyInputMessageParam, ResponseInputItemParam, ResponseTextDeltaEvent
 
 from fastapi_app.api_models import (
@@ -27,8 +26,11 @@ from fastapi_app.api_models import (
     SearchResults,
     ThoughtStep,
 )
-from fastapi_app.postgres_searcher import PostgresSearcher
-from fastapi_app.rag_base import RAGChatBase
+from fastapi_app.chat_history import DEFAULT_VERBATIM_TURNS, ChatHistory
+from fastapi_app.context_builder import DEFAULT_INPUT_TOKEN_BUDGET, ContextBuilder
+from fastapi_app.postgres_searcher import PostgresSearcher, reciprocal_rank_fusion
+from fastapi_app.query_rewriter import needs_query_rewrite, queries_match
+from fastapi_app.rag_base import RAGAgents, RAGChatBase
 
 set_tracing_disabled(disabled=True)
 
@@ -43,36 +45,21 @@ class AdvancedRAGChat(RAGChatBase):
         messages: list[ResponseInputItemParam],
         overrides: ChatRequestOverrides,
         searcher: PostgresSearcher,
-        openai_chat_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
-        chat_model: str,
-        chat_deployment: Optional[str],  # Not needed for non-Azure OpenAI
+        agents: RAGAgents,
+        input_token_budget: int = DEFAULT_INPUT_TOKEN_BUDGET,
+        session_state: Any = None,
+        history_verbatim_turns: int = DEFAULT_VERBATIM_TURNS,
     ):
         super().__init__()
         self.searcher = searcher
-        self.chat_params = self.get_chat_params(messages, overrides)
-        self.model_for_thoughts = (
-            {"model": chat_model, "deployment": chat_deployment} if chat_deployment else {"model": chat_model}
-        )
-        openai_agents_model = OpenAIChatCompletionsModel(
-            model=chat_model if chat_deployment is None else chat_deployment, openai_client=openai_chat_client
-        )
-        self.search_agent = Agent(
-            name="Searcher",
-            instructions=self.query_prompt_template,
-            tools=[function_tool(self.search_database)],
-            tool_use_behavior="stop_on_first_tool",
-            model=openai_agents_model,
-        )
-        self.answer_agent = Agent(
-            name="Answerer",
-            instructions=self.answer_prompt_template,
-            model=openai_agents_model,
-            model_settings=ModelSettings(
-                temperature=self.chat_params.temperature,
-                max_tokens=self.chat_params.response_token_limit,
-                extra_body={"seed": self.chat_params.seed} if self.chat_params.seed is not None else {},
-            ),
-        )
+        self.chat_params = self.get_chat_params(messages, overrides, input_token_budget)
+        self.context_builder = ContextBuilder(agents.chat_model)
+        self.chat_history = ChatHistory(messages[:-1], session_state, history_verbatim_turns)
+        self.speculative_search: Optional[asyncio.Task[SearchResults]] = None
+        self.model_for_thoughts = agents.model_for_thoughts
+        self.search_agent = agents.search_agent
+        self.answer_agent = agents.answer_agent
+        self.summary_agent = agents.summary_agent
 
     
 
@@ -82,6 +69,15 @@ class AdvancedRAGChat(RAGChatBase):
         search_query: str,
     ) -> SearchResults:
         """Search PostgreSQL database with error handling"""
+        if self.speculative_search is not None and queries_match(search_query, self.chat_params.original_user_query):
+            # The rewritten query is (near-)identical to the original, so reuse the search already in flight
+            return await self.speculative_search
+        return await self.run_search(search_query)
+
+    async def run_search(
+        self,
+        search_query: str,
+    ) -> SearchResults:
         print(f"DEBUG - Searching with query: {search_query}")
         
         filters: list[Filter] = []
@@ -119,13 +115,27 @@ class AdvancedRAGChat(RAGChatBase):
             return SearchResults(query=search_query, items=[], filters=filters)
 
     async def prepare_context(self) -> tuple[list[ItemPublic], list[ThoughtStep]]:
+        if self.chat_params.skip_single_turn_rewrite:
+            rewrite_needed, reason = needs_query_rewrite(
+                self.chat_params.original_user_query, self.chat_params.past_messages
+            )
+            if not rewrite_needed:
+                return await self.prepare_context_without_rewrite(reason)
+
         few_shots: list[ResponseInputItemParam] = json.loads(self.query_fewshots)
         user_query = f"Find search results for user query: {self.chat_params.original_user_query}"
         new_user_message = EasyInputMessageParam(role="user", content=user_query)
-        all_messages = few_shots + self.chat_params.past_messages + [new_user_message]
+        all_messages = few_shots + self.fit_past_messages() + [new_user_message]
 
+        if self.chat_params.speculative_retrieval:
+            # Search on the original query while the LLM rewrites it
+            self.speculative_search = asyncio.create_task(self.run_search(self.chat_params.original_user_query))
+
+        # Shown in the thoughts, with the input the agent actually got if the run succeeded
+        search_agent_input: Union[str, list[TResponseInputItem]] = all_messages
         try:
-            run_results = await Runner.run(self.search_agent, input=all_messages)
+            run_results = await Runner.run(self.search_agent, input=all_messages, context=self)
+            search_agent_input = run_results.input
             most_recent_response = run_results.new_items[-1]
             
             if not isinstance(most_recent_response, ToolCallOutputItem):
@@ -158,11 +168,28 @@ class AdvancedRAGChat(RAGChatBase):
                 filters=[]
             )
 
+        speculative_thoughts = []
+        if self.speculative_search is not None:
+            speculative_results = await self.speculative_search
+            reused = queries_match(search_results.query, self.chat_params.original_user_query)
+            if reused:
+                search_results = speculative_results
+            else:
+                search_results = self.merge_search_results(speculative_results, search_results)
+            speculative_thoughts.append(
+                ThoughtStep(
+                    title="Speculative search using original user query",
+                    description=speculative_results.query,
+                    props={"reused": reused, "merged": not reused},
+                )
+            )
+
+        search_results.items = await self.expand_to_pages(search_results.items)
         thoughts = [
             ThoughtStep(
                 title="Prompt to generate search arguments",
                 description=[{"content": self.query_prompt_template}]
-                + ItemHelpers.input_to_new_input_list(run_results.input),
+                + ItemHelpers.input_to_new_input_list(search_agent_input),
                 props=self.model_for_thoughts,
             ),
             ThoughtStep(
@@ -175,6 +202,34 @@ class AdvancedRAGChat(RAGChatBase):
                     "filters": search_results.filters,
                 },
             ),
+        ]
+        thoughts += speculative_thoughts + [
+            ThoughtStep(
+                title="Search results",
+                description=search_results.items,
+            ),
+        ]
+        return search_results.items, thoughts
+
+    async def prepare_context_without_rewrite(self, reason: str) -> tuple[list[ItemPublic], list[ThoughtStep]]:
+        """Search directly with the original user query, skipping the Searcher agent's LLM call."""
+        search_results = await self.run_search(self.chat_params.original_user_query)
+        search_results.items = await self.expand_to_pages(search_results.items)
+        thoughts = [
+            ThoughtStep(
+                title="Skipped query rewrite",
+                description=reason,
+            ),
+            ThoughtStep(
+                title="Search using original user query",
+                description=search_results.query,
+                props={
+                    "top": self.chat_params.top,
+                    "vector_search": self.chat_params.enable_vector_search,
+                    "text_search": self.chat_params.enable_text_search,
+                    "filters": search_results.filters,
+                },
+            ),
             ThoughtStep(
                 title="Search results",
                 description=search_results.items,
@@ -182,6 +237,18 @@ class AdvancedRAGChat(RAGChatBase):
         ]
         return search_results.items, thoughts
 
+    def merge_search_results(self, results: SearchResults, other_results: SearchResults) -> SearchResults:
+        """Merge two result lists with reciprocal rank fusion, keeping the query and filters of other_results."""
+        items_by_id = {item.id: item for item in results.items + other_results.items}
+        fused_ids = reciprocal_rank_fusion(
+            [[item.id for item in results.items], [item.id for item in other_results.items]]
+        )
+        return SearchResults(
+            query=other_results.query,
+            items=[items_by_id[id] for id in fused_ids[: self.chat_params.top]],
+            filters=other_results.filters,
+        )
+
  
 
     async def answer(
@@ -189,10 +256,11 @@ class AdvancedRAGChat(RAGChatBase):
         items: list[ItemPublic],
         earlier_thoughts: list[ThoughtStep],
     ) -> RetrievalResponse:
+        self.start_history_summary()
         run_results = await Runner.run(
             self.answer_agent,
-            input=self.chat_params.past_messages
-            + [{"content": self.prepare_rag_request(self.chat_params.original_user_query, items), "role": "user"}],
+            input=self.build_answer_input(items),
+            run_config=self.get_answer_run_config(),
         )
 
         return RetrievalResponse(
@@ -209,6 +277,7 @@ class AdvancedRAGChat(RAGChatBase):
                     ),
                 ],
             ),
+            sessionState=await self.get_session_state(),
         )
 
     async def answer_stream(
@@ -216,10 +285,11 @@ class AdvancedRAGChat(RAGChatBase):
         items: list[ItemPublic],
         earlier_thoughts: list[ThoughtStep],
     ) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        self.start_history_summary()
         run_results = Runner.run_streamed(
             self.answer_agent,
-            input=self.chat_params.past_messages
-            + [{"content": self.prepare_rag_request(self.chat_params.original_user_query, items), "role": "user"}],
+            input=self.build_answer_input(items),
+            run_config=self.get_answer_run_config(),
         )
 
         yield RetrievalResponseDelta(
@@ -240,4 +310,13 @@ class AdvancedRAGChat(RAGChatBase):
         async for event in run_results.stream_events():
             if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
                 yield RetrievalResponseDelta(delta=Message(content=str(event.data.delta), role=AIChatRoles.ASSISTANT))
-        return
\ No newline at end of file
+
+        yield RetrievalResponseDelta(sessionState=await self.get_session_state())
+        return
+
+
+@function_tool
+async def search_database(context: RunContextWrapper[AdvancedRAGChat], search_query: str) -> SearchResults:
+    """Search PostgreSQL database with error handling"""
+    # The Searcher agent is shared by all requests, so the request's flow is passed as the run context
+    return await context.context.search_database(search_query)
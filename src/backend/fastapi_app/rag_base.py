@@ -1,7 +1,11 @@
+import asyncio
+import logging
 import pathlib
 from abc import ABC, abstractmethod
 from collections.abc import AsyncGenerator
+from typing import Any, Optional
 
+from agents import Agent, ModelSettings, RunConfig, Runner
 from openai.types.responses import ResponseInputItemParam
 
 from fastapi_app.api_models import (
@@ -12,13 +16,59 @@ from fastapi_app.api_models import (
     RetrievalResponseDelta,
     ThoughtStep,
 )
+from fastapi_app.chat_history import ChatHistory, format_messages_for_summary
+from fastapi_app.context_builder import DEFAULT_INPUT_TOKEN_BUDGET, MESSAGE_OVERHEAD_TOKENS, ContextBuilder
+from fastapi_app.postgres_searcher import PostgresSearcher
+
+logger = logging.getLogger("ragapp")
+
+# Maximum length of the rolling summary of a chat session's earlier turns
+SUMMARY_TOKEN_LIMIT = 400
+
+
+class RAGAgents:
+    """
+    The agents of the RAG flows. They hold no per-request state, so they are created once per process
+    and shared by all requests, see RAGFlowFactory. Per-request model settings are passed with a RunConfig.
+    """
+
+    def __init__(
+        self,
+        *,
+        chat_model: str,
+        chat_deployment: Optional[str],
+        answer_agent: Agent[Any],
+        summary_agent: Agent[Any],
+        search_agent: Agent[Any],
+    ):
+        self.chat_model = chat_model
+        self.chat_deployment = chat_deployment
+        self.answer_agent = answer_agent
+        self.summary_agent = summary_agent
+        self.search_agent = search_agent
+        self.model_for_thoughts = (
+            {"model": chat_model, "deployment": chat_deployment} if chat_deployment else {"model": chat_model}
+        )
 
 
 class RAGChatBase(ABC):
     prompts_dir = pathlib.Path(__file__).parent / "prompts/"
     answer_prompt_template = open(prompts_dir / "answer.txt").read()
+    summary_prompt_template = open(prompts_dir / "summarize.txt").read()
+    searcher: PostgresSearcher
+    chat_params: ChatParams
+    context_builder: ContextBuilder
+    chat_history: ChatHistory
+    answer_agent: Agent[Any]
+    summary_agent: Agent[Any]
+    history_summary_task: Optional[asyncio.Task[Any]] = None
 
-    def get_chat_params(self, messages: list[ResponseInputItemParam], overrides: ChatRequestOverrides) -> ChatParams:
+    def get_chat_params(
+        self,
+        messages: list[ResponseInputItemParam],
+        overrides: ChatRequestOverrides,
+        input_token_budget: int = DEFAULT_INPUT_TOKEN_BUDGET,
+    ) -> ChatParams:
         response_token_limit = 1024
         prompt_template = overrides.prompt_template or self.answer_prompt_template
 
@@ -35,7 +85,14 @@ class RAGChatBase(ABC):
             seed=overrides.seed,
             retrieval_mode=overrides.retrieval_mode,
             use_advanced_flow=overrides.use_advanced_flow,
+            speculative_retrieval=overrides.speculative_retrieval,
+            skip_single_turn_rewrite=overrides.skip_single_turn_rewrite,
+            hnsw_ef_search=overrides.hnsw_ef_search,
+            hnsw_iterative_scan=overrides.hnsw_iterative_scan,
+            hnsw_max_scan_tuples=overrides.hnsw_max_scan_tuples,
+            expand_top_pages=overrides.expand_top_pages,
             response_token_limit=response_token_limit,
+            input_token_budget=input_token_budget,
             prompt_template=prompt_template,
             enable_text_search=enable_text_search,
             enable_vector_search=enable_vector_search,
@@ -47,9 +104,90 @@ class RAGChatBase(ABC):
     async def prepare_context(self) -> tuple[list[ItemPublic], list[ThoughtStep]]:
         raise NotImplementedError
 
-    def prepare_rag_request(self, user_query, items: list[ItemPublic]) -> str:
-        sources_str = "\n".join([f"[{item.id}]:{item.to_str_for_rag()}" for item in items])
-        return f"{user_query}Sources:\n{sources_str}"
+    async def expand_to_pages(self, items: list[ItemPublic]) -> list[ItemPublic]:
+        """
+        Replace the chunk text of the top expand_top_pages items with the full text of their page,
+        and drop lower-ranked chunks of those pages, since their text is already included.
+        """
+        limit = self.chat_params.expand_top_pages
+        page_ids = [item.page_id for item in items[:limit] if item.page_id is not None]
+        if not page_ids:
+            return items
+        pages = await self.searcher.fetch_page_contents(page_ids)
+        expanded_items = []
+        expanded_page_ids = set()
+        for rank, item in enumerate(items):
+            if item.page_id in expanded_page_ids:
+                continue
+            if rank < limit and item.page_id in pages:
+                expanded_page_ids.add(item.page_id)
+                item = item.model_copy(update={"content": pages[item.page_id]})
+            expanded_items.append(item)
+        return expanded_items
+
+    def get_available_tokens(self) -> int:
+        """Tokens of the input budget that are left after the instructions and the user query"""
+        return (
+            self.chat_params.input_token_budget
+            - self.context_builder.count_tokens(self.answer_prompt_template)
+            - self.context_builder.count_tokens(self.chat_params.original_user_query)
+            - 2 * MESSAGE_OVERHEAD_TOKENS
+        )
+
+    def fit_past_messages(self) -> list[ResponseInputItemParam]:
+        """The most recent past messages that fit into the history share of the input budget"""
+        history_budget = int(self.get_available_tokens() * self.context_builder.history_share)
+        return self.context_builder.fit_history(self.chat_history.get_messages(), history_budget)
+
+    def prepare_rag_request(self, user_query, items: list[ItemPublic], token_budget: Optional[int] = None) -> str:
+        sources_str, _ = self.context_builder.format_sources(items, token_budget)
+        return f"{user_query}\n\nSources:\n{sources_str}"
+
+    def build_answer_input(self, items: list[ItemPublic]) -> list[ResponseInputItemParam]:
+        """
+        Build the input of the answer agent: the past messages, then the user query with the sources,
+        with the sources filling whatever the history leaves of the input budget.
+        """
+        past_messages = self.fit_past_messages()
+        sources_budget = self.get_available_tokens() - self.context_builder.count_message_tokens(past_messages)
+        rag_request = self.prepare_rag_request(self.chat_params.original_user_query, items, sources_budget)
+        return past_messages + [{"content": rag_request, "role": "user"}]
+
+    def get_answer_run_config(self) -> RunConfig:
+        """The request's settings for the answer agent, which is shared by all requests"""
+        return RunConfig(
+            model_settings=ModelSettings(
+                temperature=self.chat_params.temperature,
+                max_tokens=self.chat_params.response_token_limit,
+                extra_body={"seed": self.chat_params.seed} if self.chat_params.seed is not None else {},
+            )
+        )
+
+    def start_history_summary(self) -> None:
+        """
+        Start summarizing the turns that move out of the verbatim window with the next request,
+        while the answer is generated, so that the summary is ready for the response's sessionState.
+        """
+        messages = self.chat_history.get_messages_to_summarize()
+        if messages:
+            self.history_summary_task = asyncio.create_task(self.summarize_history(messages))
+
+    async def summarize_history(self, messages: list[ResponseInputItemParam]) -> Any:
+        previous_summary = self.chat_history.summary.summary if self.chat_history.summary else None
+        run_results = await Runner.run(
+            self.summary_agent, input=format_messages_for_summary(previous_summary, messages)
+        )
+        return self.chat_history.update_session_state(str(run_results.final_output), messages)
+
+    async def get_session_state(self) -> Any:
+        """The sessionState for the response, with the updated summary if it could be made"""
+        if self.history_summary_task is None:
+            return self.chat_history.session_state
+        try:
+            return await self.history_summary_task
+        except Exception as e:
+            logger.warning("Failed to summarize the chat history: %s", e)
+            return self.chat_history.session_state
 
     @abstractmethod
     async def answer(
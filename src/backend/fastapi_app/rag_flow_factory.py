@@ -0,0 +1,77 @@
+from typing import Optional, Union
+
+from agents import Agent, ModelSettings, OpenAIChatCompletionsModel
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+
+from fastapi_app.api_models import ChatRequest
+from fastapi_app.chat_history import DEFAULT_VERBATIM_TURNS
+from fastapi_app.context_builder import DEFAULT_INPUT_TOKEN_BUDGET
+from fastapi_app.postgres_searcher import PostgresSearcher
+from fastapi_app.rag_advanced import AdvancedRAGChat, search_database
+from fastapi_app.rag_base import SUMMARY_TOKEN_LIMIT, RAGAgents, RAGChatBase
+from fastapi_app.rag_simple import SimpleRAGChat
+
+
+def create_rag_agents(
+    openai_chat_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
+    chat_model: str,
+    chat_deployment: Optional[str],  # Not needed for non-Azure OpenAI
+) -> RAGAgents:
+    openai_agents_model = OpenAIChatCompletionsModel(
+        model=chat_model if chat_deployment is None else chat_deployment, openai_client=openai_chat_client
+    )
+    return RAGAgents(
+        chat_model=chat_model,
+        chat_deployment=chat_deployment,
+        answer_agent=Agent(
+            name="Answerer",
+            instructions=RAGChatBase.answer_prompt_template,
+            model=openai_agents_model,
+        ),
+        summary_agent=Agent(
+            name="Summarizer",
+            instructions=RAGChatBase.summary_prompt_template,
+            model=openai_agents_model,
+            model_settings=ModelSettings(temperature=0, max_tokens=SUMMARY_TOKEN_LIMIT),
+        ),
+        search_agent=Agent(
+            name="Searcher",
+            instructions=AdvancedRAGChat.query_prompt_template,
+            tools=[search_database],
+            tool_use_behavior="stop_on_first_tool",
+            model=openai_agents_model,
+        ),
+    )
+
+
+class RAGFlowFactory:
+    """
+    Creates the RAG flow for each chat request. The model, the agents and the search tool's schema
+    are built once per process, so a request only binds its own searcher and parameters to them.
+    """
+
+    def __init__(
+        self,
+        openai_chat_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
+        chat_model: str,
+        chat_deployment: Optional[str],
+        input_token_budget: int = DEFAULT_INPUT_TOKEN_BUDGET,
+        history_verbatim_turns: int = DEFAULT_VERBATIM_TURNS,
+    ):
+        self.agents = create_rag_agents(openai_chat_client, chat_model, chat_deployment)
+        self.input_token_budget = input_token_budget
+        self.history_verbatim_turns = history_verbatim_turns
+
+    def create_flow(
+        self, chat_request: ChatRequest, searcher: PostgresSearcher
+    ) -> Union[SimpleRAGChat, AdvancedRAGChat]:
+        flow_class = AdvancedRAGChat if chat_request.context.overrides.use_advanced_flow else SimpleRAGChat
+        return flow_class(
+            messages=chat_request.messages,
+            overrides=chat_request.context.overrides,
+            searcher=searcher,
+            agents=self.agents,
+            input_token_budget=self.input_token_budget,
+            session_state=chat_request.sessionState,
+            history_verbatim_turns=self.history_verbatim_turns,
+        )
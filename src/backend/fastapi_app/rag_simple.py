@@ -1,8 +1,7 @@
 from collections.abc import AsyncGenerator
-from typing import Optional, Union
+from typing import Any
 
-from agents import Agent, ItemHelpers, ModelSettings, OpenAIChatCompletionsModel, Runner, set_tracing_disabled
-from openai import AsyncAzureOpenAI, AsyncOpenAI
+from agents import ItemHelpers, Runner, set_tracing_disabled
 from openai.types.responses import ResponseInputItemParam, ResponseTextDeltaEvent
 
 from fastapi_app.api_models import (
@@ -15,8 +14,10 @@ from fastapi_app.api_models import (
     RetrievalResponseDelta,
     ThoughtStep,
 )
+from fastapi_app.chat_history import DEFAULT_VERBATIM_TURNS, ChatHistory
+from fastapi_app.context_builder import DEFAULT_INPUT_TOKEN_BUDGET, ContextBuilder
 from fastapi_app.postgres_searcher import PostgresSearcher
-from fastapi_app.rag_base import RAGChatBase
+from fastapi_app.rag_base import RAGAgents, RAGChatBase
 
 set_tracing_disabled(disabled=True)
 
@@ -28,28 +29,18 @@ class SimpleRAGChat(RAGChatBase):
         messages: list[ResponseInputItemParam],
         overrides: ChatRequestOverrides,
         searcher: PostgresSearcher,
-        openai_chat_client: Union[AsyncOpenAI, AsyncAzureOpenAI],
-        chat_model: str,
-        chat_deployment: Optional[str],  # Not needed for non-Azure OpenAI
+        agents: RAGAgents,
+        input_token_budget: int = DEFAULT_INPUT_TOKEN_BUDGET,
+        session_state: Any = None,
+        history_verbatim_turns: int = DEFAULT_VERBATIM_TURNS,
     ):
         self.searcher = searcher
-        self.chat_params = self.get_chat_params(messages, overrides)
-        self.model_for_thoughts = (
-            {"model": chat_model, "deployment": chat_deployment} if chat_deployment else {"model": chat_model}
-        )
-        openai_agents_model = OpenAIChatCompletionsModel(
-            model=chat_model if chat_deployment is None else chat_deployment, openai_client=openai_chat_client
-        )
-        self.answer_agent = Agent(
-            name="Answerer",
-            instructions=self.answer_prompt_template,
-            model=openai_agents_model,
-            model_settings=ModelSettings(
-                temperature=self.chat_params.temperature,
-                max_tokens=self.chat_params.response_token_limit,
-                extra_body={"seed": self.chat_params.seed} if self.chat_params.seed is not None else {},
-            ),
-        )
+        self.chat_params = self.get_chat_params(messages, overrides, input_token_budget)
+        self.context_builder = ContextBuilder(agents.chat_model)
+        self.chat_history = ChatHistory(messages[:-1], session_state, history_verbatim_turns)
+        self.model_for_thoughts = agents.model_for_thoughts
+        self.answer_agent = agents.answer_agent
+        self.summary_agent = agents.summary_agent
 
     async def prepare_context(self) -> tuple[list[ItemPublic], list[ThoughtStep]]:
         """Retrieve relevant rows from the database and build a context for the chat model."""
@@ -60,7 +51,7 @@ class SimpleRAGChat(RAGChatBase):
             enable_vector_search=self.chat_params.enable_vector_search,
             enable_text_search=self.chat_params.enable_text_search,
         )
-        items = [ItemPublic.model_validate(item.to_dict()) for item in results]
+        items = await self.expand_to_pages([ItemPublic.model_validate(item.to_dict()) for item in results])
 
         thoughts = [
             ThoughtStep(
@@ -84,10 +75,11 @@ class SimpleRAGChat(RAGChatBase):
         items: list[ItemPublic],
         earlier_thoughts: list[ThoughtStep],
     ) -> RetrievalResponse:
+        self.start_history_summary()
         run_results = await Runner.run(
             self.answer_agent,
-            input=self.chat_params.past_messages
-            + [{"content": self.prepare_rag_request(self.chat_params.original_user_query, items), "role": "user"}],
+            input=self.build_answer_input(items),
+            run_config=self.get_answer_run_config(),
         )
 
         return RetrievalResponse(
@@ -104,6 +96,7 @@ class SimpleRAGChat(RAGChatBase):
                     ),
                 ],
             ),
+            sessionState=await self.get_session_state(),
         )
 
     async def answer_stream(
@@ -111,10 +104,11 @@ class SimpleRAGChat(RAGChatBase):
         items: list[ItemPublic],
         earlier_thoughts: list[ThoughtStep],
     ) -> AsyncGenerator[RetrievalResponseDelta, None]:
+        self.start_history_summary()
         run_results = Runner.run_streamed(
             self.answer_agent,
-            input=self.chat_params.past_messages
-            + [{"content": self.prepare_rag_request(self.chat_params.original_user_query, items), "role": "user"}],
+            input=self.build_answer_input(items),
+            run_config=self.get_answer_run_config(),
         )
 
         yield RetrievalResponseDelta(
@@ -135,4 +129,6 @@ class SimpleRAGChat(RAGChatBase):
         async for event in run_results.stream_events():
             if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
                 yield RetrievalResponseDelta(delta=Message(content=str(event.data.delta), role=AIChatRoles.ASSISTANT))
+
+        yield RetrievalResponseDelta(sessionState=await self.get_session_state())
         return
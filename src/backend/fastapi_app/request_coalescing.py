@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections.abc import AsyncGenerator, Callable, Coroutine
+from typing import Any, Generic, Optional, TypeVar
+
+from fastapi_app.api_models import ChatRequest
+from fastapi_app.context_builder import get_message_text
+
+logger = logging.getLogger("ragapp")
+
+T = TypeVar("T")
+
+
+def make_request_key(chat_request: ChatRequest) -> str:
+    """
+    Key of a chat request for coalescing: the messages with case and whitespace normalized,
+    the overrides and the session state, since they all shape the answer.
+    """
+    messages = [
+        [message.get("role"), " ".join(get_message_text(message).split()).casefold()]
+        for message in chat_request.messages
+    ]
+    serialized = json.dumps(
+        {
+            "messages": messages,
+            "overrides": chat_request.context.overrides.model_dump(mode="json"),
+            "session_state": chat_request.sessionState,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class StreamBroadcaster(Generic[T]):
+    """
+    Consumes a stream once, and lets any number of subscribers iterate over all of its events,
+    including the ones that were produced before they subscribed.
+    """
+
+    def __init__(self, stream: AsyncGenerator[T, None]):
+        self.events: list[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Condition()
+        self.task = asyncio.create_task(self._consume(stream))
+
+    async def _consume(self, stream: AsyncGenerator[T, None]) -> None:
+        try:
+            async for event in stream:
+                async with self._changed:
+                    self.events.append(event)
+                    self._changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncGenerator[T, None]:
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: position < len(self.events) or self.done)
+                events = self.events[position:]
+                done = self.done
+            position += len(events)
+            for event in events:
+                yield event
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class RequestCoalescer:
+    """
+    Single flight for chat requests: concurrent requests with the same key share one run of the pipeline,
+    so that a burst of identical questions costs a single search and a single answer.
+    Pipelines run in their own task, so a client that disconnects doesn't cancel the run for the others.
+    """
+
+    def __init__(self):
+        self._runs: dict[str, asyncio.Task[Any]] = {}
+        self._streams: dict[str, asyncio.Task[Any]] = {}
+
+    @staticmethod
+    def _forget(tasks: dict[str, asyncio.Task[Any]], key: str, task: asyncio.Task[Any]) -> None:
+        if tasks.get(key) is task:
+            del tasks[key]
+
+    @staticmethod
+    def _retrieve_exception(task: asyncio.Task[Any]) -> Optional[BaseException]:
+        """Retrieve the exception of a task, which may have no waiters left if their requests were cancelled"""
+        return asyncio.CancelledError() if task.cancelled() else task.exception()
+
+    async def run(self, key: str, pipeline: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        """Run the pipeline, or wait for the run of a concurrent request with the same key."""
+        task = self._runs.get(key)
+        if task is None:
+            task = asyncio.create_task(pipeline())
+            self._runs[key] = task
+
+            def on_done(task: asyncio.Task[Any]) -> None:
+                self._retrieve_exception(task)
+                self._forget(self._runs, key, task)
+
+            task.add_done_callback(on_done)
+        else:
+            logger.info("Coalescing a chat request with an identical one in flight")
+        return await asyncio.shield(task)
+
+    async def _start_broadcast(
+        self, prepare: Callable[[], Coroutine[Any, Any, AsyncGenerator[T, None]]]
+    ) -> StreamBroadcaster[T]:
+        return StreamBroadcaster(await prepare())
+
+    async def stream(
+        self, key: str, prepare: Callable[[], Coroutine[Any, Any, AsyncGenerator[T, None]]]
+    ) -> AsyncGenerator[T, None]:
+        """
+        Prepare a stream and broadcast it, or subscribe to the stream of a concurrent request with the same key.
+        Returns once the stream is prepared, so that errors while preparing it are raised here.
+        Requests join the stream until it ends, and get all of its events from the start.
+        """
+        task = self._streams.get(key)
+        if task is None:
+            task = asyncio.create_task(self._start_broadcast(prepare))
+            self._streams[key] = task
+
+            def on_prepared(task: asyncio.Task[Any]) -> None:
+                if self._retrieve_exception(task) is not None:
+                    self._forget(self._streams, key, task)
+                else:
+                    task.result().task.add_done_callback(lambda _: self._forget(self._streams, key, task))
+
+            task.add_done_callback(on_prepared)
+        else:
+            logger.info("Coalescing a chat stream with an identical one in flight")
+        broadcaster: StreamBroadcaster[T] = await asyncio.shield(task)
+        return broadcaster.subscribe()
+
+
+async def create_request_coalescer_from_env() -> Optional[RequestCoalescer]:
+    """
+    Create the request coalescer from environment variables.
+    Set CHAT_REQUEST_COALESCING_ENABLED to "false" to run every chat request separately.
+    """
+    if (os.getenv("CHAT_REQUEST_COALESCING_ENABLED") or "true").lower() != "true":
+        return None
+    return RequestCoalescer()
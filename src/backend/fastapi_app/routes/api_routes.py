@@ -1,7 +1,7 @@
 import json
 import logging
 from collections.abc import AsyncGenerator
-from typing import Union
+from typing import Optional, Union
 
 import fastapi
 from fastapi import HTTPException
@@ -11,17 +11,27 @@ from sqlalchemy import select, text
 
 from fastapi_app.api_models import (
     ChatRequest,
+    ChatRequestOverrides,
     ErrorResponse,
     ItemPublic,
     ItemWithDistance,
     RetrievalResponse,
     RetrievalResponseDelta,
 )
-from fastapi_app.dependencies import ChatClient, CommonDeps, DBSession, EmbeddingsClient
+from fastapi_app.dependencies import (
+    AnswersCache,
+    CommonDeps,
+    EmbeddingsBatcher,
+    EmbeddingsCache,
+    EmbeddingsClient,
+    RAGFlows,
+    ReadOnlyDBSession,
+    ReadOnlyDBSessionMaker,
+    RequestCoalescing,
+)
 from fastapi_app.postgres_models import Item
-from fastapi_app.postgres_searcher import PostgresSearcher
-from fastapi_app.rag_advanced import AdvancedRAGChat
-from fastapi_app.rag_simple import SimpleRAGChat
+from fastapi_app.postgres_searcher import ITEM_PUBLIC_COLUMNS, PostgresSearcher
+from fastapi_app.request_coalescing import make_request_key
 
 router = fastapi.APIRouter()
 
@@ -45,7 +55,7 @@ async def format_as_ndjson(r: AsyncGenerator[RetrievalResponseDelta, None]) -> A
 
 
 @router.get("/items/{id}", response_model=ItemPublic)
-async def item_handler(database_session: DBSession, id: int) -> ItemPublic:
+async def item_handler(database_session: ReadOnlyDBSession, id: int) -> ItemPublic:
     """A simple API to get an item by ID."""
     item = (await database_session.scalars(select(Item).where(Item.id == id))).first()
     if not item:
@@ -55,20 +65,25 @@ async def item_handler(database_session: DBSession, id: int) -> ItemPublic:
 
 @router.get("/similar", response_model=list[ItemWithDistance])
 async def similar_handler(
-    context: CommonDeps, database_session: DBSession, id: int, n: int = 5
+    context: CommonDeps, database_session: ReadOnlyDBSession, id: int, n: int = 5
 ) -> list[ItemWithDistance]:
     """A similarity API to find items similar to items with given ID."""
-    item = (await database_session.scalars(select(Item).where(Item.id == id))).first()
-    if not item:
+    item_id = (await database_session.scalars(select(Item.id).where(Item.id == id))).first()
+    if item_id is None:
         raise HTTPException(detail=f"Item with ID {id} not found.", status_code=404)
 
+    # The item's embedding is looked up in the same statement, so it is never transferred to the app,
+    # and only the public columns are returned (not the embeddings of other models)
+    embedding_column = context.embedding_column
+    public_columns = ", ".join(column.name for column in ITEM_PUBLIC_COLUMNS)
     closest = (
         await database_session.execute(
             text(
-                f"SELECT *, {context.embedding_column} <=> :embedding as DISTANCE FROM {Item.__tablename__} "
-                "WHERE id <> :item_id ORDER BY distance LIMIT :n"
+                f"SELECT {public_columns}, {embedding_column} <=> "
+                f"(SELECT {embedding_column} FROM {Item.__tablename__} WHERE id = :item_id) AS distance "
+                f"FROM {Item.__tablename__} WHERE id <> :item_id ORDER BY distance LIMIT :n"
             ),
-            {"embedding": getattr(item, context.embedding_column), "n": n, "item_id": id},
+            {"n": n, "item_id": id},
         )
     ).fetchall()
 
@@ -79,12 +94,16 @@ async def similar_handler(
 @router.get("/search", response_model=list[ItemPublic])
 async def search_handler(
     context: CommonDeps,
-    database_session: DBSession,
+    database_session: ReadOnlyDBSession,
+    database_sessionmaker: ReadOnlyDBSessionMaker,
     openai_embed: EmbeddingsClient,
+    embed_cache: EmbeddingsCache,
+    embed_batcher: EmbeddingsBatcher,
     query: str,
     top: int = 5,
     enable_vector_search: bool = True,
     enable_text_search: bool = True,
+    hnsw_ef_search: Optional[int] = fastapi.Query(default=None, gt=0),
 ) -> list[ItemPublic]:
     """A search API to find items based on a query."""
     searcher = PostgresSearcher(
@@ -94,6 +113,13 @@ async def search_handler(
         embed_model=context.openai_embed_model,
         embed_dimensions=context.openai_embed_dimensions,
         embedding_column=context.embedding_column,
+        embed_cache=embed_cache,
+        embed_batcher=embed_batcher,
+        sessionmaker=database_sessionmaker,
+        hybrid_search_mode=context.hybrid_search_mode,
+        hnsw_settings=context.get_hnsw_search_settings(ChatRequestOverrides(hnsw_ef_search=hnsw_ef_search)),
+        vector_index_mode=context.vector_index_mode,
+        binary_rerank_candidates=context.binary_rerank_candidates,
     )
     results = await searcher.search_and_embed(
         query, top=top, enable_vector_search=enable_vector_search, enable_text_search=enable_text_search
@@ -104,43 +130,61 @@ async def search_handler(
 @router.post("/chat", response_model=Union[RetrievalResponse, ErrorResponse])
 async def chat_handler(
     context: CommonDeps,
-    database_session: DBSession,
+    database_sessionmaker: ReadOnlyDBSessionMaker,
     openai_embed: EmbeddingsClient,
-    openai_chat: ChatClient,
+    embed_cache: EmbeddingsCache,
+    embed_batcher: EmbeddingsBatcher,
+    rag_flows: RAGFlows,
+    answer_cache: AnswersCache,
+    request_coalescer: RequestCoalescing,
     chat_request: ChatRequest,
 ):
-    try:
-        searcher = PostgresSearcher(
-            db_session=database_session,
-            openai_embed_client=openai_embed.client,
-            embed_deployment=context.openai_embed_deployment,
-            embed_model=context.openai_embed_model,
-            embed_dimensions=context.openai_embed_dimensions,
-            embedding_column=context.embedding_column,
-        )
-        rag_flow: Union[SimpleRAGChat, AdvancedRAGChat]
-        if chat_request.context.overrides.use_advanced_flow:
-            rag_flow = AdvancedRAGChat(
-                messages=chat_request.messages,
-                overrides=chat_request.context.overrides,
-                searcher=searcher,
-                openai_chat_client=openai_chat.client,
-                chat_model=context.openai_chat_model,
-                chat_deployment=context.openai_chat_deployment,
-            )
-        else:
-            rag_flow = SimpleRAGChat(
-                messages=chat_request.messages,
-                overrides=chat_request.context.overrides,
-                searcher=searcher,
-                openai_chat_client=openai_chat.client,
-                chat_model=context.openai_chat_model,
-                chat_deployment=context.openai_chat_deployment,
+    async def run_chat() -> RetrievalResponse:
+        # The session belongs to the run rather than the request, since coalesced requests share the run
+        async with database_sessionmaker() as database_session:
+            searcher = PostgresSearcher(
+                db_session=database_session,
+                openai_embed_client=openai_embed.client,
+                embed_deployment=context.openai_embed_deployment,
+                embed_model=context.openai_embed_model,
+                embed_dimensions=context.openai_embed_dimensions,
+                embedding_column=context.embedding_column,
+                embed_cache=embed_cache,
+                embed_batcher=embed_batcher,
+                sessionmaker=database_sessionmaker,
+                hybrid_search_mode=context.hybrid_search_mode,
+                hnsw_settings=context.get_hnsw_search_settings(chat_request.context.overrides),
+                vector_index_mode=context.vector_index_mode,
+                binary_rerank_candidates=context.binary_rerank_candidates,
             )
+            rag_flow = rag_flows.create_flow(chat_request, searcher)
 
-        items, thoughts = await rag_flow.prepare_context()
-        response = await rag_flow.answer(items=items, earlier_thoughts=thoughts)
-        return response
+            query_vector: list[float] = []
+            params_key = ""
+            if answer_cache is not None and answer_cache.is_cacheable(rag_flow.chat_params):
+                query_vector = await searcher.compute_query_embedding(rag_flow.chat_params.original_user_query)
+                params_key = answer_cache.make_params_key(
+                    rag_flow.chat_params,
+                    chat_model=context.openai_chat_model,
+                    embedding_column=searcher.embedding_column,
+                    hybrid_search_mode=searcher.hybrid_search_mode,
+                    hnsw_settings=searcher.hnsw_settings,
+                    vector_index_mode=searcher.vector_index_mode,
+                    binary_rerank_candidates=searcher.binary_rerank_candidates,
+                )
+                if cache_hit := await answer_cache.lookup(query_vector, params_key):
+                    return cache_hit.to_response(chat_request.sessionState)
+
+            items, thoughts = await rag_flow.prepare_context()
+            response = await rag_flow.answer(items=items, earlier_thoughts=thoughts)
+            if answer_cache is not None and query_vector:
+                await answer_cache.store(rag_flow.chat_params.original_user_query, query_vector, params_key, response)
+            return response
+
+    try:
+        if request_coalescer is None:
+            return await run_chat()
+        return await request_coalescer.run(make_request_key(chat_request), run_chat)
     except Exception as e:
         if isinstance(e, APIError) and e.code == "content_filter":
             return ERROR_FILTER
@@ -152,45 +196,66 @@ async def chat_handler(
 @router.post("/chat/stream")
 async def chat_stream_handler(
     context: CommonDeps,
-    database_session: DBSession,
+    database_sessionmaker: ReadOnlyDBSessionMaker,
     openai_embed: EmbeddingsClient,
-    openai_chat: ChatClient,
+    embed_cache: EmbeddingsCache,
+    embed_batcher: EmbeddingsBatcher,
+    rag_flows: RAGFlows,
+    answer_cache: AnswersCache,
+    request_coalescer: RequestCoalescing,
     chat_request: ChatRequest,
 ):
-    searcher = PostgresSearcher(
-        db_session=database_session,
-        openai_embed_client=openai_embed.client,
-        embed_deployment=context.openai_embed_deployment,
-        embed_model=context.openai_embed_model,
-        embed_dimensions=context.openai_embed_dimensions,
-        embedding_column=context.embedding_column,
-    )
+    async def prepare_stream() -> AsyncGenerator[RetrievalResponseDelta, None]:
+        # Intentionally do search before we stream down the answer, to avoid using database connections during stream
+        # See https://github.com/tiangolo/fastapi/discussions/11321
+        async with database_sessionmaker() as database_session:
+            searcher = PostgresSearcher(
+                db_session=database_session,
+                openai_embed_client=openai_embed.client,
+                embed_deployment=context.openai_embed_deployment,
+                embed_model=context.openai_embed_model,
+                embed_dimensions=context.openai_embed_dimensions,
+                embedding_column=context.embedding_column,
+                embed_cache=embed_cache,
+                embed_batcher=embed_batcher,
+                sessionmaker=database_sessionmaker,
+                hybrid_search_mode=context.hybrid_search_mode,
+                hnsw_settings=context.get_hnsw_search_settings(chat_request.context.overrides),
+                vector_index_mode=context.vector_index_mode,
+                binary_rerank_candidates=context.binary_rerank_candidates,
+            )
+            rag_flow = rag_flows.create_flow(chat_request, searcher)
 
-    rag_flow: Union[SimpleRAGChat, AdvancedRAGChat]
-    if chat_request.context.overrides.use_advanced_flow:
-        rag_flow = AdvancedRAGChat(
-            messages=chat_request.messages,
-            overrides=chat_request.context.overrides,
-            searcher=searcher,
-            openai_chat_client=openai_chat.client,
-            chat_model=context.openai_chat_model,
-            chat_deployment=context.openai_chat_deployment,
-        )
-    else:
-        rag_flow = SimpleRAGChat(
-            messages=chat_request.messages,
-            overrides=chat_request.context.overrides,
-            searcher=searcher,
-            openai_chat_client=openai_chat.client,
-            chat_model=context.openai_chat_model,
-            chat_deployment=context.openai_chat_deployment,
-        )
+            query_vector: list[float] = []
+            params_key = ""
+            if answer_cache is not None and answer_cache.is_cacheable(rag_flow.chat_params):
+                query_vector = await searcher.compute_query_embedding(rag_flow.chat_params.original_user_query)
+                params_key = answer_cache.make_params_key(
+                    rag_flow.chat_params,
+                    chat_model=context.openai_chat_model,
+                    embedding_column=searcher.embedding_column,
+                    hybrid_search_mode=searcher.hybrid_search_mode,
+                    hnsw_settings=searcher.hnsw_settings,
+                    vector_index_mode=searcher.vector_index_mode,
+                    binary_rerank_candidates=searcher.binary_rerank_candidates,
+                )
+                if cache_hit := await answer_cache.lookup(query_vector, params_key):
+                    return cache_hit.to_stream(chat_request.sessionState)
 
-    try:
-        # Intentionally do search we stream down the answer, to avoid using database connections during stream
-        # See https://github.com/tiangolo/fastapi/discussions/11321
-        items, thoughts = await rag_flow.prepare_context()
+            items, thoughts = await rag_flow.prepare_context()
         result = rag_flow.answer_stream(items, thoughts)
+        if answer_cache is not None and query_vector:
+            result = answer_cache.store_stream(
+                rag_flow.chat_params.original_user_query, query_vector, params_key, result
+            )
+        return result
+
+    try:
+        if request_coalescer is None:
+            result = await prepare_stream()
+        else:
+            # Identical requests in flight share the search and the answer, each getting the whole token stream
+            result = await request_coalescer.stream(make_request_key(chat_request), prepare_stream)
         return StreamingResponse(content=format_as_ndjson(result), media_type="application/x-ndjson")
     except Exception as e:
         if isinstance(e, APIError) and e.code == "content_filter":
@@ -0,0 +1,119 @@
+import base64
+import gzip
+import json
+import os
+from collections.abc import Iterator
+from typing import IO, Any, Optional
+
+import numpy as np
+from pgvector.sqlalchemy import Vector
+
+from fastapi_app.postgres_models import Item
+
+"""
+**Seed data file formats**
+
+- seed_data.jsonl / seed_data.jsonl.gz: one JSON record per line, optionally gzip-compressed,
+  with embeddings encoded as base64 of little-endian float32 values.
+  Files are written and read one record at a time, so memory use does not grow with the corpus.
+- seed_data.json: a single JSON array with embeddings as lists of floats, kept for compatibility.
+  It is still written incrementally, but has to be loaded into memory completely when read.
+
+The full text of each page is kept in a separate seed_pages file in the same formats,
+which is loaded before the items that reference the pages.
+"""
+
+SEED_FILE_NAMES = ["seed_data.jsonl.gz", "seed_data.jsonl", "seed_data.json"]
+PAGE_SEED_FILE_NAMES = ["seed_pages.jsonl.gz", "seed_pages.jsonl", "seed_pages.json"]
+
+EMBEDDING_COLUMNS = {column.name for column in Item.__table__.columns if isinstance(column.type, Vector)}
+
+
+def encode_embedding(embedding: Any) -> str:
+    return base64.b64encode(np.asarray(embedding, dtype="<f4").tobytes()).decode("ascii")
+
+
+def decode_embedding(value: Any) -> np.ndarray:
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+
+def is_jsonl(path: str) -> bool:
+    return path.endswith((".jsonl", ".jsonl.gz"))
+
+
+def open_text(path: str, write: bool = False, compressed: Optional[bool] = None) -> IO[str]:
+    if compressed if compressed is not None else path.endswith(".gz"):
+        if write:
+            return gzip.open(path, "wt", encoding="utf-8")
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "w" if write else "r", encoding="utf-8")
+
+
+def find_seed_file(directory: str, names: list[str] = SEED_FILE_NAMES) -> str:
+    """Find the seed data file in a directory, preferring the line-delimited formats."""
+    for name in names:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No seed data file ({', '.join(names)}) found in {directory}")
+
+
+def read_seed_records(path: str) -> Iterator[dict[str, Any]]:
+    """Read the records of a seed data file, with embeddings decoded to float32 arrays."""
+    with open_text(path) as f:
+        records: Any = (json.loads(line) for line in f if line.strip()) if is_jsonl(path) else json.load(f)
+        for record in records:
+            for key in EMBEDDING_COLUMNS.intersection(record):
+                if record[key] is not None:
+                    record[key] = decode_embedding(record[key])
+            yield record
+
+
+class SeedWriter:
+    """
+    Writes seed data records one at a time, in the format given by the file extension.
+    The file is written under a temporary name and only moved into place when closed without an error.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.count = 0
+        self._file: Optional[IO[str]] = None
+
+    def __enter__(self) -> "SeedWriter":
+        self._file = open_text(self.tmp_path, write=True, compressed=self.path.endswith(".gz"))
+        if not is_jsonl(self.path):
+            self._file.write("[")
+        return self
+
+    def write(self, record: dict[str, Any]) -> None:
+        if self._file is None:
+            raise RuntimeError("SeedWriter must be used as a context manager")
+        if is_jsonl(self.path):
+            record = {
+                key: encode_embedding(value) if key in EMBEDDING_COLUMNS and value is not None else value
+                for key, value in record.items()
+            }
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            record = {
+                key: np.asarray(value).tolist() if key in EMBEDDING_COLUMNS and value is not None else value
+                for key, value in record.items()
+            }
+            self._file.write(("," if self.count else "") + "\n" + json.dumps(record, ensure_ascii=False))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self._file is None:
+            return
+        if not is_jsonl(self.path):
+            self._file.write("\n]\n")
+        self._file.close()
+        self._file = None
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
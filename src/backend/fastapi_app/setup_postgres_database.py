@@ -1,22 +1,100 @@
 import argparse
 import asyncio
 import logging
+import os
 
 from dotenv import load_dotenv
 from sqlalchemy import text
 
 from fastapi_app.postgres_engine import create_postgres_engine_from_args, create_postgres_engine_from_env
-from fastapi_app.postgres_models import Base
+from fastapi_app.postgres_models import (
+    TSVECTOR_EXPRESSION,
+    VECTOR_INDEX_MODES,
+    AnswerCacheEntry,
+    Base,
+    Item,
+    Page,
+    index_3l,
+    index_content_tsv,
+    quantized_embedding_index,
+)
 
 logger = logging.getLogger("ragapp")
 
 
-async def create_db_schema(engine):
+async def create_answer_cache_invalidation_trigger(conn):
+    """Empty the answer cache whenever the items or pages change, since cached answers may cite stale content."""
+    logger.info("Creating answer cache invalidation trigger...")
+    await conn.execute(
+        text(
+            f"""
+            CREATE OR REPLACE FUNCTION invalidate_{AnswerCacheEntry.__tablename__}() RETURNS trigger AS $$
+            BEGIN
+                DELETE FROM {AnswerCacheEntry.__tablename__};
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """
+        )
+    )
+    for table_name in (Item.__tablename__, Page.__tablename__):
+        await conn.execute(text(f"DROP TRIGGER IF EXISTS invalidate_{AnswerCacheEntry.__tablename__} ON {table_name}"))
+        await conn.execute(
+            text(
+                f"CREATE TRIGGER invalidate_{AnswerCacheEntry.__tablename__} "
+                f"AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table_name} "
+                f"FOR EACH STATEMENT EXECUTE FUNCTION invalidate_{AnswerCacheEntry.__tablename__}()"
+            )
+        )
+
+
+async def create_quantized_embedding_index(conn, vector_index_mode: str):
+    """
+    Create the halfvec or binary HNSW index for the embeddings,
+    and drop the full-precision HNSW index, which is no longer used by searches.
+    """
+    index = quantized_embedding_index(vector_index_mode)
+    logger.info("Creating %s index %s...", vector_index_mode, index.name)
+    await conn.run_sync(lambda sync_conn: index.create(sync_conn, checkfirst=True))
+    logger.info("Dropping full-precision index %s...", index_3l.name)
+    await conn.run_sync(lambda sync_conn: index_3l.drop(sync_conn, checkfirst=True))
+
+
+async def create_db_schema(engine, vector_index_mode: str = "vector"):
+    if vector_index_mode not in VECTOR_INDEX_MODES:
+        raise ValueError(f"Unsupported vector index mode: {vector_index_mode}")
     async with engine.begin() as conn:
         logger.info("Enabling the pgvector extension for Postgres...")
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         logger.info("Creating database tables and indexes...")
         await conn.run_sync(Base.metadata.create_all)
+        # create_all does not alter tables that already exist, so add the full-text search column explicitly.
+        # Adding a STORED generated column rewrites the table, which backfills it for all existing rows.
+        logger.info("Adding full-text search column and index to existing tables...")
+        await conn.execute(
+            text(
+                f"ALTER TABLE {Item.__tablename__} ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+                f"GENERATED ALWAYS AS ({TSVECTOR_EXPRESSION}) STORED"
+            )
+        )
+        await conn.run_sync(lambda sync_conn: index_content_tsv.create(sync_conn, checkfirst=True))
+        await conn.execute(text(f"ALTER TABLE {Item.__tablename__} ADD COLUMN IF NOT EXISTS content_hash VARCHAR"))
+        # Items store the text of their chunk, and reference the page it was taken from
+        await conn.execute(
+            text(
+                f"ALTER TABLE {Item.__tablename__} ADD COLUMN IF NOT EXISTS page_id INTEGER "
+                f"REFERENCES {Page.__tablename__} (id) ON DELETE CASCADE"
+            )
+        )
+        await conn.execute(
+            text(f"CREATE INDEX IF NOT EXISTS ix_{Item.__tablename__}_page_id ON {Item.__tablename__} (page_id)")
+        )
+        await create_answer_cache_invalidation_trigger(conn)
+        if vector_index_mode == "vector":
+            # create_all only creates indexes along with new tables, so restore the index if it was dropped
+            await conn.run_sync(lambda sync_conn: index_3l.create(sync_conn, checkfirst=True))
+        else:
+            await create_quantized_embedding_index(conn, vector_index_mode)
 
     await conn.close()
 
@@ -37,7 +115,7 @@ async def main():
     else:
         engine = await create_postgres_engine_from_args(args)
 
-    await create_db_schema(engine)
+    await create_db_schema(engine, vector_index_mode=os.getenv("POSTGRES_VECTOR_INDEX_MODE") or "vector")
 
     await engine.dispose()
 
@@ -1,25 +1,156 @@
 import argparse
 import asyncio
-import json
 import logging
 import os
+import time
+from collections.abc import Sequence
+from itertools import islice
+from typing import Optional
 
-import numpy as np
-import sqlalchemy.exc
 from dotenv import load_dotenv
-from sqlalchemy import select, text
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from fastapi_app.embedding_settings import load_embedding_settings
 from fastapi_app.postgres_engine import (
     create_postgres_engine_from_args,
     create_postgres_engine_from_env,
 )
-from fastapi_app.postgres_models import Item
+from fastapi_app.postgres_models import Item, Page
+from fastapi_app.seed_io import EMBEDDING_COLUMNS, PAGE_SEED_FILE_NAMES, find_seed_file, read_seed_records
+from fastapi_app.update_embeddings import update_embeddings
 
 logger = logging.getLogger("ragapp")
 
 
-async def seed_data(engine):
+def get_record_columns(records: list[dict]) -> list[str]:
+    """
+    The columns of a batch of seed records, which must all have the same keys,
+    since a missing key would be loaded as NULL (and overwrite the existing value when updating).
+    """
+    columns = list(records[0].keys())
+    for record in records[1:]:
+        if record.keys() != records[0].keys():
+            missing = sorted(set(columns) - record.keys())
+            extra = sorted(record.keys() - set(columns))
+            raise ValueError(
+                f"Seed record {record.get('id')} does not have the same keys as record {records[0].get('id')}: "
+                f"missing {missing}, extra {extra}"
+            )
+    return columns
+
+
+async def load_batch(
+    connection, table_name: str, batch: list[dict], on_conflict: str, clear_columns: Sequence[str] = ()
+) -> tuple[int, int]:
+    """
+    Load a batch of seed records with a binary COPY into the staging table,
+    merge them into the table, and delete the rows of tombstone records.
+    The clear_columns that the records do not have are set to NULL in updated rows, so that they are filled again.
+    Returns the number of loaded and deleted records.
+    """
+    # Incremental exports contain tombstones for chunks that were removed from the corpus
+    deleted_ids = [record["id"] for record in batch if record.get("deleted")]
+    records = [record for record in batch if not record.get("deleted")]
+    columns = get_record_columns(records) if records else []
+    async with connection.transaction():
+        if records:
+            await connection.copy_records_to_table(
+                f"{table_name}_staging",
+                records=[tuple(record[column] for column in columns) for record in records],
+                columns=columns,
+            )
+            column_names = ", ".join(columns)
+            if on_conflict == "update":
+                # Rows that already exist are updated, since incremental exports contain changed chunks
+                updates = ", ".join(
+                    [f"{column} = excluded.{column}" for column in columns if column != "id"]
+                    + [f"{column} = NULL" for column in clear_columns if column not in columns]
+                )
+                conflict_action = f"DO UPDATE SET {updates}"
+            else:
+                conflict_action = "DO NOTHING"
+            await connection.execute(
+                f"INSERT INTO {table_name} ({column_names}) SELECT {column_names} FROM {table_name}_staging "
+                f"ON CONFLICT (id) {conflict_action}"
+            )
+        if deleted_ids:
+            await connection.execute(f"DELETE FROM {table_name} WHERE id = ANY($1::integer[])", deleted_ids)
+    return len(records), len(deleted_ids)
+
+
+async def drop_secondary_indexes(connection, table_name: str) -> list[tuple[str, str]]:
+    """
+    Drop the indexes of a table that do not back a constraint (the primary key is kept for ON CONFLICT),
+    and return their names and definitions so they can be rebuilt after loading.
+    """
+    indexes = await connection.fetch(
+        """
+        SELECT indexname, indexdef FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = $1
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = format('%I.%I', schemaname, indexname)::regclass)
+        """,
+        table_name,
+    )
+    for index in indexes:
+        logger.info("Dropping index %s until the data is loaded", index["indexname"])
+        await connection.execute(f'DROP INDEX IF EXISTS "{index["indexname"]}"')
+    return [(index["indexname"], index["indexdef"]) for index in indexes]
+
+
+async def build_indexes(
+    connection, indexes: list[tuple[str, str]], maintenance_work_mem: str, parallel_workers: int
+) -> None:
+    """
+    Build indexes with more maintenance memory and parallel workers than the defaults.
+    HNSW builds are much faster when the graph fits in maintenance_work_mem, and pgvector builds them in parallel.
+    """
+    await connection.execute(
+        "SELECT set_config('maintenance_work_mem', $1, false), "
+        "set_config('max_parallel_maintenance_workers', $2, false)",
+        maintenance_work_mem,
+        str(parallel_workers),
+    )
+    for index_name, index_definition in indexes:
+        logger.info("Building index %s...", index_name)
+        start_time = time.perf_counter()
+        await connection.execute(index_definition)
+        logger.info("Built index %s in %.1f seconds", index_name, time.perf_counter() - start_time)
+    await connection.execute("RESET maintenance_work_mem; RESET max_parallel_maintenance_workers")
+
+
+async def load_seed_file(
+    connection,
+    table_name: str,
+    seed_file: str,
+    batch_size: int,
+    on_conflict: str,
+    clear_columns: Sequence[str] = (),
+) -> None:
+    """Read a seed data file one record at a time, and load it into the table one batch per transaction."""
+    logger.info("Seeding %s table from %s in batches of %d...", table_name, seed_file, batch_size)
+    await connection.execute(
+        f"CREATE TEMPORARY TABLE IF NOT EXISTS {table_name}_staging (LIKE {table_name}) ON COMMIT DELETE ROWS"
+    )
+    total_loaded = total_deleted = 0
+    seed_records = read_seed_records(seed_file)
+    while batch := list(islice(seed_records, batch_size)):
+        loaded, deleted = await load_batch(connection, table_name, batch, on_conflict, clear_columns)
+        total_loaded += loaded
+        total_deleted += deleted
+        logger.info("Loaded %d records, deleted %d records", total_loaded, total_deleted)
+
+
+async def seed_data(
+    engine,
+    batch_size: int = 1000,
+    on_conflict: str = "update",
+    defer_indexes: bool = False,
+    maintenance_work_mem: str = "1GB",
+    parallel_workers: int = 4,
+):
+    if on_conflict not in ("update", "nothing"):
+        raise ValueError(f"Unsupported on_conflict action: {on_conflict}")
     # Check if Item table exists
     async with engine.begin() as conn:
         table_name = Item.__tablename__
@@ -32,24 +163,41 @@ async def seed_data(engine):
             logger.error(f" {table_name} table does not exist. Please run the database setup script first.")
             return
 
-    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
-        # Insert the objects from the JSON file into the database
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(current_dir, "seed_data.json"), encoding="utf-8") as f:
-            seed_data_objects = json.load(f)
-            for seed_data_object in seed_data_objects:
-                db_item = await session.execute(select(Item).filter(Item.id == seed_data_object["id"]))
-                if db_item.scalars().first():
-                    continue
-                attrs = {key: value for key, value in seed_data_object.items()}
-                attrs["embedding_3l"] = np.array(seed_data_object["embedding_3l"])
-                column_names = ", ".join(attrs.keys())
-                values = ", ".join([f":{key}" for key in attrs.keys()])
-                await session.execute(text(f"INSERT INTO {table_name} ({column_names}) VALUES ({values})"), attrs)
-            try:
-                await session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                pass
+    # After a cutover to a column added by migrate_embeddings, the app searches a column that the seed data does not
+    # fill, so it is cleared in changed rows and embedded afterwards for all rows without an embedding
+    async with async_sessionmaker(engine)() as session:
+        embedding_settings = await load_embedding_settings(session)
+    if embedding_settings is not None and embedding_settings.embedding_column in EMBEDDING_COLUMNS:
+        embedding_settings = None
+    clear_columns = [embedding_settings.embedding_column] if embedding_settings else []
+
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    seed_file = find_seed_file(current_dir)
+    try:
+        page_seed_file: Optional[str] = find_seed_file(current_dir, PAGE_SEED_FILE_NAMES)
+    except FileNotFoundError:
+        # Older seed data stores the page text in each item
+        page_seed_file = None
+    async with engine.connect() as conn:
+        # COPY is only available on the asyncpg connection itself
+        connection = (await conn.get_raw_connection()).driver_connection
+        # Pages are loaded first, since items reference them
+        if page_seed_file:
+            await load_seed_file(connection, Page.__tablename__, page_seed_file, batch_size, on_conflict)
+            await connection.execute(f"ANALYZE {Page.__tablename__}")
+        # Inserting into an existing HNSW index is much slower than building it once all rows are loaded
+        deferred_indexes = await drop_secondary_indexes(connection, table_name) if defer_indexes else []
+        try:
+            await load_seed_file(connection, table_name, seed_file, batch_size, on_conflict, clear_columns)
+        finally:
+            # Rebuild the indexes even if loading failed, so that the table is never left without them
+            if deferred_indexes:
+                await build_indexes(connection, deferred_indexes, maintenance_work_mem, parallel_workers)
+        await connection.execute(f"ANALYZE {table_name}")
+
+    if embedding_settings is not None:
+        logger.info("Embedding the new rows for %s, the column the app searches", embedding_settings.embedding_column)
+        await update_embeddings(only_missing=True, embedding_settings=embedding_settings, engine=engine)
 
     logger.info(f"{table_name} table seeded successfully.")
 
@@ -62,6 +210,24 @@ async def main():
     parser.add_argument("--database", type=str, help="Postgres database")
     parser.add_argument("--sslmode", type=str, help="Postgres sslmode")
     parser.add_argument("--tenant-id", type=str, help="Azure tenant ID", default=None)
+    parser.add_argument("--batch-size", type=int, help="Number of records loaded per transaction", default=1000)
+    parser.add_argument(
+        "--on-conflict",
+        choices=["update", "nothing"],
+        help="Whether to update or keep rows that already exist (use nothing to keep rows changed in the database)",
+        default="update",
+    )
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help="Drop the table's indexes while loading and build them afterwards (faster for large loads)",
+    )
+    parser.add_argument(
+        "--maintenance-work-mem", type=str, help="maintenance_work_mem for building indexes", default="1GB"
+    )
+    parser.add_argument(
+        "--parallel-workers", type=int, help="max_parallel_maintenance_workers for building indexes", default=4
+    )
 
     # if no args are specified, use environment variables
     args = parser.parse_args()
@@ -70,7 +236,14 @@ async def main():
     else:
         engine = await create_postgres_engine_from_args(args)
 
-    await seed_data(engine)
+    await seed_data(
+        engine,
+        batch_size=args.batch_size,
+        on_conflict=args.on_conflict,
+        defer_indexes=args.defer_indexes,
+        maintenance_work_mem=args.maintenance_work_mem,
+        parallel_workers=args.parallel_workers,
+    )
 
     await engine.dispose()
 
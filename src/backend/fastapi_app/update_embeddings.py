@@ -3,77 +3,245 @@ import asyncio
 import json
 import logging
 import os
+from collections.abc import AsyncGenerator, Callable, Coroutine
+from itertools import islice
+from typing import Any, Optional, TypeVar
 
 from dotenv import load_dotenv
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from sqlalchemy.orm import load_only
 
 from fastapi_app.dependencies import common_parameters, get_azure_credential
-from fastapi_app.embeddings import compute_text_embedding
+from fastapi_app.embedding_settings import EmbeddingSettings, load_embedding_settings
+from fastapi_app.embeddings import compute_text_embeddings
 from fastapi_app.openai_clients import create_openai_embed_client
 from fastapi_app.postgres_engine import create_postgres_engine_from_env
 from fastapi_app.postgres_models import Item
+from fastapi_app.seed_io import EMBEDDING_COLUMNS, SeedWriter, find_seed_file, read_seed_records
 
 logger = logging.getLogger("ragapp")
 
+CHECKPOINT_FILE = "update_embeddings_checkpoint.json"
 
-async def update_embeddings(in_seed_data=False):
+T = TypeVar("T")
+
+
+async def column_exists(conn, table_name: str, column_name: str) -> bool:
+    result = await conn.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :table_name AND column_name = :column_name)"
+        ),
+        {"table_name": table_name, "column_name": column_name},
+    )
+    return bool(result.scalar())
+
+
+class EmbeddingCheckpoint:
+    """
+    Tracks the highest id up to which all batches have been committed, and saves it after every batch,
+    so that an interrupted run can be resumed. Batches run concurrently and can finish out of order.
+    """
+
+    def __init__(self, path: str, embedding_column: str, last_id: int = 0):
+        self.path = path
+        self.embedding_column = embedding_column
+        self.last_id = last_id
+        self._pending: list[int] = []  # last id of each started batch, in order
+        self._committed: set[int] = set()
+
+    @classmethod
+    def load(cls, path: str, embedding_column: str) -> "EmbeddingCheckpoint":
+        last_id = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint["embedding_column"] == embedding_column:
+                last_id = checkpoint["last_id"]
+        return cls(path, embedding_column, last_id)
+
+    def start(self, batch_last_id: int) -> None:
+        self._pending.append(batch_last_id)
+
+    def commit(self, batch_last_id: int) -> None:
+        self._committed.add(batch_last_id)
+        while self._pending and self._pending[0] in self._committed:
+            self.last_id = self._pending.pop(0)
+            self._committed.remove(self.last_id)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"embedding_column": self.embedding_column, "last_id": self.last_id}, f)
+
+
+def build_update_statement(embedding_column: str, update_content_hash: bool) -> str:
+    """
+    The UPDATE statement for a batch of embeddings.
+    content_hash records the content that the embeddings of the live column were computed from,
+    so it is left alone when filling another column, such as a shadow column for a new model.
+    """
+    statement = f"UPDATE {Item.__tablename__} SET {embedding_column} = :embedding"
+    if update_content_hash:
+        statement += ", content_hash = :content_hash"
+    return statement + " WHERE id = :id"
+
+
+async def run_batches(
+    batches: AsyncGenerator[T, None],
+    process_batch: Callable[[T], Coroutine[Any, Any, None]],
+    concurrency: int,
+) -> None:
+    """
+    Process batches concurrently, with at most concurrency batches in flight.
+    After a batch fails, no more batches are read, and its error is raised once the batches in flight have finished.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks: set[asyncio.Task] = set()
+
+    async def run(batch: T) -> None:
+        try:
+            await process_batch(batch)
+        finally:
+            semaphore.release()
+
+    def forget_if_succeeded(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is None:
+            tasks.discard(task)
+
+    def has_failed(task: asyncio.Task) -> bool:
+        # Tasks that succeeded may not have been forgotten yet, since done callbacks run later
+        return task.done() and not task.cancelled() and task.exception() is not None
+
+    try:
+        async for batch in batches:
+            await semaphore.acquire()
+            if any(has_failed(task) for task in tasks):
+                semaphore.release()
+                break
+            task = asyncio.create_task(run(batch))
+            tasks.add(task)
+            task.add_done_callback(forget_if_succeeded)
+    finally:
+        # Closes the source of the batches (such as a database cursor) when stopping early
+        await batches.aclose()
+    # Raises the first error, after the batches in flight have finished
+    await asyncio.gather(*tasks)
+
+
+async def update_embeddings(
+    in_seed_data=False,
+    batch_size: int = 100,
+    concurrency: int = 4,
+    only_missing: bool = False,
+    only_changed: bool = False,
+    resume: bool = False,
+    checkpoint_file: str = CHECKPOINT_FILE,
+    embedding_settings: Optional[EmbeddingSettings] = None,
+    update_content_hash: bool = True,
+    engine: Optional[AsyncEngine] = None,
+):
+    if only_changed and not update_content_hash:
+        raise ValueError("only_changed needs the content hash, which is only updated for the live embedding column")
     azure_credential = await get_azure_credential()
-    engine = await create_postgres_engine_from_env(azure_credential)
+    if engine is None:
+        engine = await create_postgres_engine_from_env(azure_credential)
     openai_embed_client = await create_openai_embed_client(azure_credential)
-    common_params = await common_parameters()
-
-    embedding_column = ""
-    OPENAI_EMBED_HOST = os.getenv("OPENAI_EMBED_HOST")
-    if OPENAI_EMBED_HOST == "azure":
-        embedding_column = os.getenv("AZURE_OPENAI_EMBEDDING_COLUMN", "embedding_3l")
-    elif OPENAI_EMBED_HOST == "ollama":
-        embedding_column = os.getenv("OLLAMA_EMBEDDING_COLUMN", "embedding_nomic")
-    elif OPENAI_EMBED_HOST == "github":
-        embedding_column = os.getenv("GITHUB_EMBEDDING_COLUMN", "embedding_3l")
+    if embedding_settings is None and not in_seed_data:
+        # The column and model that the app searches, after any cutover (see migrate_embeddings.py)
+        async with async_sessionmaker(engine)() as session:
+            embedding_settings = await load_embedding_settings(session)
+    if embedding_settings is None:
+        # The column and model configured in the environment
+        embedding_settings = EmbeddingSettings.from_context(await common_parameters())
+    embedding_column = embedding_settings.embedding_column
+    if in_seed_data:
+        if embedding_column not in EMBEDDING_COLUMNS:
+            raise ValueError(f"Column {embedding_column} is not an embedding column of the {Item.__tablename__} model")
     else:
-        embedding_column = os.getenv("OPENAICOM_EMBEDDING_COLUMN", "embedding_3l")
+        async with engine.connect() as conn:
+            # The column may not be on the Item model, when backfilling a new column (see migrate_embeddings.py)
+            if not await column_exists(conn, Item.__tablename__, embedding_column):
+                raise ValueError(f"Column {embedding_column} does not exist on the {Item.__tablename__} table")
     logger.info(f"Updating embeddings in column: {embedding_column}")
+
+    async def embed_rows(rows: list[Item]) -> list[list[float]]:
+        # One API call per batch; the client retries rate-limited requests
+        return await compute_text_embeddings(
+            [row.to_str_for_embedding() for row in rows],
+            openai_client=openai_embed_client,
+            embed_model=embedding_settings.openai_embed_model,
+            embed_deployment=embedding_settings.openai_embed_deployment,
+            embedding_dimensions=embedding_settings.openai_embed_dimensions,
+        )
+
     if in_seed_data:
         current_dir = os.path.dirname(os.path.realpath(__file__))
-        rows = []
-        with open(os.path.join(current_dir, "seed_data.json")) as f:
-            seed_data_objects = json.load(f)
-            for seed_data_object in seed_data_objects:
+        seed_file = find_seed_file(current_dir)
+        # The updated seed data is written to a temporary file while the original is read, then replaces it
+        with SeedWriter(seed_file) as writer:
+            seed_records = read_seed_records(seed_file)
+            while batch := list(islice(seed_records, batch_size)):
                 # for each column in the JSON, store it in the same named attribute in the object
-                attrs = {key: value for key, value in seed_data_object.items()}
-                row = Item(**attrs)
-                embedding = await compute_text_embedding(
-                    row.to_str_for_embedding(),
-                    openai_client=openai_embed_client,
-                    embed_model=common_params.openai_embed_model,
-                    embed_deployment=common_params.openai_embed_deployment,
-                    embedding_dimensions=common_params.openai_embed_dimensions,
-                )
-                setattr(row, embedding_column, embedding)
-                rows.append(row)
-            # Write updated seed data to the file
-            with open(os.path.join(current_dir, "seed_data.json"), "w") as f:
-                json.dump([row.to_dict(include_embedding=True) for row in rows], f, indent=4)
+                rows = [Item(**record) for record in batch if not record.get("deleted")]
+                embeddings = await embed_rows(rows) if rows else []
+                for row, embedding in zip(rows, embeddings):
+                    setattr(row, embedding_column, embedding)
+                rows_by_id = {row.id: row for row in rows}
+                for record in batch:
+                    writer.write(record if record.get("deleted") else rows_by_id[record["id"]].to_dict(True))
+                logger.info("Updated embeddings for %d seed records", writer.count)
         return
 
-    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
-        async with session.begin():
-            rows_to_update = (await session.scalars(select(Item))).all()
-
-            for row_model in rows_to_update:
-                setattr(
-                    row_model,
-                    embedding_column,
-                    await compute_text_embedding(
-                        row_model.to_str_for_embedding(),
-                        openai_client=openai_embed_client,
-                        embed_model=common_params.openai_embed_model,
-                        embed_deployment=common_params.openai_embed_deployment,
-                        embedding_dimensions=common_params.openai_embed_dimensions,
-                    ),
-                )
+    checkpoint = (
+        EmbeddingCheckpoint.load(checkpoint_file, embedding_column)
+        if resume
+        else EmbeddingCheckpoint(checkpoint_file, embedding_column)
+    )
+    if checkpoint.last_id:
+        logger.info("Resuming after id %d", checkpoint.last_id)
+    query = (
+        select(Item)
+        .options(load_only(Item.id, Item.content, Item.filename, Item.pagenumber, Item.content_hash))
+        .where(Item.id > checkpoint.last_id)
+        .order_by(Item.id)
+        .execution_options(yield_per=batch_size)
+    )
+    if only_missing:
+        query = query.where(text(f"{embedding_column} IS NULL"))
+
+    sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+    updated = 0
+
+    async def read_batches() -> AsyncGenerator[list[Item], None]:
+        # Rows are streamed from a server-side cursor on their own connection
+        async with sessionmaker() as read_session:
+            result = await read_session.stream_scalars(query)
+            async for partition in result.partitions():
+                rows = list(partition)
+                if only_changed:
+                    rows = [row for row in rows if row.content_hash != row.compute_content_hash()]
+                if rows:
+                    checkpoint.start(rows[-1].id)
+                    yield rows
+
+    async def update_batch(rows: list[Item]):
+        nonlocal updated
+        embeddings = await embed_rows(rows)
+        # Each batch is committed on its own, so a failure only loses the batches in flight
+        async with sessionmaker() as session:
+            await session.execute(
+                text(build_update_statement(embedding_column, update_content_hash)),
+                [
+                    {"id": row.id, "embedding": embedding, "content_hash": row.compute_content_hash()}
+                    for row, embedding in zip(rows, embeddings)
+                ],
+            )
             await session.commit()
+        checkpoint.commit(rows[-1].id)
+        updated += len(rows)
+        logger.info("Updated embeddings for %d rows (all rows up to id %d done)", updated, checkpoint.last_id)
+
+    await run_batches(read_batches(), update_batch, concurrency)
+    logger.info("Updated embeddings for %d rows", updated)
 
 
 if __name__ == "__main__":
@@ -83,5 +251,23 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--in_seed_data", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=100, help="Number of rows embedded per API call")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of batches embedded at the same time")
+    parser.add_argument("--only-missing", action="store_true", help="Only rows without an embedding")
+    parser.add_argument(
+        "--only-changed", action="store_true", help="Only rows whose content changed since they were embedded"
+    )
+    parser.add_argument("--resume", action="store_true", help="Continue after the last id saved in the checkpoint")
+    parser.add_argument("--checkpoint-file", type=str, default=CHECKPOINT_FILE)
     args = parser.parse_args()
-    asyncio.run(update_embeddings(args.in_seed_data))
+    asyncio.run(
+        update_embeddings(
+            args.in_seed_data,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            only_missing=args.only_missing,
+            only_changed=args.only_changed,
+            resume=args.resume,
+            checkpoint_file=args.checkpoint_file,
+        )
+    )
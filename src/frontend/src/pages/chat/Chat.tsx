@@ -71,6 +71,9 @@ const Chat = () => {
                         ...response.context
                     };
                 }
+                if (response.sessionState) {
+                    chatCompletion.sessionState = response.sessionState;
+                }
                 if (response.delta && response.delta.role) {
                     chatCompletion.message.role = response.delta.role;
                 }
@@ -0,0 +1,114 @@
+from typing import Any
+
+import pytest
+
+from fastapi_app.answer_cache import AnswerCache, AnswerCacheHit
+from fastapi_app.api_models import (
+    AIChatRoles,
+    ChatParams,
+    HNSWSearchSettings,
+    Message,
+    RAGContext,
+    RetrievalMode,
+    RetrievalResponse,
+)
+
+
+def make_chat_params(**kwargs) -> ChatParams:
+    params: dict[str, Any] = {
+        "prompt_template": "Answer the question.",
+        "enable_text_search": True,
+        "enable_vector_search": True,
+        "original_user_query": "How do I apply for parental leave?",
+        "past_messages": [],
+    }
+    return ChatParams(**(params | kwargs))
+
+
+def test_answer_cache_is_cacheable():
+    assert AnswerCache.is_cacheable(make_chat_params())
+    assert not AnswerCache.is_cacheable(
+        make_chat_params(past_messages=[{"content": "Hello", "role": "user"}]),
+    )
+
+
+def make_params_key(chat_params: ChatParams, **kwargs) -> str:
+    params: dict[str, Any] = {
+        "chat_model": "gpt-4o-mini",
+        "embedding_column": "embedding_3l",
+        "hybrid_search_mode": "single_statement",
+        "hnsw_settings": HNSWSearchSettings(),
+        "vector_index_mode": "vector",
+        "binary_rerank_candidates": 200,
+    }
+    return AnswerCache.make_params_key(chat_params, **(params | kwargs))
+
+
+def test_answer_cache_params_key():
+    key = make_params_key(make_chat_params())
+    assert key == make_params_key(make_chat_params(original_user_query="Parental leave application"))
+    assert key != make_params_key(make_chat_params(top=5))
+    assert key != make_params_key(make_chat_params(retrieval_mode=RetrievalMode.TEXT))
+    assert key != make_params_key(make_chat_params(), chat_model="gpt-4o")
+    assert key != make_params_key(make_chat_params(), vector_index_mode="binary")
+    assert key != make_params_key(make_chat_params(), binary_rerank_candidates=400)
+    assert key != make_params_key(make_chat_params(skip_single_turn_rewrite=False))
+    assert key != make_params_key(make_chat_params(input_token_budget=2000))
+    assert key != make_params_key(make_chat_params(), hybrid_search_mode="concurrent")
+    assert key != make_params_key(make_chat_params(), hnsw_settings=HNSWSearchSettings(ef_search=100))
+    # Only the settings the search applies count, not the raw overrides they were built from
+    assert key == make_params_key(make_chat_params(hnsw_ef_search=100))
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_hit_to_stream():
+    cache_hit = AnswerCacheHit(
+        query="How do I apply for parental leave?",
+        similarity=0.99,
+        response=RetrievalResponse(
+            message=Message(content="Submit the form to HR [12].", role=AIChatRoles.ASSISTANT),
+            context=RAGContext(data_points={}, thoughts=[]),
+        ),
+    )
+    events = [event async for event in cache_hit.to_stream({"theme": "dark"})]
+    assert events[0].context is not None
+    assert events[0].context.thoughts[-1].title == "Answer served from cache"
+    assert events[0].sessionState == {"theme": "dark"}
+    assert "".join(event.delta.content for event in events[1:] if event.delta) == "Submit the form to HR [12]."
+    assert cache_hit.response.context.thoughts == []
+
+
+class RecordingSession:
+    def __init__(self):
+        self.params: list[dict[str, Any]] = []
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, statement, params):
+        self.params.append(params)
+
+    async def commit(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_does_not_share_session_state():
+    session = RecordingSession()
+    cache = AnswerCache(session)  # type: ignore[arg-type]
+    response = RetrievalResponse(
+        message=Message(content="Submit the form to HR [12].", role=AIChatRoles.ASSISTANT),
+        context=RAGContext(data_points={}, thoughts=[]),
+        sessionState={"history_summary": {"summary": "The user asked about their salary."}},
+    )
+    await cache.store("How do I apply for parental leave?", [0.1] * cache.embedding_dimensions, "key", response)
+    cached_response = RetrievalResponse.model_validate_json(session.params[0]["response"])
+    assert cached_response.sessionState is None
+    cache_hit = AnswerCacheHit(query="How do I apply for parental leave?", similarity=0.99, response=cached_response)
+    assert cache_hit.to_response({"theme": "dark"}).sessionState == {"theme": "dark"}
@@ -173,7 +173,13 @@ async def test_advanced_chat_flow(test_client, snapshot):
         "/chat",
         json={
             "context": {
-                "overrides": {"top": 1, "use_advanced_flow": True, "retrieval_mode": "hybrid", "temperature": 0.3}
+                "overrides": {
+                    "top": 1,
+                    "use_advanced_flow": True,
+                    "retrieval_mode": "hybrid",
+                    "temperature": 0.3,
+                    "skip_single_turn_rewrite": False,
+                }
             },
             "messages": [{"content": "What is the capital of France?", "role": "user"}],
         },
@@ -192,7 +198,13 @@ async def test_advanced_chat_streaming_flow(test_client, snapshot):
         "/chat/stream",
         json={
             "context": {
-                "overrides": {"top": 1, "use_advanced_flow": True, "retrieval_mode": "hybrid", "temperature": 0.3}
+                "overrides": {
+                    "top": 1,
+                    "use_advanced_flow": True,
+                    "retrieval_mode": "hybrid",
+                    "temperature": 0.3,
+                    "skip_single_turn_rewrite": False,
+                }
             },
             "messages": [{"content": "What is the capital of France?", "role": "user"}],
         },
@@ -0,0 +1,43 @@
+from fastapi_app.chat_history import HISTORY_SUMMARY_KEY, ChatHistory, hash_messages
+from fastapi_app.context_builder import get_message_text
+
+
+def make_turns(count: int) -> list:
+    messages = []
+    for i in range(count):
+        messages += [{"content": f"question {i}", "role": "user"}, {"content": f"answer {i}", "role": "assistant"}]
+    return messages
+
+
+def test_short_history_is_kept_verbatim():
+    past_messages = make_turns(2)
+    history = ChatHistory(past_messages, None, verbatim_turns=3)
+    assert history.get_messages() == past_messages
+    assert history.get_messages_to_summarize() == []
+
+
+def test_summary_replaces_older_turns():
+    past_messages = make_turns(5)
+    # The summary made during the previous request covers the first turn
+    session_state = ChatHistory(past_messages, None, verbatim_turns=3).update_session_state(
+        "Asked about leave.", past_messages[:2]
+    )
+    history = ChatHistory(past_messages, session_state, verbatim_turns=3)
+    messages = history.get_messages()
+    assert messages[0].get("role") == "system" and "Asked about leave." in get_message_text(messages[0])
+    assert messages[1:] == past_messages[2:]
+    # With this request's turn, turns 2 and 3 fall out of the verbatim window of the next request
+    assert history.get_messages_to_summarize() == past_messages[2:6]
+    new_state = history.update_session_state("Asked about leave and travel.", past_messages[2:6])
+    assert new_state[HISTORY_SUMMARY_KEY]["message_count"] == 6
+    assert new_state[HISTORY_SUMMARY_KEY]["messages_hash"] == hash_messages(past_messages[:6])
+
+
+def test_summary_of_other_conversation_is_ignored():
+    session_state = ChatHistory(make_turns(5), None).update_session_state("Asked about leave.", make_turns(1))
+    past_messages = [{"content": "something else", "role": "user"}] + make_turns(5)[1:]
+    history = ChatHistory(past_messages, session_state)
+    assert history.summary is None
+    assert history.get_messages() == past_messages
+    assert ChatHistory(make_turns(5), {HISTORY_SUMMARY_KEY: {"summary": 1}}).summary is None
+    assert ChatHistory(make_turns(5), session_state, verbatim_turns=0).get_messages() == make_turns(5)
@@ -0,0 +1,65 @@
+from openai.types.responses import EasyInputMessageParam
+
+from fastapi_app.api_models import ItemPublic
+from fastapi_app.context_builder import ContextBuilder, get_message_text
+
+
+def make_item(id: int, filename: str, pagenumber: int, content: str) -> ItemPublic:
+    return ItemPublic(
+        id=id,
+        filename=filename,
+        fileurl=f"https://example.com/{filename}",
+        pagenumber=pagenumber,
+        chunk=id,
+        content=content,
+        typedoc="HR Policy",
+    )
+
+
+def test_get_message_text():
+    assert get_message_text({"content": "hello", "role": "user"}) == "hello"
+    assert get_message_text({"content": [{"type": "input_text", "text": "hello"}], "role": "user"}) == "hello"
+
+
+def test_fit_history_keeps_most_recent_messages():
+    builder = ContextBuilder("gpt-4o-mini")
+    messages: list[EasyInputMessageParam] = [
+        {"content": f"message {i} " + "word " * 20, "role": "user"} for i in range(5)
+    ]
+    budget = builder.count_message_tokens(messages[-2:])
+    assert builder.fit_history(messages, budget) == messages[-2:]
+    assert builder.fit_history(messages, 0) == []
+
+
+def test_format_sources_groups_and_dedupes():
+    builder = ContextBuilder("gpt-4o-mini")
+    items = [
+        make_item(1, "leave.pdf", 3, "Parental leave is 16 weeks."),
+        make_item(2, "travel.pdf", 1, "Book travel through the portal."),
+        make_item(3, "leave.pdf", 3, "Parental leave is 16 weeks."),
+        make_item(4, "leave.pdf", 4, "Leave requests need approval."),
+    ]
+    sources, item_ids = builder.format_sources(items)
+    assert item_ids == [1, 2, 4]
+    assert sources.count("File: leave.pdf") == 1
+    assert sources.index("[4] Page 4") < sources.index("File: travel.pdf")
+
+
+def test_format_sources_trims_lowest_ranked_first():
+    builder = ContextBuilder("gpt-4o-mini")
+    items = [make_item(i, f"file{i}.pdf", 1, "policy text " * 50) for i in range(1, 5)]
+    _, all_ids = builder.format_sources(items)
+    full_sources, _ = builder.format_sources(items[:2])
+    sources, item_ids = builder.format_sources(items, builder.count_tokens(full_sources) + 20)
+    assert all_ids == [1, 2, 3, 4]
+    assert item_ids == [1, 2]
+    assert sources == full_sources
+
+
+def test_format_sources_truncates_top_item():
+    builder = ContextBuilder("gpt-4o-mini")
+    items = [make_item(1, "leave.pdf", 1, "policy text " * 500), make_item(2, "leave.pdf", 2, "more")]
+    sources, item_ids = builder.format_sources(items, 100)
+    assert item_ids == [1]
+    assert builder.count_tokens(sources) <= 100
+    assert builder.format_sources(items, 0) == ("", [])
@@ -1,6 +1,7 @@
 import pytest
 
-from fastapi_app.dependencies import common_parameters, get_azure_credential
+from fastapi_app.api_models import ChatRequestOverrides
+from fastapi_app.dependencies import ReadReplicaRouter, common_parameters, get_azure_credential
 
 
 @pytest.mark.asyncio
@@ -11,6 +12,25 @@ async def test_get_common_parameters(mock_session_env):
     assert result.openai_embed_dimensions == 1024
     assert result.openai_chat_deployment == "gpt-4o-mini"
     assert result.openai_embed_deployment == "text-embedding-3-large"
+    assert result.hybrid_search_mode == "single_statement"
+    assert result.hnsw_search_settings.to_config() == {}
+
+
+@pytest.mark.asyncio
+async def test_get_common_parameters_hnsw_settings(mock_session_env, monkeypatch):
+    monkeypatch.setenv("POSTGRES_HNSW_EF_SEARCH", "100")
+    monkeypatch.setenv("POSTGRES_HNSW_ITERATIVE_SCAN", "relaxed_order")
+    result = await common_parameters()
+    assert result.hnsw_search_settings.to_config() == {
+        "hnsw.ef_search": "100",
+        "hnsw.iterative_scan": "relaxed_order",
+    }
+    overrides = ChatRequestOverrides(hnsw_ef_search=400, hnsw_max_scan_tuples=50000)
+    assert result.get_hnsw_search_settings(overrides).to_config() == {
+        "hnsw.ef_search": "400",
+        "hnsw.iterative_scan": "relaxed_order",
+        "hnsw.max_scan_tuples": "50000",
+    }
 
 
 @pytest.mark.asyncio
@@ -39,3 +59,44 @@ async def test_get_azure_credential(mock_session_env, mock_azure_credential):
     token = result.get_token("https://vault.azure.net")
     assert token.expires_on == 9999999999
     assert token.token == ""
+
+
+class FakeSessionmaker:
+    def __init__(self, healthy: bool = True):
+        self.healthy = healthy
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        if not self.healthy:
+            raise ConnectionRefusedError("replica is down")
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, statement):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_read_replica_router():
+    primary, replica_a, replica_b = FakeSessionmaker(), FakeSessionmaker(), FakeSessionmaker()
+    router = ReadReplicaRouter(primary, {"a": replica_a, "b": replica_b})  # type: ignore[arg-type, dict-item]
+    await router.check_health()
+    assert [router.get_sessionmaker() for _ in range(4)] == [replica_a, replica_b, replica_a, replica_b]
+
+    replica_a.healthy = False
+    await router.check_health()
+    assert router.healthy == {"a": False, "b": True}
+    assert [router.get_sessionmaker() for _ in range(2)] == [replica_b, replica_b]
+
+    # Reads go to the primary while no replica is healthy
+    replica_b.healthy = False
+    await router.check_health()
+    assert router.get_sessionmaker() is primary
+
+    replica_a.healthy = True
+    await router.check_health()
+    assert router.get_sessionmaker() is replica_a
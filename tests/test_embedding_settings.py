@@ -0,0 +1,88 @@
+import pytest
+
+from fastapi_app import embedding_settings
+from fastapi_app.dependencies import FastAPIAppContext
+from fastapi_app.embedding_settings import EmbeddingSettings, EmbeddingSettingsWatcher, validate_column_name
+from fastapi_app.migrate_embeddings import EmbeddingColumnReport, compute_recall
+
+
+def make_context() -> FastAPIAppContext:
+    return FastAPIAppContext(
+        openai_chat_model="gpt-4o-mini",
+        openai_embed_model="text-embedding-3-large",
+        openai_embed_dimensions=1024,
+        openai_chat_deployment=None,
+        openai_embed_deployment=None,
+        embedding_column="embedding_3l",
+    )
+
+
+def test_validate_column_name():
+    assert validate_column_name("embedding_3s") == "embedding_3s"
+    for column_name in ("", "3l", "Embedding", "embedding; DROP TABLE items", 'embedding_3l"'):
+        with pytest.raises(ValueError):
+            validate_column_name(column_name)
+    with pytest.raises(ValueError):
+        EmbeddingSettings(embedding_column="id = 1 OR", openai_embed_model="text-embedding-3-small")
+
+
+@pytest.mark.asyncio
+async def test_watcher_applies_settings_to_shared_context(monkeypatch):
+    context = make_context()
+    settings = EmbeddingSettings(
+        embedding_column="embedding_3s",
+        openai_embed_model="text-embedding-3-small",
+        openai_embed_dimensions=512,
+    )
+
+    async def load_embedding_settings(session):
+        return settings
+
+    monkeypatch.setattr(embedding_settings, "load_embedding_settings", load_embedding_settings)
+
+    class FakeSession:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+    watcher = EmbeddingSettingsWatcher(FakeSession, context)  # type: ignore[arg-type]
+    assert await watcher.refresh() is True
+    assert context.embedding_column == "embedding_3s"
+    assert context.openai_embed_model == "text-embedding-3-small"
+    assert context.openai_embed_dimensions == 512
+    assert context.openai_embed_deployment is None
+    # Unchanged settings are not applied again
+    assert await watcher.refresh() is False
+
+
+def test_watcher_ignores_new_column_with_quantized_index_mode():
+    context = make_context()
+    context.vector_index_mode = "halfvec"
+    watcher = EmbeddingSettingsWatcher(None, context)  # type: ignore[arg-type]
+    new_column = EmbeddingSettings(embedding_column="embedding_3s", openai_embed_model="text-embedding-3-small")
+    assert not new_column.supports_vector_index_mode("halfvec")
+    assert new_column.supports_vector_index_mode("vector")
+    assert watcher.apply(new_column) is False
+    assert context.embedding_column == "embedding_3l"
+    # Switching between the columns of the Item model works in any mode
+    model_column = EmbeddingSettings(embedding_column="embedding_3l", openai_embed_model="text-embedding-3-small")
+    assert watcher.apply(model_column) is True
+    assert context.openai_embed_model == "text-embedding-3-small"
+
+
+def test_compute_recall():
+    assert compute_recall([1, 2, 3, 4], [1, 2, 3, 5]) == 0.75
+    assert compute_recall([], []) == 1.0
+
+
+def test_embedding_column_report_failures():
+    report = EmbeddingColumnReport(
+        embedding_column="embedding_3s", rows=100, embedded_rows=98, index_valid=True, sample_size=10, recall=0.95
+    )
+    assert report.coverage == 0.98
+    assert report.failures(min_coverage=0.95, min_recall=0.9) == []
+    assert len(report.failures(min_coverage=1.0, min_recall=0.99)) == 2
+    report.index_valid = False
+    assert "does not exist or is invalid" in report.failures(min_coverage=0.95, min_recall=0.9)[0]
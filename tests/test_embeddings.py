@@ -1,6 +1,12 @@
+import asyncio
+
+import openai
 import pytest
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.create_embedding_response import Usage
 
-from fastapi_app.embeddings import compute_text_embedding
+from fastapi_app.embedding_cache import EmbeddingCache, PostgresEmbeddingStore
+from fastapi_app.embeddings import EmbeddingBatcher, compute_text_embedding
 from fastapi_app.openai_clients import create_openai_embed_client
 from tests.data import test_data
 
@@ -28,3 +34,135 @@ async def test_compute_text_embedding_dimensions(mock_azure_credential, mock_ope
         embedding_dimensions=1024,
     )
     assert result == test_data.embeddings
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cache(mock_azure_credential, mock_openai_embedding):
+    openai_embed_client = await create_openai_embed_client(mock_azure_credential)
+    cache = EmbeddingCache(maxsize=10)
+    for q in ["parental leave", "  Parental   LEAVE "]:
+        result = await compute_text_embedding(
+            q=q,
+            openai_client=openai_embed_client,
+            embed_model="text-embedding-3-small",
+            embed_deployment="text-embedding-3-small",
+            embedding_dimensions=1024,
+            cache=cache,
+        )
+        assert result == test_data.embeddings
+    assert cache.stats.misses == 1
+    assert cache.stats.hits == 1
+    assert cache.stats.size == 1
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_lru_eviction():
+    cache = EmbeddingCache(maxsize=2)
+    await cache.set("a", [1.0])
+    await cache.set("b", [2.0])
+    assert await cache.get("a") == [1.0]
+    await cache.set("c", [3.0])
+    assert await cache.get("b") is None
+    assert await cache.get("a") == [1.0]
+    assert await cache.get("c") == [3.0]
+    assert cache.stats.evictions == 1
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("fastapi_app.embedding_cache.time.monotonic", lambda: now)
+    cache = EmbeddingCache(maxsize=10, ttl_seconds=60)
+    await cache.set("a", [1.0])
+    now += 59
+    assert await cache.get("a") == [1.0]
+    now += 2
+    assert await cache.get("a") is None
+    assert cache.stats.size == 0
+
+
+@pytest.mark.asyncio
+async def test_postgres_embedding_store_deletes_expired_rows(monkeypatch):
+    statements: list[str] = []
+
+    class RecordingSession:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def execute(self, statement, params):
+            statements.append(str(statement).split()[0])
+
+        async def commit(self):
+            pass
+
+    now = 1000.0
+    monkeypatch.setattr("fastapi_app.embedding_cache.time.monotonic", lambda: now)
+    store = PostgresEmbeddingStore(RecordingSession, ttl_seconds=60, cleanup_interval_seconds=300)  # type: ignore[arg-type]
+    await store.set("a", [1.0])
+    now += 299
+    await store.set("b", [2.0])
+    now += 2
+    await store.set("c", [3.0])
+    assert statements == ["INSERT", "DELETE", "INSERT", "INSERT", "DELETE"]
+
+
+def test_embedding_cache_key():
+    key = EmbeddingCache.make_key("How do I apply for PTO?", "text-embedding-3-large", None, 1024)
+    assert key == EmbeddingCache.make_key(" how do  I apply for pto? ", "text-embedding-3-large", None, 1024)
+    assert key != EmbeddingCache.make_key("How do I apply for PTO?", "text-embedding-3-large", None, 256)
+    assert key != EmbeddingCache.make_key("How do I apply for PTO?", "text-embedding-3-small", None, 1024)
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_coalesces_requests(mock_azure_credential, monkeypatch):
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs["input"])
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[
+                Embedding(embedding=[float(len(text))], index=index, object="embedding")
+                for index, text in enumerate(kwargs["input"])
+            ],
+            model="text-embedding-3-large",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+    monkeypatch.setattr(openai.resources.AsyncEmbeddings, "create", mock_acreate)
+    openai_embed_client = await create_openai_embed_client(mock_azure_credential)
+    batcher = EmbeddingBatcher(max_batch_size=10, max_wait_seconds=0.01)
+    results = await asyncio.gather(
+        *[
+            compute_text_embedding(
+                q=q,
+                openai_client=openai_embed_client,
+                embed_model="text-embedding-3-large",
+                embedding_dimensions=1024,
+                batcher=batcher,
+            )
+            for q in ["a", "bb", "a", "ccc"]
+        ]
+    )
+    assert results == [[1.0], [2.0], [1.0], [3.0]]
+    assert calls == [["a", "bb", "ccc"]]
+    assert batcher.requests == 4
+    assert batcher.batches == 1
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_propagates_errors(mock_azure_credential, monkeypatch):
+    async def mock_acreate(*args, **kwargs):
+        raise ValueError("quota exceeded")
+
+    monkeypatch.setattr(openai.resources.AsyncEmbeddings, "create", mock_acreate)
+    openai_embed_client = await create_openai_embed_client(mock_azure_credential)
+    batcher = EmbeddingBatcher(max_batch_size=2, max_wait_seconds=1)
+    results = await asyncio.gather(
+        *[batcher.embed(q, openai_embed_client, "text-embedding-3-large", None, 1024) for q in ["a", "b"]],
+        return_exceptions=True,
+    )
+    assert [str(result) for result in results] == ["quota exceeded", "quota exceeded"]
@@ -0,0 +1,140 @@
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+import openai
+import pytest
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.create_embedding_response import Usage
+
+SCRIPT_PATH = Path(__file__).parent.parent / "scripts" / "pdfs_to_seed_json.py"
+
+
+@pytest.fixture
+def pdfs_to_seed_json(monkeypatch):
+    """Load the ingestion script as a module, with a fake Azure OpenAI configuration"""
+    monkeypatch.setenv("AZURE_OPENAI_KEY", "fakekey")
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://api.openai.com")
+    monkeypatch.setenv("AZURE_OPENAI_EMBED_DEPLOYMENT_VERSION", "2024-03-01-preview")
+    monkeypatch.setenv("AZURE_OPENAI_EMBED_DEPLOYMENT", "text-embedding-3-small")
+    spec = importlib.util.spec_from_file_location("pdfs_to_seed_json", SCRIPT_PATH)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_rejected_input_only_loses_its_own_chunk(pdfs_to_seed_json, monkeypatch):
+    requests = []
+
+    def mock_create(input, model):
+        requests.append(input)
+        if "rejected" in input:
+            raise openai.BadRequestError(
+                "Invalid input",
+                response=httpx.Response(400, request=httpx.Request("POST", "https://api.openai.com/embeddings")),
+                body=None,
+            )
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[
+                Embedding(object="embedding", index=index, embedding=[float(len(text))] * 1536)
+                for index, text in enumerate(input)
+            ],
+            model=model,
+            usage=Usage(prompt_tokens=len(input), total_tokens=len(input)),
+        )
+
+    monkeypatch.setattr(pdfs_to_seed_json.client.embeddings, "create", mock_create)
+    texts = ["a", "bb", "rejected", "dddd"]
+    limiter = pdfs_to_seed_json.AdaptiveConcurrencyLimiter()
+
+    embeddings = pdfs_to_seed_json.get_embeddings_with_retry(texts, limiter)
+    assert [embedding[0] if embedding else None for embedding in embeddings] == [1.0, 2.0, None, 4.0]
+    assert requests == [texts, ["a", "bb"], ["rejected", "dddd"], ["rejected"], ["dddd"]]
+    assert limiter.in_flight == 0
+
+    batch = [(text, {"filename": "policy.pdf", "chunk": chunk}) for chunk, text in enumerate(texts)]
+    records = pdfs_to_seed_json.build_chunk_records(batch, limiter)
+    assert [record["chunk"] for record in records] == [0, 1, 3]
+
+
+def test_apply_delta_keeps_full_export_complete(pdfs_to_seed_json, tmp_path):
+    full_path = str(tmp_path / "seed_data.jsonl")
+    delta_path = str(tmp_path / "seed_data_delta.jsonl")
+    with pdfs_to_seed_json.SeedWriter(full_path) as writer:
+        for record_id in (1, 2, 3):
+            writer.write({"id": record_id, "content": f"old {record_id}"})
+    with pdfs_to_seed_json.SeedWriter(delta_path) as writer:
+        writer.write({"id": 2, "content": "new 2"})
+        writer.write({"id": 4, "content": "new 4"})
+        writer.write({"id": 3, "deleted": True})
+
+    assert pdfs_to_seed_json.apply_delta(full_path, delta_path, keep_previous=True) == 3
+    records = {record["id"]: record["content"] for record in pdfs_to_seed_json.read_seed_records(full_path)}
+    assert records == {1: "old 1", 2: "new 2", 4: "new 4"}
+
+
+def test_unloaded_delta_is_carried_over(pdfs_to_seed_json, tmp_path):
+    delta_path = str(tmp_path / "seed_data_delta.jsonl")
+    with pdfs_to_seed_json.SeedWriter(delta_path) as writer:
+        writer.write({"id": 1, "content": "first run"})
+        writer.write({"id": 2, "deleted": True})
+        writer.write({"id": 3, "content": "first run"})
+
+    with pdfs_to_seed_json.SeedWriter(delta_path) as delta_writer:
+        writer = pdfs_to_seed_json.TrackingWriter(delta_writer)
+        writer.write({"id": 3, "content": "second run"})
+        pdfs_to_seed_json.copy_unreplaced_records(delta_path, delta_writer, writer.ids)
+
+    records = list(pdfs_to_seed_json.read_seed_records(delta_path))
+    assert records == [
+        {"id": 3, "content": "second run"},
+        {"id": 1, "content": "first run"},
+        {"id": 2, "deleted": True},
+    ]
+
+
+def test_extraction_is_bounded(pdfs_to_seed_json, tmp_path, monkeypatch):
+    for index in range(10):
+        (tmp_path / f"policy{index}.pdf").write_bytes(b"%PDF-" + str(index).encode())
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pdfs_to_seed_json, "PDF_DIRS", [str(tmp_path)])
+    monkeypatch.setattr(pdfs_to_seed_json, "MAX_PENDING_FILES", 2)
+    submitted: list[str] = []
+    diffed: list[str] = []
+
+    class CountingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, /, *args, **kwargs):
+            submitted.append(args[0])
+            # Files may only be submitted while fewer than MAX_PENDING_FILES files wait to be diffed
+            assert len(submitted) - len(diffed) <= 2
+            return super().submit(fn, *args, **kwargs)
+
+    def fake_extract_file(filename, folder_path, base_fileurl, doctype, unchanged_sha256=None):
+        page = {"filename": filename, "pagenumber": 1, "content": filename}
+        return filename, ([page], [(filename, {"filename": filename, "pagenumber": 1, "chunk": 0})])
+
+    original_diff_file_pages = pdfs_to_seed_json.diff_file_pages
+
+    def counting_diff_file_pages(pages, file_entry, manifest):
+        diffed.append(pages[0]["filename"])
+        return original_diff_file_pages(pages, file_entry, manifest)
+
+    monkeypatch.setattr(pdfs_to_seed_json, "ProcessPoolExecutor", CountingExecutor)
+    monkeypatch.setattr(pdfs_to_seed_json, "extract_file", fake_extract_file)
+    monkeypatch.setattr(pdfs_to_seed_json, "diff_file_pages", counting_diff_file_pages)
+    monkeypatch.setattr(
+        pdfs_to_seed_json, "build_chunk_records", lambda batch, limiter: [metadata for _, metadata in batch]
+    )
+    records: list[dict] = []
+    pages: list[dict] = []
+
+    class ListWriter:
+        def __init__(self, items):
+            self.write = items.append
+
+    manifest = pdfs_to_seed_json.process_all_pdfs(ListWriter(records), ListWriter(pages))
+    assert sorted(submitted) == sorted(diffed) == sorted(f"policy{index}.pdf" for index in range(10))
+    assert len(records) == len(pages) == len(manifest["files"]) == 10
@@ -1,11 +1,19 @@
 import os
+import time
 
 import pytest
+from azure.core.credentials import AccessToken
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import InMemoryMetricReader, NumberDataPoint
+from sqlalchemy.ext.asyncio import create_async_engine
 
 from fastapi_app.postgres_engine import (
+    AzureTokenCache,
     create_postgres_engine,
     create_postgres_engine_from_args,
     create_postgres_engine_from_env,
+    get_pool_stats,
+    register_pool_metrics,
 )
 from tests.conftest import POSTGRES_DATABASE, POSTGRES_HOST, POSTGRES_PASSWORD, POSTGRES_SSL, POSTGRES_USERNAME
 
@@ -61,3 +69,57 @@ async def test_create_postgres_engine_from_args(mock_azure_credential):
     assert engine.url.database == os.environ["POSTGRES_DATABASE"]
     assert engine.url.password == os.environ.get("POSTGRES_PASSWORD")
     assert engine.url.query["ssl"] == "prefer"
+
+
+@pytest.mark.asyncio
+async def test_create_postgres_engine_pool_settings(mock_session_env, monkeypatch):
+    monkeypatch.setenv("POSTGRES_POOL_SIZE", "20")
+    monkeypatch.setenv("POSTGRES_POOL_MAX_OVERFLOW", "5")
+    monkeypatch.setenv("POSTGRES_POOL_PRE_PING", "true")
+    engine = await create_postgres_engine_from_env()
+    stats = get_pool_stats(engine)
+    assert stats.size == 20
+    assert stats.checked_out == 0
+    assert stats.max_connections == 25
+    assert engine.sync_engine.pool._pre_ping is True
+
+
+def test_register_pool_metrics_reports_every_pool():
+    engines = {
+        "primary": create_async_engine("postgresql+asyncpg://admin@localhost/postgres", pool_size=10, max_overflow=5),
+        "replica-1": create_async_engine("postgresql+asyncpg://admin@replica-1/postgres", pool_size=4, max_overflow=0),
+    }
+    reader = InMemoryMetricReader()
+    register_pool_metrics(engines, meter_provider=MeterProvider(metric_readers=[reader]))
+    metrics_data = reader.get_metrics_data()
+    assert metrics_data is not None
+    metrics = {metric.name: metric for metric in metrics_data.resource_metrics[0].scope_metrics[0].metrics}
+    max_connections = {
+        dict(point.attributes or {})["db.client.connection.pool.name"]: point.value
+        for point in metrics["db.client.connection.max"].data.data_points
+        if isinstance(point, NumberDataPoint)
+    }
+    assert max_connections == {"primary": 15, "replica-1": 4}
+    assert len(metrics["db.client.connection.count"].data.data_points) == 4
+
+
+@pytest.mark.asyncio
+async def test_azure_token_cache_refreshes_ahead_of_expiry():
+    class ExpiringCredential:
+        def __init__(self):
+            self.calls = 0
+
+        def get_token(self, *scopes):
+            self.calls += 1
+            # The first token is about to expire, the next ones are valid for an hour
+            return AccessToken(f"token-{self.calls}", int(time.time()) + (60 if self.calls == 1 else 3600))
+
+    credential = ExpiringCredential()
+    token_cache = AzureTokenCache(credential, refresh_margin_seconds=300)
+    assert await token_cache.refresh() == "token-1"
+    # The cached token is returned right away, while a new one is fetched in the background
+    assert token_cache.get_token() == "token-1"
+    assert token_cache._refresh_task is not None
+    await token_cache._refresh_task
+    assert token_cache.get_token() == "token-2"
+    assert credential.calls == 2
@@ -1,6 +1,7 @@
 import pytest
 
 from fastapi_app.api_models import Filter, ItemPublic
+from fastapi_app.postgres_searcher import PostgresSearcher, reciprocal_rank_fusion
 from tests.data import test_data
 
 
@@ -31,6 +32,39 @@ def test_postgres_build_filter_clause_with_filters_numeric(postgres_searcher):
     )
 
 
+def test_reciprocal_rank_fusion():
+    assert reciprocal_rank_fusion([[1, 2, 3], [3, 4]]) == [3, 1, 2, 4]
+    assert reciprocal_rank_fusion([[], [5]]) == [5]
+    assert reciprocal_rank_fusion([]) == []
+
+
+def test_postgres_build_vector_query_quantized(postgres_searcher):
+    halfvec_searcher = PostgresSearcher(
+        db_session=postgres_searcher.db_session,
+        openai_embed_client=postgres_searcher.openai_embed_client,
+        embed_deployment=postgres_searcher.embed_deployment,
+        embed_model=postgres_searcher.embed_model,
+        embed_dimensions=postgres_searcher.embed_dimensions,
+        embedding_column="embedding_3l",
+        vector_index_mode="halfvec",
+    )
+    assert "CAST(embedding_3l AS halfvec(1536)) <=>" in halfvec_searcher.build_vector_query("")
+    binary_searcher = PostgresSearcher(
+        db_session=postgres_searcher.db_session,
+        openai_embed_client=postgres_searcher.openai_embed_client,
+        embed_deployment=postgres_searcher.embed_deployment,
+        embed_model=postgres_searcher.embed_model,
+        embed_dimensions=postgres_searcher.embed_dimensions,
+        embedding_column="embedding_3l",
+        vector_index_mode="binary",
+        binary_rerank_candidates=100,
+    )
+    vector_query = binary_searcher.build_vector_query("")
+    assert "CAST(binary_quantize(embedding_3l) AS bit(1536)) <~>" in vector_query
+    assert "LIMIT 100" in vector_query
+    assert binary_searcher.hnsw_settings.ef_search == 100
+
+
 @pytest.mark.asyncio
 async def test_postgres_searcher_search_empty_text_search(postgres_searcher):
     assert await postgres_searcher.search("", [], 5, None) == []
@@ -0,0 +1,33 @@
+from fastapi_app.query_rewriter import needs_query_rewrite, queries_match
+
+
+def test_queries_match():
+    assert queries_match("How do I apply for parental leave?", "how do i apply for Parental Leave")
+    assert not queries_match("How do I apply for parental leave?", "parental leave application process")
+    assert queries_match("", "?")
+
+
+def test_needs_query_rewrite_single_turn():
+    rewrite_needed, _ = needs_query_rewrite("What is the annual leave entitlement?", [])
+    assert rewrite_needed is False
+
+
+def test_needs_query_rewrite_with_history():
+    rewrite_needed, _ = needs_query_rewrite(
+        "And for consultants?",
+        [
+            {"content": "What is the annual leave entitlement?", "role": "user"},
+            {"content": "Staff are entitled to 2.5 days per month.", "role": "assistant"},
+        ],
+    )
+    assert rewrite_needed is True
+
+
+def test_needs_query_rewrite_non_english():
+    rewrite_needed, _ = needs_query_rewrite("¿Cuántos días de vacaciones tengo?", [])
+    assert rewrite_needed is True
+
+
+def test_needs_query_rewrite_long_query():
+    rewrite_needed, _ = needs_query_rewrite(" ".join(["leave"] * 30), [])
+    assert rewrite_needed is True
@@ -0,0 +1,82 @@
+from typing import Any
+
+import pytest
+from openai import AsyncOpenAI
+
+from fastapi_app.api_models import ChatRequest, ChatRequestContext, ChatRequestOverrides
+from fastapi_app.rag_advanced import AdvancedRAGChat
+from fastapi_app.rag_flow_factory import RAGFlowFactory
+
+
+class FakeItem:
+    def __init__(self, id: int):
+        self.id = id
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "filename": "travel_policy.pdf",
+            "fileurl": "https://example.com/travel_policy.pdf",
+            "pagenumber": 1,
+            "chunk": self.id,
+            "content": f"Chunk {self.id}",
+            "typedoc": "policy",
+        }
+
+
+class FakeSearcher:
+    def __init__(self):
+        self.queries: list[str] = []
+
+    async def search_and_embed(self, query_text: str, **kwargs) -> list[FakeItem]:
+        self.queries.append(query_text)
+        return [FakeItem(1), FakeItem(2)]
+
+
+@pytest.mark.asyncio
+async def test_speculative_results_used_when_search_agent_fails(monkeypatch):
+    async def failing_run(*args, **kwargs):
+        raise RuntimeError("The chat model is unavailable")
+
+    monkeypatch.setattr("fastapi_app.rag_advanced.Runner.run", failing_run)
+    factory = RAGFlowFactory(AsyncOpenAI(api_key="not-used"), "gpt-4o-mini", None)
+    searcher = FakeSearcher()
+    chat_request = ChatRequest(
+        messages=[{"content": "What is the per diem for Geneva?", "role": "user"}],
+        context=ChatRequestContext(
+            overrides=ChatRequestOverrides(
+                use_advanced_flow=True, speculative_retrieval=True, skip_single_turn_rewrite=False
+            )
+        ),
+    )
+    flow = factory.create_flow(chat_request, searcher)  # type: ignore[arg-type]
+    assert isinstance(flow, AdvancedRAGChat)
+
+    items, thoughts = await flow.prepare_context()
+
+    assert [item.id for item in items] == [1, 2]
+    assert searcher.queries == ["What is the per diem for Geneva?"]
+    assert thoughts[0].title == "Prompt to generate search arguments"
+    assert thoughts[0].description[-1]["content"].endswith("What is the per diem for Geneva?")
+    assert thoughts[2].props == {"reused": True, "merged": False}
+
+
+@pytest.mark.asyncio
+async def test_single_turn_query_skips_rewrite_by_default(monkeypatch):
+    async def unexpected_run(*args, **kwargs):
+        raise AssertionError("The search agent should not be called")
+
+    monkeypatch.setattr("fastapi_app.rag_advanced.Runner.run", unexpected_run)
+    factory = RAGFlowFactory(AsyncOpenAI(api_key="not-used"), "gpt-4o-mini", None)
+    searcher = FakeSearcher()
+    chat_request = ChatRequest(
+        messages=[{"content": "What is the per diem for Geneva?", "role": "user"}],
+        context=ChatRequestContext(overrides=ChatRequestOverrides(use_advanced_flow=True)),
+    )
+    flow = factory.create_flow(chat_request, searcher)  # type: ignore[arg-type]
+
+    items, thoughts = await flow.prepare_context()
+
+    assert [item.id for item in items] == [1, 2]
+    assert searcher.queries == ["What is the per diem for Geneva?"]
+    assert thoughts[0].title == "Skipped query rewrite"
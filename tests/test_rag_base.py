@@ -0,0 +1,101 @@
+from typing import Optional
+
+import pytest
+
+from fastapi_app.api_models import ChatRequestOverrides, ItemPublic
+from fastapi_app.chat_history import ChatHistory
+from fastapi_app.context_builder import ContextBuilder, get_message_text
+from fastapi_app.rag_base import RAGChatBase
+
+
+class FakeSearcher:
+    def __init__(self, pages: dict[int, str]):
+        self.pages = pages
+        self.requested_page_ids: list[int] = []
+
+    async def fetch_page_contents(self, page_ids: list[int]) -> dict[int, str]:
+        self.requested_page_ids = page_ids
+        return {page_id: self.pages[page_id] for page_id in page_ids if page_id in self.pages}
+
+
+class FakeRAGChat(RAGChatBase):
+    def __init__(
+        self,
+        overrides: ChatRequestOverrides,
+        searcher: FakeSearcher,
+        past_messages: Optional[list] = None,
+        input_token_budget: int = 6000,
+    ):
+        messages = (past_messages or []) + [{"content": "parental leave", "role": "user"}]
+        self.chat_params = self.get_chat_params(messages, overrides, input_token_budget)
+        self.context_builder = ContextBuilder("gpt-4o-mini")
+        self.chat_history = ChatHistory(messages[:-1])
+        self.searcher = searcher  # type: ignore[assignment]
+
+    async def prepare_context(self):
+        raise NotImplementedError
+
+    async def answer(self, items, earlier_thoughts):
+        raise NotImplementedError
+
+    async def answer_stream(self, items, earlier_thoughts):
+        raise NotImplementedError
+        yield
+
+
+def make_item(id: int, page_id, content: str) -> ItemPublic:
+    return ItemPublic(
+        id=id,
+        filename="leave.pdf",
+        fileurl="https://example.com/leave.pdf",
+        pagenumber=page_id or 0,
+        chunk=id,
+        content=content,
+        typedoc="HR Policy",
+        page_id=page_id,
+    )
+
+
+@pytest.mark.asyncio
+async def test_expand_to_pages():
+    searcher = FakeSearcher({10: "Full page 10", 20: "Full page 20"})
+    rag_chat = FakeRAGChat(ChatRequestOverrides(expand_top_pages=2), searcher)
+    items = [
+        make_item(1, 10, "chunk 1"),
+        make_item(2, 10, "chunk 2"),
+        make_item(3, 20, "chunk 3"),
+        make_item(4, None, "chunk 4"),
+    ]
+    expanded = await rag_chat.expand_to_pages(items)
+    assert searcher.requested_page_ids == [10, 10]
+    # The second chunk of page 10 is dropped, and page 20 is not among the top 2 results
+    assert [(item.id, item.content) for item in expanded] == [(1, "Full page 10"), (3, "chunk 3"), (4, "chunk 4")]
+
+
+@pytest.mark.asyncio
+async def test_expand_to_pages_disabled():
+    searcher = FakeSearcher({10: "Full page 10"})
+    rag_chat = FakeRAGChat(ChatRequestOverrides(), searcher)
+    items = [make_item(1, 10, "chunk 1")]
+    assert await rag_chat.expand_to_pages(items) == items
+    assert searcher.requested_page_ids == []
+
+
+def test_build_answer_input_fits_budget():
+    past_messages = [
+        {"content": "earlier question " * 200, "role": "user"},
+        {"content": "recent answer", "role": "assistant"},
+    ]
+    items = [make_item(i, i, "policy text " * 200) for i in range(1, 6)]
+    unlimited = FakeRAGChat(ChatRequestOverrides(), FakeSearcher({}), past_messages, input_token_budget=100_000)
+    assert unlimited.build_answer_input(items)[:-1] == past_messages
+
+    rag_chat = FakeRAGChat(ChatRequestOverrides(), FakeSearcher({}), past_messages, input_token_budget=2000)
+    answer_input = rag_chat.build_answer_input(items)
+    # The oldest message and the lowest-ranked sources are left out
+    assert answer_input[:-1] == past_messages[1:]
+    rag_request = get_message_text(answer_input[-1])
+    assert rag_request.startswith("parental leave")
+    assert "[1] Page 1" in rag_request and "[5] Page 5" not in rag_request
+    builder = rag_chat.context_builder
+    assert builder.count_tokens(rag_chat.answer_prompt_template) + builder.count_message_tokens(answer_input) <= 2000
@@ -0,0 +1,34 @@
+from typing import Any
+
+from openai import AsyncOpenAI
+
+from fastapi_app.api_models import ChatRequest, ChatRequestContext, ChatRequestOverrides
+from fastapi_app.rag_advanced import AdvancedRAGChat
+from fastapi_app.rag_flow_factory import RAGFlowFactory
+from fastapi_app.rag_simple import SimpleRAGChat
+
+
+def make_chat_request(**overrides) -> ChatRequest:
+    return ChatRequest(
+        messages=[{"content": "What is the per diem for Geneva?", "role": "user"}],
+        context=ChatRequestContext(overrides=ChatRequestOverrides(**overrides)),
+    )
+
+
+def test_flows_share_agents():
+    factory = RAGFlowFactory(AsyncOpenAI(api_key="not-used"), "gpt-4o-mini", None, input_token_budget=4000)
+    # Creating a flow doesn't use the searcher
+    searcher: Any = None
+    simple_flow = factory.create_flow(make_chat_request(use_advanced_flow=False, temperature=0.1, seed=7), searcher)
+    advanced_flow = factory.create_flow(make_chat_request(use_advanced_flow=True), searcher)
+    assert isinstance(simple_flow, SimpleRAGChat)
+    assert isinstance(advanced_flow, AdvancedRAGChat)
+    assert simple_flow.answer_agent is advanced_flow.answer_agent
+    assert advanced_flow.search_agent.tools[0].name == "search_database"
+    assert simple_flow.chat_params.input_token_budget == 4000
+    assert simple_flow.model_for_thoughts == {"model": "gpt-4o-mini"}
+    # Per-request settings are passed with the run instead of being baked into the shared agent
+    model_settings = simple_flow.get_answer_run_config().model_settings
+    assert model_settings is not None
+    assert model_settings.temperature == 0.1
+    assert model_settings.extra_body == {"seed": 7}
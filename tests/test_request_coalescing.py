@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from fastapi_app.api_models import ChatRequest, ChatRequestContext, ChatRequestOverrides
+from fastapi_app.request_coalescing import RequestCoalescer, make_request_key
+
+
+def make_chat_request(content: str, **overrides) -> ChatRequest:
+    return ChatRequest(
+        messages=[{"content": content, "role": "user"}],
+        context=ChatRequestContext(overrides=ChatRequestOverrides(**overrides)),
+    )
+
+
+def test_make_request_key():
+    key = make_request_key(make_chat_request("What is the per diem for Geneva?"))
+    assert make_request_key(make_chat_request("  what is the per diem  for Geneva?")) == key
+    assert make_request_key(make_chat_request("What is the per diem for Bern?")) != key
+    assert make_request_key(make_chat_request("What is the per diem for Geneva?", top=5)) != key
+
+
+@pytest.mark.asyncio
+async def test_run_coalesces_concurrent_requests():
+    coalescer = RequestCoalescer()
+    runs = 0
+    release = asyncio.Event()
+
+    async def pipeline():
+        nonlocal runs
+        runs += 1
+        await release.wait()
+        return runs
+
+    requests = [asyncio.create_task(coalescer.run("key", pipeline)) for _ in range(5)]
+    other_request = asyncio.create_task(coalescer.run("other key", pipeline))
+    await asyncio.sleep(0)
+    # A request that gives up doesn't cancel the run for the others
+    requests[0].cancel()
+    release.set()
+    results = await asyncio.gather(*requests[1:], other_request)
+    assert runs == 2
+    assert len(set(results[:-1])) == 1
+    # Once the run is over, the next request runs the pipeline again
+    assert await coalescer.run("key", pipeline) == 3
+
+
+@pytest.mark.asyncio
+async def test_run_shares_errors():
+    coalescer = RequestCoalescer()
+
+    async def pipeline():
+        await asyncio.sleep(0)
+        raise ValueError("search failed")
+
+    results = await asyncio.gather(*(coalescer.run("key", pipeline) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert coalescer._runs == {}
+
+
+@pytest.mark.asyncio
+async def test_stream_fans_out_to_subscribers():
+    coalescer = RequestCoalescer()
+    prepares = 0
+    release = asyncio.Event()
+
+    async def answer_stream():
+        yield "Per diem "
+        await release.wait()
+        yield "is 300 CHF."
+
+    async def prepare():
+        nonlocal prepares
+        prepares += 1
+        return answer_stream()
+
+    async def read(stream):
+        return [event async for event in stream]
+
+    first = await coalescer.stream("key", prepare)
+    first_events = asyncio.create_task(read(first))
+    await asyncio.sleep(0)
+    # A request that joins after the first tokens still gets the whole stream
+    second = await coalescer.stream("key", prepare)
+    release.set()
+    assert await first_events == ["Per diem ", "is 300 CHF."]
+    assert await read(second) == ["Per diem ", "is 300 CHF."]
+    assert prepares == 1
+    assert coalescer._streams == {}
@@ -0,0 +1,65 @@
+import gzip
+import json
+from typing import Any
+
+import numpy as np
+import pytest
+
+from fastapi_app.seed_io import SeedWriter, decode_embedding, encode_embedding, find_seed_file, read_seed_records
+
+RECORDS: list[dict[str, Any]] = [
+    {"id": 1, "filename": "policy.pdf", "content": "Policy text", "embedding_3l": [0.5, -1.25, 3.0]},
+    {"id": 2, "deleted": True},
+]
+
+
+def test_encode_decode_embedding():
+    embedding = [0.1, 0.2, -0.3]
+    decoded = decode_embedding(encode_embedding(embedding))
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, embedding, rtol=1e-6)
+    np.testing.assert_allclose(decode_embedding(embedding), embedding, rtol=1e-6)
+
+
+@pytest.mark.parametrize("filename", ["seed_data.jsonl", "seed_data.jsonl.gz", "seed_data.json"])
+def test_seed_writer_roundtrip(tmp_path, filename):
+    path = str(tmp_path / filename)
+    with SeedWriter(path) as writer:
+        for record in RECORDS:
+            writer.write(record)
+    assert writer.count == 2
+    assert find_seed_file(str(tmp_path)) == path
+
+    records = list(read_seed_records(path))
+    assert records[0]["content"] == "Policy text"
+    np.testing.assert_array_equal(records[0]["embedding_3l"], [0.5, -1.25, 3.0])
+    assert records[1] == {"id": 2, "deleted": True}
+
+
+def test_seed_writer_formats(tmp_path):
+    with SeedWriter(str(tmp_path / "seed_data.jsonl.gz")) as writer:
+        writer.write(RECORDS[0])
+    with gzip.open(tmp_path / "seed_data.jsonl.gz", "rt", encoding="utf-8") as f:
+        assert isinstance(json.loads(f.readline())["embedding_3l"], str)
+
+    with SeedWriter(str(tmp_path / "seed_data.json")) as writer:
+        writer.write(RECORDS[0])
+    with open(tmp_path / "seed_data.json", encoding="utf-8") as f:
+        assert json.load(f) == [RECORDS[0]]
+
+
+def test_seed_writer_error_keeps_existing_file(tmp_path):
+    path = str(tmp_path / "seed_data.jsonl")
+    with SeedWriter(path) as writer:
+        writer.write(RECORDS[0])
+    with pytest.raises(ValueError):
+        with SeedWriter(path) as writer:
+            writer.write(RECORDS[1])
+            raise ValueError("embedding failed")
+    assert [record["id"] for record in read_seed_records(path)] == [1]
+    assert not (tmp_path / "seed_data.jsonl.tmp").exists()
+
+
+def test_find_seed_file_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        find_seed_file(str(tmp_path))
@@ -0,0 +1,52 @@
+import pytest
+
+from fastapi_app.setup_postgres_seeddata import get_record_columns, load_batch
+
+
+def test_get_record_columns():
+    records = [
+        {"id": 1, "content": "Policy text", "embedding_3l": [0.5]},
+        {"embedding_3l": [1.5], "content": "Other text", "id": 2},
+    ]
+    assert get_record_columns(records) == ["id", "content", "embedding_3l"]
+
+
+def test_get_record_columns_mismatch():
+    records = [
+        {"id": 1, "content": "Policy text", "embedding_3l": [0.5]},
+        {"id": 2, "content": "Other text", "page_id": 3},
+    ]
+    with pytest.raises(ValueError, match=r"Seed record 2 .* missing \['embedding_3l'\], extra \['page_id'\]"):
+        get_record_columns(records)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements: list[str] = []
+
+    def transaction(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def copy_records_to_table(self, table_name, records, columns):
+        pass
+
+    async def execute(self, statement, *args):
+        self.statements.append(statement)
+
+
+@pytest.mark.asyncio
+async def test_load_batch_clears_columns_missing_from_records():
+    connection = FakeConnection()
+    batch: list[dict] = [{"id": 1, "content": "Policy text", "embedding_3l": [0.5]}, {"id": 2, "deleted": True}]
+    assert await load_batch(connection, "items", batch, "update", ["embedding_3s", "embedding_3l"]) == (1, 1)
+    assert connection.statements[0].endswith(
+        "ON CONFLICT (id) DO UPDATE SET content = excluded.content, embedding_3l = excluded.embedding_3l, "
+        "embedding_3s = NULL"
+    )
+    assert connection.statements[1].startswith("DELETE FROM items")
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from fastapi_app.postgres_models import Item
+from fastapi_app.update_embeddings import EmbeddingCheckpoint, build_update_statement, run_batches
+
+
+def test_checkpoint_only_advances_past_contiguous_batches(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = EmbeddingCheckpoint(path, "embedding_3l")
+    for batch_last_id in (10, 20, 30):
+        checkpoint.start(batch_last_id)
+    checkpoint.commit(20)
+    assert checkpoint.last_id == 0
+    checkpoint.commit(10)
+    assert checkpoint.last_id == 20
+    checkpoint.commit(30)
+    assert checkpoint.last_id == 30
+
+    assert EmbeddingCheckpoint.load(path, "embedding_3l").last_id == 30
+    # A checkpoint for another column is ignored
+    assert EmbeddingCheckpoint.load(path, "embedding_nomic").last_id == 0
+    assert EmbeddingCheckpoint.load(str(tmp_path / "missing.json"), "embedding_3l").last_id == 0
+
+
+def test_content_hash_changes_with_embedded_text():
+    item = Item(content="Annual leave policy", filename="leave.pdf", pagenumber=1)
+    content_hash = item.compute_content_hash()
+    same_item = Item(content="Annual leave policy", filename="leave.pdf", pagenumber=1)
+    assert same_item.compute_content_hash() == content_hash
+    item.content = "Updated annual leave policy"
+    assert item.compute_content_hash() != content_hash
+
+
+def test_update_statement_only_sets_content_hash_for_live_column():
+    assert build_update_statement("embedding_3l", update_content_hash=True) == (
+        "UPDATE items SET embedding_3l = :embedding, content_hash = :content_hash WHERE id = :id"
+    )
+    # A shadow column backfill must not mark rows as current for the live column
+    assert build_update_statement("embedding_new", update_content_hash=False) == (
+        "UPDATE items SET embedding_new = :embedding WHERE id = :id"
+    )
+
+
+async def make_batches(batch_count: int, batch_size: int, read: list[int], closed: list[bool]):
+    try:
+        for batch in range(batch_count):
+            read.append(batch)
+            yield list(range(batch * batch_size, (batch + 1) * batch_size))
+    finally:
+        closed.append(True)
+
+
+@pytest.mark.asyncio
+async def test_run_batches_processes_every_batch():
+    updated_ids: list[int] = []
+    in_flight = max_in_flight = 0
+
+    async def update_batch(ids: list[int]):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        # Batches finish out of order
+        await asyncio.sleep(0.001 * (ids[0] % 3))
+        updated_ids.extend(ids)
+        in_flight -= 1
+
+    read: list[int] = []
+    closed: list[bool] = []
+    await run_batches(make_batches(20, 5, read, closed), update_batch, concurrency=4)
+    assert sorted(updated_ids) == list(range(100))
+    assert max_in_flight == 4
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_run_batches_stops_after_a_failed_batch():
+    async def update_batch(ids: list[int]):
+        await asyncio.sleep(0.001)
+        if ids[0] == 10:
+            raise ValueError("Embedding request failed")
+
+    read: list[int] = []
+    closed: list[bool] = []
+    with pytest.raises(ValueError, match="Embedding request failed"):
+        await run_batches(make_batches(20, 5, read, closed), update_batch, concurrency=4)
+    assert len(read) < 20
+    assert closed == [True]